@@ -141,6 +141,29 @@ class Colony(object):
         #print(len(nodes))
         self._nodes = nodes
 
+    def map_cells(self, function, priors=None):
+        """
+        Make a copy of the flattened colony with function applied to every cell, keeping splits.
+
+        :param function: Maps a cell to its replacement.
+        :param priors: A colony whose nodes' priors are reused, node for node, instead of mapping the priors.
+        """
+        colony = Colony()
+        prior_nodes = priors._nodes if priors is not None else [None] * len(self._nodes)
+        for node, prior_node in zip(self._nodes, prior_nodes):
+            if prior_node is not None:
+                prior = prior_node.prior
+            elif node.prior is not None:
+                prior = CellNode(function(node.prior.cell))
+            else:
+                prior = None
+            new_node = CellNode(function(node.cell), prior=prior)
+            if node.children:
+                child1, child2 = node.children
+                new_node.push2(function(child1.cell), function(child2.cell), child1.alpha)
+            colony.add(new_node)
+        return colony
+
     def clone(self):
         """Make a deep copy of the colony."""
         colony = Colony()
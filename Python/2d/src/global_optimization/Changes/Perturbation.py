@@ -4,10 +4,11 @@ import numpy as np
 from copy import deepcopy
 from typing import Any, Dict, List, Tuple
 from global_optimization.Modules import CellNodeM, FrameM
+from proposals import ProposalStream
 
 
 class Perturbation(Change):
-    def __init__(self, node: CellNodeM, config: Dict[str, Any], frame: FrameM):
+    def __init__(self, node: CellNodeM, config: Dict[str, Any], frame: FrameM, proposals: ProposalStream):
         self.node = node
         self.config = config
         self._checks = []
@@ -52,26 +53,29 @@ class Perturbation(Change):
         #     p_decision = np.array([p_x, p_y, p_width, p_length, p_rotation])
         p_decision = np.array([p_x, p_y, p_width, p_length, p_rotation, p_z])
 
-        p = np.random.uniform(0.0, 1.0, size=p_decision.size)
+        # draw from the pre-drawn proposal stream
+        uniforms, normal = proposals.uniforms, proposals.normal
+
+        p = uniforms(p_decision.size)
         # generate a sequence such that at least an attribute must be modified
         while not valid and badcount < 50:
             while (p > p_decision).all():
-                p = np.random.uniform(0.0, 1.0, size=p_decision.size)
+                p = uniforms(p_decision.size)
 
             if p[0] < p_decision[0]:  # perturb x
-                new_cell.x = cell.x + np.random.normal(x_mu, x_sigma)
+                new_cell.x = cell.x + normal(x_mu, x_sigma)
 
             if p[1] < p_decision[1]:  # perturb y
-                new_cell.y = cell.y + np.random.normal(y_mu, y_sigma)
+                new_cell.y = cell.y + normal(y_mu, y_sigma)
 
             if p[2] < p_decision[2]:  # perturb width
-                new_cell.width = cell.width + np.random.normal(width_mu, width_sigma)
+                new_cell.width = cell.width + normal(width_mu, width_sigma)
 
             if p[3] < p_decision[3]:  # perturb length
-                new_cell.length = cell.length + np.random.normal(length_mu, length_sigma)
+                new_cell.length = cell.length + normal(length_mu, length_sigma)
 
             if p[4] < p_decision[4]:  # perturb rotation
-                new_cell.rotation = cell.rotation + np.random.normal(rotation_mu, rotation_sigma)
+                new_cell.rotation = cell.rotation + normal(rotation_mu, rotation_sigma)
 
             # if p[5] < p_decision[5]:  # perturb z
             #     new_cell.z = cell.z + int(np.random.normal(0, 0.1))
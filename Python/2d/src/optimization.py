@@ -1,5 +1,6 @@
 import time
 import math
+from copy import deepcopy
 from math import sqrt
 from itertools import chain
 
@@ -10,6 +11,8 @@ from scipy.optimize import leastsq
 
 from colony import LineageFrames
 from lineage_funcs import load_colony
+from proposals import ProposalStream
+from sampling import FenwickSampler
 
 import dask.distributed
 
@@ -115,9 +118,10 @@ def load_image(imagefile):
     return realimage
 
 
-def perturb_bacilli(node, config, imageshape, invalid_limit=50):
-    """Create a new perturbed bacilli cell."""
+def perturb_bacilli(node, config, imageshape, proposals, invalid_limit=50):
+    """Create a new perturbed bacilli cell, drawing the random numbers from proposals."""
     global badcount  # DEBUG
+    uniforms, normal = proposals.uniforms, proposals.normal
     cell = node.cell
     prior = node.prior.cell
 
@@ -177,28 +181,28 @@ def perturb_bacilli(node, config, imageshape, invalid_limit=50):
         else:
             p_decision = np.array([p_x, p_y, p_width, p_length, p_rotation])
 
-        p = np.random.uniform(0.0, 1.0, size=p_decision.size)
+        p = uniforms(p_decision.size)
 
         # generate a sequence such that at least an attribute must be modified
         while (p > p_decision).all():
-            p = np.random.uniform(0.0, 1.0, size=p_decision.size)
+            p = uniforms(p_decision.size)
 
         if p[0] < p_decision[0]:  # perturb x
-            x = cell.x + np.random.normal(x_mu, x_sigma)
+            x = cell.x + normal(x_mu, x_sigma)
 
         if p[1] < p_decision[1]:  # perturb y
-            y = cell.y + np.random.normal(y_mu, y_sigma)
+            y = cell.y + normal(y_mu, y_sigma)
 
         if p[2] < p_decision[2]:  # perturb width
-            width = cell.width + np.random.normal(width_mu, width_sigma)
+            width = cell.width + normal(width_mu, width_sigma)
 
         if p[3] < p_decision[3]:  # perturb length
-            length = cell.length + np.random.normal(length_mu, length_sigma)
+            length = cell.length + normal(length_mu, length_sigma)
 
         if p[4] < p_decision[4]:  # perturb rotation
-            rotation = cell.rotation + np.random.normal(rotation_mu, rotation_sigma)
+            rotation = cell.rotation + normal(rotation_mu, rotation_sigma)
         # if simulation_config["image.type"] == "graySynthetic" and p[5] < p_decision[5]:
-            # cell_opacity = cell.opacity + (np.random.normal(opacity_mu, opacity_sigma))
+            # cell_opacity = cell.opacity + (normal(opacity_mu, opacity_sigma))
 
         displacement = sqrt(np.sum((np.array([x, y, 0] - prior.position))**2))
 
@@ -364,14 +368,115 @@ def auto_temp_schedule_cost(cost_diff):
     return True if ((cost_diff[1] - cost_diff[0]) / cost_diff[0]) > 0.2 else False
 
 
-def optimize_core(imagefile, colony, args, config, iterations_per_cell=3000, auto_temp_complete=True, auto_const_temp = 1):
+# The residual sampler helpers take stacks of images, so global_optimize can score cells over
+# every slice of a frame. A single image is passed as a stack of one.
+
+def region_bounds(region, shape):
+    """Clip a region to an image of the given shape, returning (top, bottom, left, right)."""
+    return (max(int(region.top), 0), min(int(region.bottom), shape[0]),
+            max(int(region.left), 0), min(int(region.right), shape[1]))
+
+
+def residual_score(realimages, synthimages, bounds):
+    """Sum of squared residuals inside the bounds of a cell, over every image of the stacks."""
+    top, bottom, left, right = bounds
+    return sum(np.sum(np.square(realimage[top:bottom, left:right] - synthimage[top:bottom, left:right]))
+               for realimage, synthimage in zip(realimages, synthimages))
+
+
+def residual_sampler(cellnodes, realimages, synthimages, simulation_config):
+    """Build a sampler weighting every cell by the residual over its simulated region, and the bounds of those regions."""
+    shape = realimages[0].shape
+    bounds = np.array([region_bounds(node.cell.simulated_region(simulation_config), shape)
+                       for node in cellnodes], dtype=int).reshape(-1, 4)
+    sampler = FenwickSampler(residual_score(realimages, synthimages, cell_bounds) for cell_bounds in bounds)
+    return sampler, bounds
+
+
+def update_residual_sampler(sampler, bounds, realimages, synthimages, region):
+    """Rescore the cells whose simulated region intersects a region that just changed."""
+    top, bottom, left, right = region_bounds(region, realimages[0].shape)
+    for index in np.flatnonzero((bounds[:, 0] < bottom) & (bounds[:, 1] > top) &
+                                (bounds[:, 2] < right) & (bounds[:, 3] > left)):
+        sampler.update(index, residual_score(realimages, synthimages, bounds[index]))
+
+
+def choose_cell_index(cell_count, sampler, uniform_floor, proposals):
+    """Pick a cell uniformly, or in proportion to the sampler weights mixed with a uniform floor."""
+    if sampler is None or sampler.total <= 0 or proposals.uniform() < uniform_floor:
+        return proposals.integer(cell_count)
+    return sampler.sample(proposals.uniform())
+
+
+# config values measured in pixels, divided by the downsampling factor at a coarse pyramid level
+PYRAMID_LENGTH_KEYS = ['bacilli.maxSpeed', 'bacilli.minGrowth', 'bacilli.maxGrowth', 'bacilli.minWidth',
+                       'bacilli.maxWidth', 'bacilli.minLength', 'bacilli.maxLength', 'bacilli.distanceCostDivisor']
+
+
+def downsample_image(image, factor):
+    """Downsample an image by averaging factor x factor blocks of pixels."""
+    height, width = image.shape[0] // factor * factor, image.shape[1] // factor * factor
+    return image[:height, :width].reshape(height // factor, factor, width // factor, factor).mean(axis=(1, 3))
+
+
+def pyramid_config(config, factor):
+    """Copy of the config with the lengths scaled to a coarse level. Perturbation sigmas stay in coarse pixels."""
+    config = deepcopy(config)
+    for key in PYRAMID_LENGTH_KEYS:
+        if key in config:
+            config[key] /= factor
+    sigma = config['simulation'].get('light.diffraction.sigma')
+    if isinstance(sigma, (int, float)):
+        config['simulation']['light.diffraction.sigma'] = sigma / factor
+    return config
+
+
+def pyramid_cell(cell, factor, inverse=False):
+    """
+    Map a cell to a coarse level, or back to full resolution if inverse is set. A coarse pixel j
+    covers the fine pixels factor * j ... factor * j + factor - 1.
+    """
+    cell = deepcopy(cell)
+    offset = (factor - 1) / 2
+    for attribute in ['x', 'y']:
+        if hasattr(cell, attribute):
+            value = getattr(cell, attribute)
+            setattr(cell, attribute, value * factor + offset if inverse else (value - offset) / factor)
+    for attribute in ['width', 'length', 'radius']:
+        if hasattr(cell, attribute):
+            value = getattr(cell, attribute)
+            setattr(cell, attribute, value * factor if inverse else value / factor)
+    return cell
+
+
+def optimize_core_pyramid(imagefile, colony, args, config, iterations_per_cell=3000):
+    """
+    Optimize coarse to fine: most iterations run on downsampled copies of the image (the
+    "pyramid.factors" config entry, coarsest first, e.g. [4, 2]) and a short refinement runs at
+    full resolution. "pyramid.iterations" sets the fraction of the iterations of each coarse level.
+    """
+    factors = config['pyramid.factors']
+    fractions = config.get('pyramid.iterations', [0.8 / len(factors)] * len(factors))
+    realimage = load_image(imagefile)
+
+    for factor, fraction in zip(factors, fractions):
+        coarse_colony = colony.map_cells(lambda cell: pyramid_cell(cell, factor))
+        coarse_colony, *_ = optimize_core(imagefile, coarse_colony, args, pyramid_config(config, factor),
+                                          iterations_per_cell * fraction, realimage=downsample_image(realimage, factor))
+        colony = coarse_colony.map_cells(lambda cell: pyramid_cell(cell, factor, inverse=True), priors=colony)
+
+    return optimize_core(imagefile, colony, args, config, iterations_per_cell * (1 - sum(fractions)), realimage=realimage)
+
+
+def optimize_core(imagefile, colony, args, config, iterations_per_cell=3000, auto_temp_complete=True, auto_const_temp = 1, realimage=None):
     """Core of the optimization routine."""
     global debugcount, badcount  # DEBUG
 
     bad_count = 0
     bad_prob_tot = 0
 
-    realimage = load_image(imagefile)
+    if realimage is None:
+        realimage = load_image(imagefile)
     shape = realimage.shape
     simulation_config = config["simulation"]
 
@@ -390,6 +495,15 @@ def optimize_core(imagefile, colony, args, config, iterations_per_cell=3000, aut
     else:
         cost = objective(realimage, synthimage, cellmap, config["overlap.cost"], config["cell.importance"])
 
+    # pre-drawn random numbers for cell picks, perturbations and acceptance tests
+    proposals = ProposalStream()
+
+    # optionally pick cells in proportion to the residual around them instead of uniformly
+    sampler = None
+    uniform_floor = config.get('selection.uniformFloor', 0.1)
+    if config.get('selection.residualWeighted', False):
+        sampler, bounds = residual_sampler(cellnodes, [realimage], [synthimage], simulation_config)
+
     # setup temperature schedule
     run_count = int(iterations_per_cell * len(cellnodes))
 
@@ -407,12 +521,12 @@ def optimize_core(imagefile, colony, args, config, iterations_per_cell=3000, aut
         #    print(f'{imagefile.name}: Progress: {100*i/run_count:.02f}%', flush=True)
 
         # choose a cell at random
-        index = np.random.randint(0, len(cellnodes))
+        index = choose_cell_index(len(cellnodes), sampler, uniform_floor, proposals)
         node = cellnodes[index]
 
         # perturb the cell and push it onto the stack
         if celltype == 'bacilli':
-            perturb_bacilli(node, config, shape)
+            perturb_bacilli(node, config, shape, proposals)
             new_node = node.children[0]
 
             old_synthimage = synthimage.copy()
@@ -534,7 +648,8 @@ def optimize_core(imagefile, colony, args, config, iterations_per_cell=3000, aut
                 bad_prob_tot += acceptance
 
             # check if the acceptance threshold was met; pop if not
-            if acceptance <= np.random.random_sample():
+            accepted = acceptance > proposals.uniform()
+            if not accepted:
                 # restore the previous cells
                 if combined:
                     presplit.pop()
@@ -555,6 +670,14 @@ def optimize_core(imagefile, colony, args, config, iterations_per_cell=3000, aut
             colony.flatten()
             cellnodes = list(colony)
 
+            if sampler is not None and accepted:
+                if len(cellnodes) != len(sampler):
+                    # a split or combination changed the cells, flattening keeps the order otherwise
+                    sampler, bounds = residual_sampler(cellnodes, [realimage], [synthimage], simulation_config)
+                else:
+                    bounds[index] = region_bounds(cellnodes[index].cell.simulated_region(simulation_config), shape)
+                    update_residual_sampler(sampler, bounds, [realimage], [synthimage], region)
+
             # DEBUG
             if args.debug and i % 80 == 0:
                 synthimage, cellmap = generate_synthetic_image(cellnodes, shape, simulation_config)
@@ -665,8 +788,10 @@ def optimize(imagefile, lineageframes, args, config, client):
     global badcount  # DEBUG
     badcount = 0  # DEBUG
 
+    core = optimize_core_pyramid if config.get('pyramid.factors') else optimize_core
+
     if not client:
-        colony, _, debugimage, best_fit_frame = optimize_core(imagefile, lineageframes.forward(), args, config)
+        colony, _, debugimage, best_fit_frame = core(imagefile, lineageframes.forward(), args, config)
         debugimage.save(args.output / imagefile.name)
         best_fit_frame.save(args.bestfit / imagefile.name)
         return colony
@@ -681,7 +806,7 @@ def optimize(imagefile, lineageframes, args, config, client):
     for colony in group:
         for i in range(ejob):
             newColony = colony.clone()
-            futures.append(client.submit(optimize_core, imagefile, newColony, args, config))
+            futures.append(client.submit(core, imagefile, newColony, args, config))
 
     try:
         dask.distributed.wait(futures, 360)
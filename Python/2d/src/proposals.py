@@ -0,0 +1,70 @@
+"""
+This module contains the proposal stream used by the optimization loops to draw random numbers.
+
+Drawing one number at a time from random or np.random costs microseconds of Python overhead per
+call. The stream instead draws large vectorized blocks of uniforms and standard normals from a
+seeded np.random.Generator and hands them out one at a time. Move types, cell indices,
+perturbation offsets and acceptance tests are all derived from these two blocks.
+"""
+
+from typing import Optional, Sequence
+
+import numpy as np
+
+
+class ProposalStream:
+    """Hands out pre-drawn uniform and normal random numbers, refilling them in blocks."""
+
+    def __init__(self, rng: Optional[np.random.Generator] = None, block_size: int = 65536):
+        """
+        :param rng: The generator to draw from. Defaults to one seeded from np.random, so the global
+                    seed still makes runs reproducible.
+        :param block_size: The number of values drawn at a time.
+        """
+        self.rng = rng if rng is not None else np.random.default_rng(np.random.randint(2 ** 32))
+        self.block_size = block_size
+        self._uniforms = np.empty(0)
+        self._uniform_cursor = 0
+        self._normals = np.empty(0)
+        self._normal_cursor = 0
+
+    def uniform(self) -> float:
+        """A uniform random number in [0, 1)."""
+        if self._uniform_cursor >= len(self._uniforms):
+            self._uniforms = self.rng.random(self.block_size)
+            self._uniform_cursor = 0
+        value = self._uniforms[self._uniform_cursor]
+        self._uniform_cursor += 1
+        return float(value)
+
+    def uniforms(self, count: int) -> np.ndarray:
+        """An array of count uniform random numbers in [0, 1)."""
+        if self._uniform_cursor + count > len(self._uniforms):
+            self._uniforms = np.concatenate((self._uniforms[self._uniform_cursor:], self.rng.random(max(self.block_size, count))))
+            self._uniform_cursor = 0
+        values = self._uniforms[self._uniform_cursor:self._uniform_cursor + count]
+        self._uniform_cursor += count
+        return values
+
+    def normal(self, mu: float = 0.0, sigma: float = 1.0) -> float:
+        """A normal random number with mean mu and standard deviation sigma."""
+        if self._normal_cursor >= len(self._normals):
+            self._normals = self.rng.standard_normal(self.block_size)
+            self._normal_cursor = 0
+        value = self._normals[self._normal_cursor]
+        self._normal_cursor += 1
+        return mu + sigma * float(value)
+
+    def integer(self, count: int) -> int:
+        """A uniform random integer in [0, count)."""
+        return min(int(self.uniform() * count), count - 1)
+
+    def choice(self, probabilities: Sequence[float]) -> int:
+        """The index of an outcome, picked with the given probabilities (which are normalized)."""
+        # a linear scan beats np.cumsum for the handful of outcomes a move has
+        remaining = self.uniform() * sum(probabilities)
+        for index, probability in enumerate(probabilities):
+            remaining -= probability
+            if remaining < 0:
+                return index
+        return len(probabilities) - 1
@@ -0,0 +1,96 @@
+"""
+This module contains a Fenwick tree (binary indexed tree) used to pick cells with probability
+proportional to a weight, with O(log n) sampling and weight updates.
+"""
+
+from typing import Iterable
+
+import numpy as np
+
+
+class FenwickSampler:
+    """Samples indices in proportion to non-negative weights that can be updated, appended and removed."""
+
+    def __init__(self, weights: Iterable[float] = ()):
+        weights = np.asarray(list(weights), dtype=float)
+        self._size = len(weights)
+        self._build(weights, max(1, self._size))
+
+    def _build(self, weights: np.ndarray, capacity: int):
+        """Build the tree in O(n): node i holds the sum of the weights in (i - lowbit(i), i] (1-based)."""
+        self._weights = np.zeros(capacity)
+        self._weights[:len(weights)] = weights
+        prefix = np.concatenate(([0.0], np.cumsum(self._weights)))
+        positions = np.arange(1, capacity + 1)
+        self._tree = prefix[positions] - prefix[positions - (positions & -positions)]
+        self._top_bit = 1 << (capacity.bit_length() - 1)
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def total(self) -> float:
+        return self._prefix_sum(self._size)
+
+    @property
+    def weights(self) -> np.ndarray:
+        return self._weights[:self._size]
+
+    def _prefix_sum(self, count: int) -> float:
+        """Sum of the first count weights."""
+        total = 0.0
+        while count > 0:
+            total += self._tree[count - 1]
+            count &= count - 1
+        return total
+
+    def _add(self, index: int, delta: float):
+        position = index + 1
+        while position <= len(self._tree):
+            self._tree[position - 1] += delta
+            position += position & -position
+
+    def update(self, index: int, weight: float):
+        """Set the weight at the given index."""
+        if not 0 <= index < self._size:
+            raise IndexError(f'index {index} out of range for {self._size} weights')
+        self._add(index, weight - self._weights[index])
+        self._weights[index] = weight
+
+    def append(self, weight: float):
+        """Add a weight at the end, growing the tree if it is full."""
+        if self._size == len(self._weights):
+            self._build(self._weights[:self._size], 2 * len(self._weights))
+        self._size += 1
+        self.update(self._size - 1, weight)
+
+    def swap_remove(self, index: int):
+        """Remove the weight at the given index by moving the last weight into its place."""
+        last = self._size - 1
+        if index != last:
+            self.update(index, self._weights[last])
+        self.update(last, 0.0)
+        self._size -= 1
+
+    def pop(self):
+        """Remove the last weight."""
+        self.swap_remove(self._size - 1)
+
+    def find(self, value: float) -> int:
+        """Returns the smallest index whose prefix sum of weights (inclusive) exceeds value."""
+        position = 0
+        step = self._top_bit
+        while step:
+            next_position = position + step
+            if next_position <= len(self._tree) and self._tree[next_position - 1] <= value:
+                position = next_position
+                value -= self._tree[next_position - 1]
+            step >>= 1
+        # rounding can push the search past the last weight
+        return min(position, self._size - 1)
+
+    def sample(self, uniform: float) -> int:
+        """Returns an index picked in proportion to the weights, using a uniform random number in [0, 1)."""
+        if self._size == 0:
+            raise IndexError('cannot sample from an empty sampler')
+        return self.find(uniform * self.total)
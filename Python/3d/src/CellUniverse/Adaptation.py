@@ -0,0 +1,97 @@
+"""
+This module contains the step size adapter that scales the sigma of every perturb parameter
+toward a target acceptance rate.
+
+After every proposal, log(scale) of each parameter the proposal changed moves by
+learning_rate * (accepted - target_acceptance), a Robbins-Monro update whose fixed point is the
+target acceptance rate. Scales are clamped to [min_scale, max_scale] and multiply the sigma set
+in the cell config.
+"""
+
+from math import exp, log
+from typing import Any, Dict, List, Optional
+
+from .Cells import Cell
+from .Cells.Cell import CellConfig, PerturbParams
+from .Config import AdaptationConfig
+
+
+class StepSizeAdapter:
+    """Tracks acceptance per perturb parameter and adapts the scale of its sigma."""
+
+    def __init__(self, config: AdaptationConfig, cell_config: CellConfig):
+        """
+        :param config: The adaptation settings.
+        :param cell_config: The cell settings, whose PerturbParams fields are the adapted parameters.
+        """
+        self.config = config
+        self.sigmas = {name: value.sigma for name, value in cell_config if isinstance(value, PerturbParams)}
+        self.scales: Dict[str, float] = {name: 1.0 for name in self.sigmas}  # shared by all cells
+        self.cell_scales: Dict[str, Dict[str, float]] = {}  # per cell name, if per_cell is set
+        self.proposals = {name: 0 for name in self.sigmas}
+        self.accepted = {name: 0 for name in self.sigmas}
+        self._records = 0
+
+    def scales_for(self, cell: Cell) -> Dict[str, float]:
+        """Returns the factors to multiply the sigma of each parameter by when perturbing the cell."""
+        if self.config.per_cell:
+            return self.cell_scales.get(cell.get_cell_params().name, self.scales)
+        return self.scales
+
+    def _changed_parameters(self, old_cell: Cell, new_cell: Cell) -> List[str]:
+        old_params = old_cell.get_cell_params()
+        new_params = new_cell.get_cell_params()
+        return [name for name in self.sigmas if getattr(old_params, name) != getattr(new_params, name)]
+
+    def _update(self, scales: Dict[str, float], name: str, accepted: bool):
+        step = self.config.learning_rate * (accepted - self.config.target_acceptance)
+        scale = exp(log(scales[name]) + step)
+        scales[name] = min(max(scale, self.config.min_scale), self.config.max_scale)
+
+    def record(self, old_cell: Cell, new_cell: Cell, accepted: bool):
+        """Record whether a perturbation of old_cell into new_cell was accepted and adapt the scales."""
+        names = self._changed_parameters(old_cell, new_cell)
+        if self.config.per_cell:
+            cell_name = old_cell.get_cell_params().name
+            cell_scales = self.cell_scales.setdefault(cell_name, dict(self.scales))
+        for name in names:
+            self.proposals[name] += 1
+            self.accepted[name] += accepted
+            self._update(self.scales, name, accepted)
+            if self.config.per_cell:
+                self._update(cell_scales, name, accepted)
+
+        self._records += 1
+        if self.config.log_interval and self._records % self.config.log_interval == 0:
+            self.log()
+
+    def acceptance_rates(self) -> Dict[str, Optional[float]]:
+        """Returns the acceptance rate of the proposals that changed each parameter."""
+        return {name: self.accepted[name] / self.proposals[name] if self.proposals[name] else None
+                for name in self.sigmas}
+
+    def adapted_sigmas(self) -> Dict[str, float]:
+        """Returns the configured sigma of each parameter multiplied by its shared scale."""
+        return {name: self.sigmas[name] * self.scales[name] for name in self.sigmas}
+
+    def log(self, prefix: str = "Adapted sigmas"):
+        rates = self.acceptance_rates()
+        summary = ", ".join(
+            f"{name}: {sigma:.4g}" + (f" ({rates[name]:.1%} accepted)" if rates[name] is not None else "")
+            for name, sigma in self.adapted_sigmas().items()
+        )
+        print(f"{prefix}: {summary}")
+
+    def get_state(self) -> Dict[str, Any]:
+        """The adapted scales, e.g. to write to a checkpoint."""
+        return {'scales': dict(self.scales), 'cell_scales': {name: dict(scales) for name, scales in self.cell_scales.items()}}
+
+    def set_state(self, state: Dict[str, Any]):
+        """Restore the adapted scales saved by get_state."""
+        self.scales.update(state['scales'])
+        self.cell_scales = {name: dict(scales) for name, scales in state['cell_scales'].items()}
+
+    def reset_counts(self):
+        """Reset the acceptance counts, keeping the adapted scales, e.g. when moving on to the next frame."""
+        self.proposals = {name: 0 for name in self.sigmas}
+        self.accepted = {name: 0 for name in self.sigmas}
@@ -3,9 +3,6 @@ from typing import Optional, TypeVar
 import typed_argparse as tap
 
 from pathlib import Path
-import time
-import numpy as np
-import multiprocessing
 
 class Args(tap.TypedArgs):
     # Required arguments
@@ -18,8 +15,8 @@ class Args(tap.TypedArgs):
     debug: Optional[Path] = tap.arg('-d', help="Path to the debug directory", default=None)
     first_frame: int = tap.arg('-ff', help="First frame to analyze", default=0)
     last_frame: int = tap.arg('-lf', help="Last frame to analyze (defaults to the last frame)", default=-1)
-    workers: int = tap.arg('-w', help="Number of workers to use (defaults to the number of cores)", default=-1)
-    jobs: int = tap.arg('-j', help="Number of jobs to run in parallel (defaults to the number of workers)", default=-1)
+    workers: int = tap.arg('-w', help="Number of worker processes running the chains (defaults to the number of cores)", default=-1)
+    jobs: int = tap.arg('-j', help="Number of independent optimization chains per frame (defaults to 1)", default=-1)
     cluster: str = tap.arg('-C', help="Address of the cluster to connect to", default='')
     no_parallel: bool = tap.arg('--no_parallel', '-np', help="Disable parallelization", default=False)
     auto_temp: bool = tap.arg('--auto_temp' '-at', help="Automatically determine the starting and ending temperatures", default=False)
@@ -27,8 +24,13 @@ class Args(tap.TypedArgs):
     end_temp: Optional[float] = tap.arg('-et', help="Ending temperature", default=None)
     residual: Optional[Path] = tap.arg('-r', help="Path to save the residual directory", default=None)
     continue_from: int = tap.arg('-cf', help="Frame to start from (defaults to first)", default=-1)
+    resume: bool = tap.arg('--resume', help="Resume after the last checkpoint in the output directory", default=False)
     seed: Optional[int] = tap.arg('-s', help="Random seed", default=None)
     batches: int = tap.arg('-b', help="Number of batches to run", default=1)
+    frame_window: int = tap.arg('-fw', help="Number of frames to keep in memory", default=2)
+    io_threads: int = tap.arg('-io', help="Number of background threads writing output images", default=2)
+    cache_dir: Optional[Path] = tap.arg('--cache-dir', help="Directory to cache preprocessed images in between runs", default=None)
+    cache_size: float = tap.arg('--cache-size', help="Maximum size of the image cache in GB", default=20.0)
 
     def __post_init__(self):
         # Validate arguments
@@ -40,19 +42,3 @@ class Args(tap.TypedArgs):
             raise ValueError('Invalid interval: frame_first must be less than frame_last')
         elif self.first_frame < 0:
             raise ValueError('Invalid interval: frame_first must be greater or equal to 0')
-
-        # set seed
-        seed = int(time.time() * 1000) % (2**32)
-        if self.seed is not None:
-            seed = self.seed
-        np.random.seed(seed)
-        print(f"Seed: {seed}")
-
-        if self.workers == -1:
-            self.workers = multiprocessing.cpu_count()
-
-        if self.jobs == -1:
-            if self.cluster:
-                raise ValueError('-j/--jobs is required for non-local clusters')
-            else:
-                self.jobs = self.workers
@@ -1,15 +1,42 @@
+import multiprocessing
+import random
 import time
+from concurrent.futures import Executor, ProcessPoolExecutor
 from pathlib import Path
-from typing import List
+from typing import List, NamedTuple, Optional
+
+import numpy as np
+from PIL import Image
 
 from .CellFactory import CellFactory
+from .Checkpoint import Checkpoint
 from .Config import load_config, BaseConfig
+from .ImageCache import ImageCache
 from .Lineage import Lineage
 from .Args import Args
-from skimage import io
+from .Pipeline import BoundedStage, StageTimings
+
+# numpy dtypes of the PIL modes a TIFF slice can be read as
+TIFF_MODE_DTYPES = {'1': 'bool', 'L': 'uint8', 'P': 'uint8', 'RGB': 'uint8', 'I;16': 'uint16', 'I;16B': 'uint16',
+                    'I': 'int32', 'F': 'float32'}
+
+
+class TiffInfo(NamedTuple):
+    """The layout of a TIFF stack, read from its header."""
+    slices: int
+    height: int
+    width: int
+    dtype: str
 
 
 # Helper functions
+def probe_tiff(file: Path) -> TiffInfo:
+    """Read the number of slices, their size and dtype from the TIFF header without decoding any pixels."""
+    with Image.open(file) as img:
+        width, height = img.size
+        return TiffInfo(getattr(img, 'n_frames', 1), height, width, TIFF_MODE_DTYPES.get(img.mode, img.mode))
+
+
 def get_image_file_paths(input_pattern: str, first_frame: int, last_frame: int, config: BaseConfig):
     """Gets the list of images that are to be analyzed."""
     image_paths: List[Path] = []
@@ -20,14 +47,6 @@ def get_image_file_paths(input_pattern: str, first_frame: int, last_frame: int,
             
             if file.exists() and file.is_file():
                 image_paths.append(file)
-
-                # setup some configurations automatically if they are tif files
-                if file.suffix in ['.tif', '.tiff']:
-                    img = io.imread(file)
-                    slices = img.shape[0]
-
-                    config.simulation.z_slices = slices
-                    config.simulation.z_values = [i - slices // 2 for i in range(slices)]
             else:
                 raise ValueError(f'Input file not found "{file}"')
             i += 1
@@ -36,6 +55,19 @@ def get_image_file_paths(input_pattern: str, first_frame: int, last_frame: int,
         if last_frame != -1 and len(image_paths) != last_frame - first_frame + 1:
             raise e
 
+    # setup some configurations automatically if they are tif files
+    tiff_paths = [file for file in image_paths if file.suffix in ['.tif', '.tiff']]
+    if tiff_paths:
+        info = probe_tiff(tiff_paths[0])
+        for file in tiff_paths[1:]:
+            other = probe_tiff(file)
+            if other != info:
+                raise ValueError(f'"{file}" has {other.slices} slices of {other.height}x{other.width} {other.dtype}, '
+                                 f'but "{tiff_paths[0]}" has {info.slices} slices of {info.height}x{info.width} {info.dtype}')
+
+        config.simulation.z_slices = info.slices
+        config.simulation.z_values = [i - info.slices // 2 for i in range(info.slices)]
+
     print(image_paths)
 
     return image_paths
@@ -43,21 +75,26 @@ def get_image_file_paths(input_pattern: str, first_frame: int, last_frame: int,
 
 class CellUniverse:
     def __init__(self, args: Args):
-        # set up dask client
-        # if not args.no_parallel:
-        #     from dask.distributed import Client, LocalCluster
-        #     if not args.cluster:
-        #         cluster = LocalCluster(
-        #             n_workers=args.workers, threads_per_worker=1,
-        #         )
-        #         client = Client(cluster)
-        #     else:
-        #         cluster = args.cluster
-        #         client = Client(cluster)
-        #         client.restart()
-        # else:
-        #     client = None
+        # seed the random generators the proposal streams and chain seeds are drawn from
+        seed = args.seed if args.seed is not None else int(time.time() * 1000) % (2**32)
+        random.seed(seed)
+        np.random.seed(seed)
+        print(f"Seed: {seed}")
+
+        # set up the pool that runs independent optimization chains for each frame
+        # (typed_argparse does not call Args.__post_init__, so the defaults are resolved here)
         self.client = None
+        self.executor: Optional[Executor] = None
+        self.chains = args.jobs if args.jobs > 0 else 1
+        self.io_threads = args.io_threads
+        if not args.no_parallel and self.chains > 1:
+            if args.cluster:
+                from dask.distributed import Client
+                self.client = Client(args.cluster)
+                self.executor = self.client.get_executor()
+            else:
+                workers = args.workers if args.workers > 0 else multiprocessing.cpu_count()
+                self.executor = ProcessPoolExecutor(max_workers=min(workers, self.chains))
 
         # --------
         # Config
@@ -73,14 +110,51 @@ class CellUniverse:
         # --------
         # Lineage
         # --------
-        self.lineage = Lineage(cells, image_file_paths, config, args.output, args.continue_from)
+        self.image_cache = ImageCache(args.cache_dir, int(args.cache_size * 1e9)) if args.cache_dir is not None else None
+        self.lineage = Lineage(cells, image_file_paths, config, args.output, args.continue_from, args.frame_window, self.image_cache)
+        self.first_frame = self.lineage.resume() if args.resume else 0
 
     def run(self):
         current_time = time.time()
-        for frame in range(len(self.lineage)):
-            self.lineage.optimize(frame)
-            self.lineage.copy_cells_forward(frame + 1)
-            self.lineage.save_images(frame)
-            # self.lineage.save_cells(frame) # TODO: Figure out why this isn't working
+        # decoding upcoming frames and writing finished ones overlap with the optimization
+        timings = StageTimings()
+        loader = BoundedStage("load", 1, 1, timings)
+        writer = BoundedStage("write", self.io_threads, self.io_threads, timings)
+        try:
+            self.lineage.prefetch(self.first_frame, loader)
+            for frame in range(self.first_frame, len(self.lineage)):
+                self.lineage.prefetch(frame + 1, loader)
+                with timings.busy("optimize"):
+                    self.lineage.optimize(frame, self.executor, self.chains)
+                    self.lineage.copy_cells_forward(frame + 1)
+                with timings.busy("render"):
+                    real_images, synth_images = self.lineage.render_images(frame)
+                checkpoint = self.lineage.make_checkpoint(frame)
+                writer.submit(self.write_frame, frame, real_images, synth_images, checkpoint)
+                self.lineage.release(frame)
+            writer.join()
+            self.lineage.compact_cells()
+            self.lineage.report_iterations()
+        finally:
+            writer.shutdown()
+            loader.shutdown()
+            self.lineage.close()
+            if self.executor is not None:
+                self.executor.shutdown()
+            if self.client is not None:
+                self.client.close()
+
+        elapsed = time.time() - current_time
+        timings.report(elapsed)
+        if self.image_cache is not None:
+            self.image_cache.report()
+        print(f"Time elapsed: {elapsed:.2f} seconds")
 
-        print(f"Time elapsed: {time.time() - current_time:.2f} seconds")
+    def write_frame(self, frame: int, real_images: List[Image.Image], synth_images: List[Image.Image], checkpoint: Checkpoint):
+        """
+        Write the images and cells of a finished frame, then its checkpoint, so a checkpoint implies
+        the images and cells are on disk.
+        """
+        self.lineage.write_images(frame, real_images, synth_images)
+        self.lineage.write_cells(checkpoint.image_name, checkpoint.cell_params)
+        self.lineage.write_checkpoint(checkpoint)
@@ -5,8 +5,11 @@ This module contains the Cell class which stores the abstract base class for Cel
 from __future__ import annotations
 from pydantic import BaseModel
 from abc import ABC, abstractmethod
-from typing import Type, Tuple, DefaultDict
-import random
+from typing import Type, Tuple, DefaultDict, Dict, List, Optional
+
+import numpy as np
+
+from ..Proposals import ProposalStream
 
 class CellParams(BaseModel, ABC):
     """The CellParams class stores the parameters of a particular cell."""
@@ -22,9 +25,14 @@ class PerturbParams(BaseModel):
     mu: float
     sigma: float
 
-    def get_perturb_offset(self):
-        if random.random() < self.prob:
-            return random.gauss(self.mu, self.sigma)
+    def get_perturb_offset(self, proposals: ProposalStream, scale: float = 1.0):
+        """
+        Draw an offset, with sigma multiplied by scale (used to adapt the step size).
+
+        :param proposals: The stream to draw the random numbers from.
+        """
+        if proposals.uniform() < self.prob:
+            return proposals.normal(self.mu, self.sigma * scale)
         else:
             return self.mu
 
@@ -39,15 +47,47 @@ class Cell(ABC):
         pass
 
     @abstractmethod
-    def draw(self, image, simulation_config, cell_map = None, z = 0):
+    def draw(self, image, simulation_config, cell_map = None, z = 0, origin = (0, 0)):
         pass
 
     @abstractmethod
     def draw_outline(self, image, color, z = 0):
         pass
 
+    @staticmethod
+    def draw_stack(cells: List['Cell'], image_stack, simulation_config, z_slices, origin = (0, 0)):
+        """
+        Draws the cells into every slice of an image stack. Cell types can override this with
+        a batched implementation; it must produce the same pixels as calling draw slice by slice.
+
+        :param z_slices: The z value of each slice in image_stack, in ascending order.
+        """
+        for image, z in zip(image_stack, z_slices):
+            for cell in cells:
+                cell.draw(image, simulation_config, z = z, origin = origin)
+
+    @staticmethod
+    def count_stack(cells: List['Cell'], count_stack, simulation_config, z_slices, origin = (0, 0), weight = 1):
+        """
+        Adds weight to every voxel of count_stack that is covered by each cell. Cell types can
+        override this with a batched implementation.
+
+        :param z_slices: The z value of each slice in count_stack, in ascending order.
+        """
+        mask_config = simulation_config.copy(update={'background_color': 0.0, 'cell_color': 1.0})
+        for count_image, z in zip(count_stack, z_slices):
+            for cell in cells:
+                mask = np.zeros(count_image.shape)
+                cell.draw(mask, mask_config, z = z, origin = origin)
+                count_image += weight * (mask > 0)
+
     @abstractmethod
-    def get_perturbed_cell(self) -> Cell:
+    def get_perturbed_cell(self, proposals: ProposalStream, step_scales: Optional[Dict[str, float]] = None) -> Cell:
+        """
+        :param proposals: The stream to draw the offsets from.
+        :param step_scales: Factors to multiply the sigma of each perturb parameter by, keyed by
+                            parameter name. Missing parameters are not scaled.
+        """
         pass
 
     @abstractmethod
@@ -55,7 +95,10 @@ class Cell(ABC):
         pass
 
     @abstractmethod
-    def get_split_cells(self) -> Tuple[Cell, Cell, bool]:
+    def get_split_cells(self, proposals: ProposalStream) -> Tuple[Cell, Cell, bool]:
+        """
+        :param proposals: The stream to draw the split from.
+        """
         pass
 
     @abstractmethod
@@ -67,6 +110,11 @@ class Cell(ABC):
     def check_if_cells_valid(cells: List['Cell']):
         pass
 
+    @staticmethod
+    def check_if_cell_valid(cell: 'Cell', neighbours: List['Cell']):
+        """Check if a cell is valid next to its neighbours, assuming the neighbours are valid among themselves."""
+        return type(cell).check_if_cells_valid([cell] + neighbours)
+
 
     @abstractmethod
     def calculate_corners(self) -> tuple[list[float], list[float]]:
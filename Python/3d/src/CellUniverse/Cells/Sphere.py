@@ -1,12 +1,14 @@
 from __future__ import annotations
-from math import sqrt, cos, sin, pi
-from typing import List
+from bisect import bisect_left, bisect_right
+from math import sqrt, cos, sin, pi, ceil, floor
+from typing import Dict, List, Optional
 import numpy as np
-from skimage.draw import disk, circle_perimeter_aa
 from scipy.spatial.distance import pdist, squareform
 from typing import DefaultDict
 
 from .mathhelper import Vector
+from .stamps import DiskStampCache, paste, quantize
+from ..Proposals import ProposalStream
 
 from .Cell import Cell, CellParams, PerturbParams, CellConfig
 
@@ -32,6 +34,7 @@ class Sphere(Cell):
     """The Sphere class represents a spherical bacterium."""
     paramClass = SphereParams
     cellConfig: SphereConfig
+    stamp_cache = DiskStampCache()
 
     def __init__(self, init_props: SphereParams):
         # destructure the properties of the sphere
@@ -51,8 +54,13 @@ class Sphere(Cell):
         # self._split_alpha = split_alpha
         self.dormant = False
 
-    def draw(self, image, simulation_config, cell_map = None, z = 0):
-        """Draws the cell by adding the given value to the image."""
+    def draw(self, image, simulation_config, cell_map = None, z = 0, origin = (0, 0)):
+        """
+        Draws the cell by adding the given value to the image.
+
+        :param origin: The (row, column) of image[0, 0] in frame coordinates, used when
+                       drawing into a sub-region of a slice.
+        """
         if self.dormant:
             return
 
@@ -63,8 +71,11 @@ class Sphere(Cell):
         background_color = simulation_config.background_color
         cell_color = simulation_config.cell_color
 
-        rr, cc = disk((self._position.y, self._position.x), current_radius, shape=image.shape)
-        image[rr, cc] = cell_color
+        stamp = Sphere.get_stamp_cache(simulation_config).get_disk(self._position.y, self._position.x, current_radius)
+        if stamp is None:
+            return
+        top, left, mask = stamp
+        paste(image, top - origin[0], left - origin[1], mask, cell_color)
 
 
     def draw_outline(self, image, color, z = 0):
@@ -76,8 +87,78 @@ class Sphere(Cell):
         if current_radius <= 0:
             return
 
-        rr, cc, val = circle_perimeter_aa(round(self._position.y), round(self._position.x), round(current_radius), shape=image.shape)
-        image[rr, cc] = color
+        rr, cc = Sphere.stamp_cache.get_outline(round(current_radius))
+        rr = rr + round(self._position.y)
+        cc = cc + round(self._position.x)
+        inside = (rr >= 0) & (rr < image.shape[0]) & (cc >= 0) & (cc < image.shape[1])
+        image[rr[inside], cc[inside]] = color
+
+    @staticmethod
+    def _rasterize_stack(cells: List['Sphere'], shape, simulation_config, z_slices, origin):
+        """
+        Rasterizes each sphere over its bounding box in a (z, y, x) stack of the given shape.
+        Centers and radii are quantized exactly as the stamp cache does, so the masks match
+        drawing each slice with draw pixel for pixel.
+
+        :return: A generator of ((z, y, x) tuple of slices, boolean mask) for each sphere that touches the stack.
+        """
+        subpixel = simulation_config.stamp_subpixel
+        depth, height, width = shape
+        z_values = np.asarray(z_slices, dtype=float)
+
+        for cell in cells:
+            if cell.dormant:
+                continue
+
+            # slices where the sphere has a positive radius
+            position, radius = cell._position, cell._radius
+            first = bisect_left(z_slices, position.z - radius)
+            last = bisect_right(z_slices, position.z + radius)
+            if first >= last:
+                continue
+            slice_radii = np.sqrt(radius ** 2 - (position.z - z_values[first:last]) ** 2)
+            slice_radii = np.round(slice_radii * subpixel) / subpixel
+
+            # bounding box of the largest slice, clipped to the stack
+            row = quantize(position.y, subpixel)
+            col = quantize(position.x, subpixel)
+            extent = ceil(slice_radii.max()) + 1
+            top = max(floor(row) - extent - origin[0], 0)
+            bottom = min(floor(row) + extent + 1 - origin[0], height)
+            left = max(floor(col) - extent - origin[1], 0)
+            right = min(floor(col) + extent + 1 - origin[1], width)
+            if top >= bottom or left >= right:
+                continue
+
+            dy = np.arange(top + origin[0], bottom + origin[0], dtype=float) - row
+            dx = np.arange(left + origin[1], right + origin[1], dtype=float) - col
+            distances = dy[:, None] ** 2 + dx[None, :] ** 2
+            mask = distances[None, :, :] < (slice_radii ** 2)[:, None, None]
+            yield (slice(first, last), slice(top, bottom), slice(left, right)), mask
+
+    @staticmethod
+    def draw_stack(cells: List['Sphere'], image_stack, simulation_config, z_slices, origin = (0, 0)):
+        """
+        Draws the spheres into a whole (z, y, x) image stack, rasterizing each sphere's bounding
+        box in one batched operation.
+        """
+        cell_color = simulation_config.cell_color
+        for region, mask in Sphere._rasterize_stack(cells, image_stack.shape, simulation_config, z_slices, origin):
+            image_stack[region][mask] = cell_color
+
+    @staticmethod
+    def count_stack(cells: List['Sphere'], count_stack, simulation_config, z_slices, origin = (0, 0), weight = 1):
+        """Adds weight to every voxel of count_stack covered by each sphere."""
+        for region, mask in Sphere._rasterize_stack(cells, count_stack.shape, simulation_config, z_slices, origin):
+            count_stack[region] += weight * mask
+
+    @staticmethod
+    def get_stamp_cache(simulation_config):
+        """Returns the shared stamp cache, recreating it if the simulation config asks for a different quantization."""
+        cache = Sphere.stamp_cache
+        if cache.subpixel != simulation_config.stamp_subpixel:
+            cache = Sphere.stamp_cache = DiskStampCache(cache.maxsize, simulation_config.stamp_subpixel)
+        return cache
 
     def split(self, alpha):
         """Splits a cell into two cells with a ratio determined by alpha."""
@@ -153,13 +234,14 @@ class Sphere(Cell):
         #     width, length,
         #     rotation, "combined alpha unknown", (self._opacity + cell.opacity)/2)
 
-    def get_perturbed_cell(self):
+    def get_perturbed_cell(self, proposals: ProposalStream, step_scales: Optional[Dict[str, float]] = None):
+        scales = step_scales or {}
         return Sphere(SphereParams(
             name=self._name,
-            x=self._position.x + Sphere.cellConfig.x.get_perturb_offset(),
-            y=self._position.y + Sphere.cellConfig.y.get_perturb_offset(),
-            z=self._position.z + Sphere.cellConfig.z.get_perturb_offset(),
-            radius=self._radius + Sphere.cellConfig.radius.get_perturb_offset(),
+            x=self._position.x + Sphere.cellConfig.x.get_perturb_offset(proposals, scales.get('x', 1.0)),
+            y=self._position.y + Sphere.cellConfig.y.get_perturb_offset(proposals, scales.get('y', 1.0)),
+            z=self._position.z + Sphere.cellConfig.z.get_perturb_offset(proposals, scales.get('z', 1.0)),
+            radius=self._radius + Sphere.cellConfig.radius.get_perturb_offset(proposals, scales.get('radius', 1.0)),
         ))
 
     def get_paramaterized_cell(self, params: DefaultDict[str, float]):
@@ -172,12 +254,12 @@ class Sphere(Cell):
             radius=min(max(Sphere.cellConfig.minRadius, self._radius + params['radius']), Sphere.cellConfig.maxRadius),
         ))
 
-    def get_split_cells(self):
+    def get_split_cells(self, proposals: ProposalStream):
         """Splits the cell into two cells along a random axis, each with half the original radius."""
 
         # Create a random unit vector for the split axis
-        theta = np.random.uniform(0, 2 * pi)
-        phi = np.random.uniform(0, pi)
+        theta = proposals.uniform() * 2 * pi
+        phi = proposals.uniform() * pi
         split_axis = Vector([
             sin(phi) * cos(theta),
             sin(phi) * sin(theta),
@@ -267,6 +349,15 @@ class Sphere(Cell):
     def check_if_cells_valid(cells: List['Cell']):
         return not Sphere.check_if_cells_overlap(cells)
 
+    @staticmethod
+    def check_if_cell_valid(cell: 'Sphere', neighbours: List['Sphere']):
+        """Check if a sphere overlaps any of its neighbours, with the same tolerance as check_if_cells_overlap."""
+        if not neighbours:
+            return True
+        positions = np.array([neighbour._position for neighbour in neighbours])
+        radii = np.array([neighbour._radius * 0.95 for neighbour in neighbours])
+        distances = np.linalg.norm(positions - np.asarray(cell._position), axis=1)
+        return not np.any(distances < radii + cell._radius * 0.95)
 
     @staticmethod
     def check_if_cells_overlap(spheres: List['Sphere']):
@@ -0,0 +1,115 @@
+"""
+This module contains the per-frame checkpoints that let an interrupted run resume after the last
+finished frame.
+
+A checkpoint is an npz file holding the optimized cells of one frame as a matrix of parameter
+values, the state of np.random, and a small JSON header with the config hash, the adapted step
+sizes, the optimization result and the states of the proposal streams of the frames that have
+been loaded but not run yet. Checkpoints are written to a temporary file and renamed into place,
+so a crash while writing never leaves a truncated checkpoint behind.
+"""
+
+import hashlib
+import json
+import os
+import zipfile
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Type
+
+import numpy as np
+
+from .Cells.Cell import Cell, CellParams
+from .Config import BaseConfig
+from .Convergence import OptimizationResult
+
+CHECKPOINT_VERSION = 1
+
+
+class Checkpoint(NamedTuple):
+    """The state of a run after a frame has been optimized."""
+    frame_index: int
+    image_name: str
+    config_hash: str
+    cell_params: List[CellParams]
+    numpy_state: tuple
+    proposal_states: Dict[int, Dict[str, Any]]  # of the frames after frame_index that have been loaded
+    step_sizes: Optional[Dict[str, Any]]
+    result: Optional[OptimizationResult]
+    predicted: bool  # whether the frame was warm started by the motion model
+
+
+def config_hash(config: BaseConfig) -> str:
+    """A hash of the config, used to refuse resuming a run with different settings."""
+    return hashlib.sha256(config.json(sort_keys=True).encode()).hexdigest()
+
+
+def checkpoint_path(directory: Path, frame_index: int) -> Path:
+    return directory / f"frame_{frame_index:05d}.npz"
+
+
+def save_checkpoint(directory: Path, checkpoint: Checkpoint):
+    """Write the checkpoint atomically to the directory."""
+    directory.mkdir(parents=True, exist_ok=True)
+    cell_names = [params.name for params in checkpoint.cell_params]
+    parameter_names = [name for name, value in checkpoint.cell_params[0] if name != 'name'] if cell_names else []
+    cell_values = np.array([[getattr(params, name) for name in parameter_names] for params in checkpoint.cell_params],
+                           dtype=np.float64).reshape(len(cell_names), len(parameter_names))
+
+    header = {
+        'version': CHECKPOINT_VERSION,
+        'frame_index': checkpoint.frame_index,
+        'image_name': checkpoint.image_name,
+        'config_hash': checkpoint.config_hash,
+        'proposal_states': checkpoint.proposal_states,
+        'step_sizes': checkpoint.step_sizes,
+        'result': checkpoint.result._asdict() if checkpoint.result is not None else None,
+        'predicted': checkpoint.predicted,
+    }
+    algorithm, keys, position, has_gauss, cached_gaussian = checkpoint.numpy_state
+
+    path = checkpoint_path(directory, checkpoint.frame_index)
+    temporary_path = path.with_suffix('.tmp')
+    with open(temporary_path, 'wb') as file:
+        np.savez_compressed(
+            file,
+            header=np.array(json.dumps(header)),
+            cell_names=np.array(cell_names, dtype=str),
+            parameter_names=np.array(parameter_names, dtype=str),
+            cell_values=cell_values,
+            numpy_keys=np.asarray(keys, dtype=np.uint32),
+            numpy_state=np.array([position, has_gauss, cached_gaussian], dtype=np.float64),
+            numpy_algorithm=np.array(algorithm),
+        )
+    os.replace(temporary_path, path)
+
+
+def load_checkpoint(path: Path, cell_class: Type[Cell]) -> Checkpoint:
+    """Read a checkpoint. Raises ValueError if the file is damaged or was written by another version."""
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            header = json.loads(str(data['header']))
+            cell_names = data['cell_names'].tolist()
+            parameter_names = data['parameter_names'].tolist()
+            cell_values = data['cell_values']
+            position, has_gauss, cached_gaussian = data['numpy_state'].tolist()
+            numpy_state = (str(data['numpy_algorithm']), data['numpy_keys'], int(position), int(has_gauss), cached_gaussian)
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile) as e:
+        raise ValueError(f'Damaged checkpoint "{path}": {e}') from e
+
+    if header.get('version') != CHECKPOINT_VERSION:
+        raise ValueError(f'Checkpoint "{path}" has version {header.get("version")}, expected {CHECKPOINT_VERSION}')
+
+    cell_params = [cell_class.paramClass(name=name, **dict(zip(parameter_names, values.tolist())))
+                   for name, values in zip(cell_names, cell_values)]
+    result = OptimizationResult(**header['result']) if header['result'] is not None else None
+    # JSON object keys are strings
+    proposal_states = {int(index): state for index, state in header['proposal_states'].items()}
+    return Checkpoint(header['frame_index'], header['image_name'], header['config_hash'], cell_params, numpy_state,
+                      proposal_states, header['step_sizes'], result, header['predicted'])
+
+
+def find_checkpoints(directory: Path) -> List[Path]:
+    """The checkpoint files in the directory, ordered by frame."""
+    if not directory.is_dir():
+        return []
+    return sorted(directory.glob("frame_*.npz"))
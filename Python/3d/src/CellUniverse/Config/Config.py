@@ -5,14 +5,18 @@ from ..Cells import BacilliConfig
 from ..Cells import SphereConfig
 from .ConfigTypes import BaseConfig
 
+# Parametrize the config at module level so pydantic registers the classes here and configs can be pickled
+SphereBaseConfig = BaseConfig[SphereConfig]
+BacilliBaseConfig = BaseConfig[BacilliConfig]
+
 
 def load_config(path: Path):
     """Loads the configuration file and returns the appropriate config class and cell class."""
     with open(path, 'r') as file:
         config = yaml.safe_load(file)
     if config['cellType'] == 'sphere':
-        return BaseConfig[SphereConfig](**config)
+        return SphereBaseConfig(**config)
     elif config['cellType'] == 'bacilli':
-        return BaseConfig[BacilliConfig](**config)
+        return BacilliBaseConfig(**config)
     else:
         raise ValueError(f'Invalid cell type: "{config["cellType"]}"')
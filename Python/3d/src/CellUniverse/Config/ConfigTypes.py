@@ -1,4 +1,4 @@
-from typing import List, Union, Generic, TypeVar
+from typing import List, Optional, Union, Generic, TypeVar
 from pydantic import BaseModel, root_validator, validator
 from pydantic.generics import GenericModel
 
@@ -9,6 +9,14 @@ from ..Cells import SphereConfig
 
 class SimulationConfig(BaseModel, extra = 'forbid'):
     iterations_per_cell: int
+    algorithm = 'hill'  # One of 'hill', 'simulated annealing' or 'gradient descent'
+    proposals_per_move = 1  # Number of perturbations scored together for the chosen cell on every iteration
+    cell_selection = 'uniform'  # 'uniform' or 'residual' (pick cells in proportion to the residual over their bounding box)
+    selection_uniform_floor = 0.1  # With residual cell selection, the fraction of cells picked uniformly instead
+    gradient_method = 'analytic'  # 'analytic' (soft rasterizer with Adam) or 'finite difference', used by gradient descent
+    gradient_learning_rate = 0.1  # Adam learning rate for analytic gradient descent
+    gradient_edge_width = 1.0  # Width in pixels of the sigmoid edge of the soft spheres used for analytic gradients
+    gradient_steps = 10  # Number of Adam steps per gradient descent iteration
     background_color: float
     cell_color: float
     # light_diffraction_sigma: Union[float, str]
@@ -18,9 +26,69 @@ class SimulationConfig(BaseModel, extra = 'forbid'):
     padding = 0
     z_scaling = 1
     blur_sigma = 0
+    cost_recompute_interval = 1000  # Number of incremental cost updates between full recomputes of the cost
+    overlap_cost = 0.0  # Cost added for every voxel covered by more than one cell (per extra cell)
+    pyramid_factors: List[int] = []  # XY downsampling factor of each coarse level, coarsest first (e.g. [4, 2]). Empty to only optimize at full resolution
+    pyramid_z_factors: List[int] = []  # Keep every n-th z slice at each coarse level (defaults to keeping all slices)
+    pyramid_iterations: List[float] = []  # Fraction of the iterations run at each coarse level (defaults to 80% split evenly). The rest refine at full resolution
+    stamp_subpixel = 16  # Sphere centers and radii are quantized to 1/stamp_subpixel of a pixel when drawn
     z_slices = -1  # Number of z slices in 3d image. This is set automatically, do not specify
     z_values: List[int] = []  # List of z values to use for each image slice. This is set automatically, do not specify
 
+    @validator('algorithm')
+    def check_algorithm(cls, v):
+        if v not in ['hill', 'simulated annealing', 'gradient descent']:
+            raise ValueError('algorithm should be one of "hill", "simulated annealing" or "gradient descent"')
+        return v
+
+    @validator('cell_selection')
+    def check_cell_selection(cls, v):
+        if v not in ['uniform', 'residual']:
+            raise ValueError('cell_selection should be "uniform" or "residual"')
+        return v
+
+    @validator('selection_uniform_floor')
+    def check_selection_uniform_floor(cls, v):
+        if not 0 <= v <= 1:
+            raise ValueError('selection_uniform_floor should be between 0 and 1')
+        return v
+
+    @validator('gradient_method')
+    def check_gradient_method(cls, v):
+        if v not in ['analytic', 'finite difference']:
+            raise ValueError('gradient_method should be "analytic" or "finite difference"')
+        return v
+
+    @validator('proposals_per_move')
+    def check_proposals_per_move(cls, v):
+        if v < 1:
+            raise ValueError('proposals_per_move should be at least 1')
+        return v
+
+    @validator('pyramid_factors', 'pyramid_z_factors', each_item=True)
+    def check_pyramid_factors(cls, v):
+        if v < 1:
+            raise ValueError('pyramid factors should be at least 1')
+        return v
+
+    @validator('pyramid_z_factors', 'pyramid_iterations')
+    def check_pyramid_levels(cls, v, values, field):
+        if v and len(v) != len(values.get('pyramid_factors', [])):
+            raise ValueError(f'{field.name} should have one entry per pyramid level')
+        return v
+
+    @validator('pyramid_iterations')
+    def check_pyramid_iterations(cls, v):
+        if any(fraction < 0 for fraction in v) or sum(v) >= 1:
+            raise ValueError('pyramid_iterations should be non-negative and leave some iterations for full resolution')
+        return v
+
+    @validator('stamp_subpixel')
+    def check_stamp_subpixel(cls, v):
+        if v <= 0 or v & (v - 1):
+            raise ValueError('stamp_subpixel should be a power of two')
+        return v
+
     @validator('z_values')
     def check_z_values(cls, v, values):
         if v != []:
@@ -50,6 +118,69 @@ class ProbabilityConfig(BaseModel, extra = 'forbid'):
             print(f'New probabilities are {values}')
             print(Style.RESET_ALL, end='')
         return values
+
+class ConvergenceConfig(BaseModel, extra = 'forbid'):
+    window = 1000  # Number of iterations in the sliding window
+    tolerance = 1e-4  # Stop when the cost improves by less than this fraction of the cost over the window
+    min_acceptance = 0.0  # Stop when fewer than this fraction of the moves in the window are accepted
+    min_iterations = 0  # Never stop before this many iterations
+
+    @validator('window')
+    def check_window(cls, v):
+        if v < 1:
+            raise ValueError('window should be at least 1')
+        return v
+
+class AdaptationConfig(BaseModel, extra = 'forbid'):
+    target_acceptance = 0.234  # Acceptance rate each perturb parameter's sigma is scaled toward
+    learning_rate = 0.05  # How fast log(scale) moves after every proposal that changed the parameter
+    min_scale = 0.05  # Lower bound on the factor the configured sigma is multiplied by
+    max_scale = 20.0  # Upper bound on the factor the configured sigma is multiplied by
+    per_cell = False  # Adapt the step sizes of every cell separately, starting from the shared ones
+    log_interval = 1000  # Print the adapted sigmas every this many proposals (0 to only print them per frame)
+
+    @validator('target_acceptance')
+    def check_target_acceptance(cls, v):
+        if not 0 < v < 1:
+            raise ValueError('target_acceptance should be between 0 and 1')
+        return v
+
+    @validator('max_scale')
+    def check_scale_bounds(cls, v, values):
+        if not 0 < values.get('min_scale', v) <= v:
+            raise ValueError('min_scale and max_scale should be positive with min_scale <= max_scale')
+        return v
+
+class MotionConfig(BaseModel, extra = 'forbid'):
+    model = 'constant velocity'  # 'constant velocity' (least squares over the history) or 'kalman'
+    history = 3  # Number of past frames used to estimate the velocity of every cell
+    damping = 1.0  # Fraction of the estimated velocity applied when extrapolating
+    process_noise = 0.1  # Kalman only: variance of the change in velocity between frames
+    measurement_noise = 1.0  # Kalman only: variance of the optimized cell parameters
+    initial_velocity_variance = 10.0  # Kalman only: variance of the velocity of a newly seen cell
+
+    @validator('model')
+    def check_model(cls, v):
+        if v not in ['constant velocity', 'kalman']:
+            raise ValueError('model should be "constant velocity" or "kalman"')
+        return v
+
+    @validator('history')
+    def check_history(cls, v):
+        if v < 2:
+            raise ValueError('history should be at least 2 frames')
+        return v
+
+class OutputConfig(BaseModel, extra = 'forbid'):
+    format = 'png'  # 'png' (one file per slice), 'tiff' (a multi-page file per frame) or 'npy' (one memory-mappable array per run)
+    sort_cells = True  # Sort cells.csv by file and cell name at the end of the run, rows are in the order frames finish otherwise
+
+    @validator('format')
+    def check_format(cls, v):
+        if v not in ['png', 'tiff', 'npy']:
+            raise ValueError('format should be "png", "tiff" or "npy"')
+        return v
+
 #
 # class CameraShiftConfig(BaseModel, extra = 'forbid'):
 #     modification_x_sigma = 0.0
@@ -72,6 +203,18 @@ class BaseConfig(GenericModel, Generic[CellConfig], extra = 'forbid'):
     # Probability settings
     prob: ProbabilityConfig
 
+    # Early termination settings, frames always run for the full number of iterations if not set
+    convergence: Optional[ConvergenceConfig] = None
+
+    # Adaptive perturbation step size settings, the configured sigmas are used as is if not set
+    adaptation: Optional[AdaptationConfig] = None
+
+    # Motion model used to extrapolate the cells into the next frame, cells are copied unchanged if not set
+    motion: Optional[MotionConfig] = None
+
+    # How the real images with outlines and the synthetic images are written
+    output = OutputConfig()
+
     # Camera shift settings
     # camera = CameraShiftConfig()
 
@@ -1,2 +1,2 @@
 from .Config import load_config
-from .ConfigTypes import BaseConfig, SimulationConfig
\ No newline at end of file
+from .ConfigTypes import BaseConfig, SimulationConfig, ConvergenceConfig, AdaptationConfig, MotionConfig, OutputConfig
\ No newline at end of file
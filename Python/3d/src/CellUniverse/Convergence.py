@@ -0,0 +1,68 @@
+"""
+This module contains the convergence detector used to stop optimizing a frame once the cost has plateaued.
+"""
+
+from collections import deque
+from typing import NamedTuple, Optional
+
+from .Config import ConvergenceConfig
+
+
+class OptimizationResult(NamedTuple):
+    """Summary of the optimization of a frame."""
+    iterations: int
+    cost: float
+    stop_reason: str
+
+
+class ConvergenceMonitor:
+    """Tracks the cost improvements and acceptance rate over a sliding window of iterations."""
+
+    def __init__(self, config: Optional[ConvergenceConfig], initial_cost: float):
+        """
+        :param config: The convergence settings, or None to never stop early.
+        :param initial_cost: The cost before the first iteration.
+        """
+        self.config = config
+        self.iterations = 0
+        self._cost = initial_cost
+        window = config.window if config is not None else 0
+        self._improvements = deque(maxlen=window)
+        self._accepted = deque(maxlen=window)
+        self._improvement_sum = 0.0
+        self._accepted_count = 0
+
+    def record(self, accepted: bool, cost: float):
+        """Record the outcome of an iteration and the cost after it."""
+        self.iterations += 1
+        if self.config is None:
+            self._cost = cost
+            return
+
+        if len(self._improvements) == self._improvements.maxlen:
+            self._improvement_sum -= self._improvements[0]
+            self._accepted_count -= self._accepted[0]
+        improvement = self._cost - cost
+        self._improvements.append(improvement)
+        self._accepted.append(accepted)
+        self._improvement_sum += improvement
+        self._accepted_count += accepted
+        self._cost = cost
+
+    @property
+    def stop_reason(self) -> Optional[str]:
+        """The reason to stop optimizing the frame, or None to keep going."""
+        config = self.config
+        if config is None or self.iterations < config.min_iterations or len(self._improvements) < config.window:
+            return None
+
+        relative_improvement = self._improvement_sum / max(abs(self._cost), 1e-12)
+        if relative_improvement < config.tolerance:
+            return (f"converged: cost improved by {relative_improvement:.2e} (relative) "
+                    f"over the last {config.window} iterations")
+
+        acceptance_rate = self._accepted_count / config.window
+        if acceptance_rate < config.min_acceptance:
+            return f"converged: acceptance rate {acceptance_rate:.2%} over the last {config.window} iterations"
+
+        return None
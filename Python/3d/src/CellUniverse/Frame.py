@@ -1,31 +1,86 @@
 from pathlib import Path
-from typing import Dict, List, Any
+from typing import Dict, List, Any, NamedTuple, Optional
 import numpy.typing as npt
 import numpy as np
 import pandas as pd
 from PIL import Image
-import random
+from math import sqrt
+from scipy.special import logsumexp
 
-from copy import deepcopy
 from collections import defaultdict
 
-from .Cells import Cell
+from .Adaptation import StepSizeAdapter
+from .Cells import Cell, Sphere
 from .Config import SimulationConfig
+from .Proposals import ProposalStream
+from .Sampling import FenwickSampler
+from .SoftRasterizer import Adam, SoftSphereRasterizer
+from .SpatialIndex import NeighbourGrid, SliceIndex
+
+class RegionChange(NamedTuple):
+    """A proposed change to a region of a frame's coverage and synthetic image stacks."""
+    region: tuple
+    coverage: npt.NDArray
+    synth: npt.NDArray
+    residual_delta: float  # change in the sum of squared residuals
+    overlap_delta: int  # change in the number of voxels covered by more than one cell
+
 
 class Frame:
-    def __init__(self, real_image_stack: npt.NDArray, simulation_config: SimulationConfig, cells: List[Cell], output_path: Path, image_name: str):
+    def __init__(self, real_image_stack: npt.NDArray, simulation_config: SimulationConfig, cells: List[Cell], output_path: Path, image_name: str,
+                 proposal_stream: Optional[ProposalStream] = None):
         self.z_slices = [simulation_config.z_scaling * (i - simulation_config.z_slices // 2) for i in range(simulation_config.z_slices)]
         self.cells = cells
         self.simulation_config = simulation_config
         self.output_path = output_path
         self.image_name = image_name  # name of image file for saving cell data
-
-        self._real_image_stack = real_image_stack  # original 3d array of images
-        self.real_image_stack = np.array(self._real_image_stack)  # create a copy of the original image stack
-
+        self.slice_index = SliceIndex(self.z_slices, cells)  # cells that intersect each z-slice
+        self.neighbour_grid = NeighbourGrid(cells)  # cells near each other, for overlap checks
+        self._gradient_optimizer: Optional[Adam] = None  # optimizer state kept between analytic gradient steps
+        self.step_sizes: Optional[StepSizeAdapter] = None  # adapts the perturbation sigmas if set
+        # pre-drawn random numbers for cell picks, offsets and acceptance tests
+        self.proposal_stream = proposal_stream if proposal_stream is not None else ProposalStream()
+        self.cell_sampler: Optional[FenwickSampler] = None  # residual score of each cell, for residual cell selection
+        self._cell_indices: Dict[int, int] = {}  # index of each cell in self.cells, keyed by id
+
+        # padding copies the original 3d array of images, which may be memory-mapped, into memory
+        self.real_image_stack = real_image_stack
         self.pad_real_image()
         # self.cell_map_stack = self.generate_cell_maps()
-        self.synth_image_stack = self.generate_synth_images()
+        self.regenerate()
+
+    def __getstate__(self):
+        """Leave out everything derived from the cells when pickling, e.g. to send the frame to a worker process."""
+        state = self.__dict__.copy()
+        for derived in ['_synth_image_stack', 'coverage_stack', 'slice_index', 'neighbour_grid', 'cell_sampler', '_cell_indices', '_gradient_optimizer']:
+            state.pop(derived, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # the spatial indexes are keyed by object identity so it has to be rebuilt for the unpickled cells
+        self.set_cells(self.cells)
+
+    @property
+    def synth_image_stack(self):
+        return self._synth_image_stack
+
+    @synth_image_stack.setter
+    def synth_image_stack(self, synth_image_stack: npt.NDArray):
+        """Replace the whole synthetic image stack and recompute the running cost from scratch."""
+        self._synth_image_stack = np.asarray(synth_image_stack)
+        self.recompute_cost()
+
+    @property
+    def cost(self):
+        """The cost of the current synthetic images, tracked incrementally."""
+        return self.cost_after(None)
+
+    def recompute_cost(self):
+        """Recompute the running sum of squared residuals over the full stack to discard accumulated drift."""
+        self._residual_sum = float(np.sum(np.square(self.real_image_stack - self._synth_image_stack)))
+        self._overlap_sum = self.count_overlap(self.coverage_stack)
+        self._updates_since_recompute = 0
 
     # def update(self):
     #     """Update the frame."""
@@ -38,58 +93,186 @@ class Frame:
     #     self.simulation_config = simulation_config
     #     self.update()
 
-    def generate_synth_images(self):
-        """Generate synthetic images from the cells in the frame."""
-        if self.cells is None:
-            raise ValueError("Cells are not set")
-
-        shape = self.get_image_shape()
-        synth_image_stack = []
-
-        for i, z in enumerate(self.z_slices):
-            synth_image = np.full(shape, self.simulation_config.background_color)
-            for cell in self.cells:
-                cell.draw(synth_image, self.simulation_config, z = z)
-            synth_image_stack.append(synth_image)
-
-        return np.array(synth_image_stack)
-
-
-    def generate_synth_images_fast(self, old_cell: Cell, new_cell: Cell):
+    def generate_coverage(self):
+        """Generate a stack counting the number of cells that cover each voxel."""
+        shape = (len(self.z_slices),) + tuple(self.get_image_shape())
+        coverage_stack = np.zeros(shape, dtype=np.int16)
+        if self.cells:
+            type(self.cells[0]).count_stack(self.cells, coverage_stack, self.simulation_config, self.z_slices)
+        return coverage_stack
+
+    def synth_from_coverage(self, coverage_stack: npt.NDArray):
+        """Colour a coverage stack (or a region of one) as a synthetic image."""
+        return np.where(coverage_stack > 0, self.simulation_config.cell_color, self.simulation_config.background_color)
+
+    @staticmethod
+    def count_overlap(coverage_stack: npt.NDArray):
+        """Count the voxels covered by more than one cell, counting a voxel once for every extra cell."""
+        return int(np.maximum(coverage_stack.astype(np.int64) - 1, 0).sum())
+
+    def regenerate(self):
+        """Regenerate the coverage and synthetic images from the cells in the frame."""
+        self.coverage_stack = self.generate_coverage()
+        self.synth_image_stack = self.synth_from_coverage(self.coverage_stack)
+        self._rebuild_cell_sampler()
+
+    def _cell_score(self, cell: Cell):
+        """The sum of squared residuals over the bounding box of a cell."""
+        region = self.get_region(*cell.calculate_corners())
+        if region is None:
+            return 0.0
+        return float(np.square(self.real_image_stack[region] - self._synth_image_stack[region]).sum())
+
+    def _rebuild_cell_sampler(self):
+        """Score every cell from scratch if cells are picked by residual."""
+        if self.simulation_config.cell_selection != 'residual':
+            self.cell_sampler = None
+            self._cell_indices = {}
+            return
+        self.cell_sampler = FenwickSampler(self._cell_score(cell) for cell in self.cells)
+        self._cell_indices = {id(cell): i for i, cell in enumerate(self.cells)}
+
+    def _refresh_cell_scores(self, removed: List[Cell], added: List[Cell]):
         """
-            Generate the synthetic images after perturbing a cell.
-            This is a faster version of a similar function that
-            tries to reuse previously generated images if no changes
-            have been made to them.
+            Rescore the cells whose scored pixels overlap those of a cell that was just removed or
+            added, after the change was written into the synthetic images. No other cell saw its
+            residual change. The scores cover every pixel a box touches, so boxes less than a
+            pixel apart can share pixels and the neighbours are looked up with a one pixel margin.
         """
-        if self.cells is None:
-            raise ValueError("Cells are not set")
-
-        shape = self.get_image_shape()
-        synth_image_stack = []
-
-        # Calculate the smallest box that contains both the old and new cell
-        min_corner, max_corner = old_cell.calculate_minimum_box(new_cell)
-
-        for i, z in enumerate(self.z_slices):
-            # If the z-slice is outside the min/max box, append the existing synthetic image to the stack
-            if (z < min_corner[2] or z > max_corner[2]):
-                synth_image_stack.append(self.synth_image_stack[i])
-                continue
-
-            synth_image = np.full(shape, self.simulation_config.background_color)
-            for cell in self.cells:
-                cell.draw(synth_image, self.simulation_config, z = z)
-            synth_image_stack.append(synth_image)
-
-        # Return the stack of synthetic images
-        return synth_image_stack
-
-
-
-    def calculate_cost(self, synth_image_stack: npt.NDArray):
-        """Calculate the L2 cost of the synthetic images."""
-        return float(np.linalg.norm(self.real_image_stack - synth_image_stack))
+        if self.cell_sampler is None:
+            return
+        affected = {id(cell): cell for cell in added}
+        for cell in removed + added:
+            affected.update((id(neighbour), neighbour) for neighbour in self.neighbour_grid.query(cell, margin=1.0))
+        for key, cell in affected.items():
+            index = self._cell_indices.get(key)
+            if index is not None:
+                self.cell_sampler.update(index, self._cell_score(cell))
+
+    def choose_cell_index(self):
+        """
+            Pick the index of a cell to modify: uniformly at random, or with residual cell selection
+            in proportion to the residual score of each cell, mixed with a uniform floor.
+        """
+        sampler = self.cell_sampler
+        uniform_floor = self.simulation_config.selection_uniform_floor
+        if sampler is None:
+            return self.proposal_stream.integer(len(self.cells))
+        if sampler.total <= 0 or self.proposal_stream.uniform() < uniform_floor:
+            return self.proposal_stream.integer(len(self.cells))
+        return sampler.sample(self.proposal_stream.uniform())
+
+    def get_region(self, min_corner: List[float], max_corner: List[float]):
+        """
+            Convert a bounding box in cell coordinates into a (z, y, x) tuple of slices
+            into the image stack, clipped to the stack. Returns None if the box does not
+            touch the stack.
+        """
+        z_indices = self.slice_index.slice_range(min_corner[2], max_corner[2])
+        if not z_indices:
+            return None
+
+        height, width = self.get_image_shape()
+        top = max(int(np.floor(min_corner[1])), 0)
+        bottom = min(int(np.floor(max_corner[1])) + 1, height)
+        left = max(int(np.floor(min_corner[0])), 0)
+        right = min(int(np.floor(max_corner[0])) + 1, width)
+        if top >= bottom or left >= right:
+            return None
+
+        return slice(z_indices[0], z_indices[-1] + 1), slice(top, bottom), slice(left, right)
+
+    def calculate_region_delta(self, region, patch: npt.NDArray):
+        """Calculate the change in the sum of squared residuals if the region were replaced by the patch."""
+        real = self.real_image_stack[region]
+        new_residual = np.square(real - patch).sum()
+        old_residual = np.square(real - self._synth_image_stack[region]).sum()
+        return float(new_residual - old_residual)
+
+    def propose_change(self, removed: List[Cell], added: List[Cell]) -> Optional[RegionChange]:
+        """
+            Compute how the coverage, synthetic images and cost change when some cells are removed
+            from the frame and others are added, without touching the frame itself. Only the box
+            around the cells is updated and no other cell is redrawn. Returns None if the box is
+            outside the stack.
+        """
+        corners = [cell.calculate_corners() for cell in removed + added]
+        min_corner = [min(corner[0][i] for corner in corners) for i in range(3)]
+        max_corner = [max(corner[1][i] for corner in corners) for i in range(3)]
+        region = self.get_region(min_corner, max_corner)
+        if region is None:
+            return None
+
+        z_range, rows, cols = region
+        coverage = np.array(self.coverage_stack[region])
+        cell_class = type((removed + added)[0])
+        z_slices = self.z_slices[z_range]
+        origin = (rows.start, cols.start)
+        cell_class.count_stack(removed, coverage, self.simulation_config, z_slices, origin, weight=-1)
+        cell_class.count_stack(added, coverage, self.simulation_config, z_slices, origin)
+
+        synth = self.synth_from_coverage(coverage)
+        residual_delta = self.calculate_region_delta(region, synth)
+        overlap_delta = self.count_overlap(coverage) - self.count_overlap(self.coverage_stack[region])
+        return RegionChange(region, coverage, synth, residual_delta, overlap_delta)
+
+    def propose_replacements(self, old_cell: Cell, candidates: List[Cell]) -> List[Optional[RegionChange]]:
+        """
+            Score several candidate replacements for one cell in a single vectorized pass over
+            the box that contains the old cell and every candidate. The old cell is removed from
+            the coverage once and shared by all candidates. Returns one change per candidate, all
+            None if the box is outside the stack.
+        """
+        corners = [cell.calculate_corners() for cell in [old_cell] + candidates]
+        min_corner = [min(corner[0][i] for corner in corners) for i in range(3)]
+        max_corner = [max(corner[1][i] for corner in corners) for i in range(3)]
+        region = self.get_region(min_corner, max_corner)
+        if region is None:
+            return [None] * len(candidates)
+
+        z_range, rows, cols = region
+        cell_class = type(old_cell)
+        z_slices = self.z_slices[z_range]
+        origin = (rows.start, cols.start)
+        old_coverage = self.coverage_stack[region]
+        base_coverage = np.array(old_coverage)
+        cell_class.count_stack([old_cell], base_coverage, self.simulation_config, z_slices, origin, weight=-1)
+
+        coverages = np.repeat(base_coverage[None], len(candidates), axis=0)
+        for coverage, candidate in zip(coverages, candidates):
+            cell_class.count_stack([candidate], coverage, self.simulation_config, z_slices, origin)
+
+        synths = self.synth_from_coverage(coverages)
+        real = self.real_image_stack[region]
+        old_residual = np.square(real - self._synth_image_stack[region]).sum()
+        residual_deltas = np.square(real[None] - synths).sum(axis=(1, 2, 3)) - old_residual
+        old_overlap = self.count_overlap(old_coverage)
+        overlap_deltas = np.maximum(coverages.astype(np.int64) - 1, 0).sum(axis=(1, 2, 3)) - old_overlap
+
+        return [RegionChange(region, coverages[k], synths[k], float(residual_deltas[k]), int(overlap_deltas[k]))
+                for k in range(len(candidates))]
+
+    def cost_after(self, change: Optional[RegionChange]):
+        """The cost after applying a change, or the current cost if change is None."""
+        residual_sum, overlap_sum = self._residual_sum, self._overlap_sum
+        if change is not None:
+            residual_sum += change.residual_delta
+            overlap_sum += change.overlap_delta
+        return sqrt(max(residual_sum, 0.0)) + self.simulation_config.overlap_cost * overlap_sum
+
+    def apply_change(self, change: Optional[RegionChange]):
+        """Write a change into the coverage and synthetic images and update the running cost."""
+        if change is None:
+            return
+        self.coverage_stack[change.region] = change.coverage
+        self._synth_image_stack[change.region] = change.synth
+        self._residual_sum += change.residual_delta
+        self._overlap_sum += change.overlap_delta
+
+        # periodically recompute the cost over the full stack so rounding errors can't accumulate
+        self._updates_since_recompute += 1
+        if self._updates_since_recompute >= self.simulation_config.cost_recompute_interval:
+            self.recompute_cost()
 
     # def generate_cell_maps(self):
     #     """Generate cell maps from the cells in the frame. This should only be for binary images"""
@@ -108,9 +291,9 @@ class Frame:
     def generate_output_images(self):
         """Generate the output images for the frame."""
         real_images_with_outlines: List[Image.Image] = []
-        for real_image, z in zip(self.real_image_stack, self.z_slices):
+        for i, (real_image, z) in enumerate(zip(self.real_image_stack, self.z_slices)):
             output_frame = np.stack((real_image,) * 3, axis=-1)
-            for cell in self.cells:
+            for cell in self.slice_index.cells_at(i):
                 cell.draw_outline(output_frame, (1, 0, 0), z)
             output_frame = Image.fromarray(np.uint8(255 * output_frame))
             real_images_with_outlines.append(output_frame)
@@ -120,6 +303,53 @@ class Frame:
         """Generate the output synthetic images for the frame."""
         return [Image.fromarray(np.uint8(255 * synth_image), "L") for synth_image in self.synth_image_stack]
 
+    def set_cells(self, cells: List[Cell]):
+        """Replace the cells in the frame and regenerate the synthetic images."""
+        self.cells = cells
+        self.slice_index = SliceIndex(self.z_slices, cells)
+        self.neighbour_grid = NeighbourGrid(cells)
+        self._gradient_optimizer = None
+        self.regenerate()
+
+    def _replace_cell(self, index: int, cell: Cell):
+        """
+            Replace the cell at the given index, keeping the spatial indexes up to date. The cell
+            keeps the residual score of the cell it replaces until the change is accepted.
+        """
+        old_cell = self.cells[index]
+        self.slice_index.replace(old_cell, cell)
+        self.neighbour_grid.replace(old_cell, cell)
+        self.cells[index] = cell
+        if self.cell_sampler is not None:
+            del self._cell_indices[id(old_cell)]
+            self._cell_indices[id(cell)] = index
+
+    def _add_cell(self, cell: Cell):
+        """Append a cell to the frame, keeping the spatial indexes up to date."""
+        self.cells.append(cell)
+        self.slice_index.add(cell)
+        self.neighbour_grid.add(cell)
+        if self.cell_sampler is not None:
+            self._cell_indices[id(cell)] = len(self.cells) - 1
+            self.cell_sampler.append(self._cell_score(cell))
+
+    def _remove_cell(self, index: int):
+        """
+            Remove the cell at the given index, keeping the spatial indexes up to date. The last cell
+            is moved into its place so the other indices of the residual sampler stay valid.
+        """
+        index %= len(self.cells)
+        cell = self.cells[index]
+        self.cells[index] = self.cells[-1]
+        self.cells.pop()
+        self.slice_index.remove(cell)
+        self.neighbour_grid.remove(cell)
+        if self.cell_sampler is not None:
+            del self._cell_indices[id(cell)]
+            if index < len(self.cells):
+                self._cell_indices[id(self.cells[index])] = index
+            self.cell_sampler.swap_remove(index)
+
     def get_cells_as_params(self):
         """Convert the cells in the frame to a pandas dataframe."""
         cell_params = pd.DataFrame([dict(cell.get_cell_params()) for cell in self.cells])
@@ -130,80 +360,175 @@ class Frame:
     def __len__(self):
         return len(self.cells)
 
-    def perturb(self):
-        # randomly pick an index for a cell
-        index = random.randint(0, len(self.cells) - 1)
+    def perturb(self, proposals: int = 1, temperature: Optional[float] = None):
+        """
+            Propose a perturbation of a random cell. Returns the cost difference and a callback
+            that applies the perturbation when called with True.
+
+            :param proposals: The number of proposals to draw for the chosen cell. With more than one,
+                              the proposals are scored together and one is picked using the
+                              multiple-try Metropolis rule, or greedily if temperature is None.
+            :param temperature: The annealing temperature used by multiple-try Metropolis.
+        """
+        # pick an index for a cell
+        index = self.choose_cell_index()
+
+        if proposals > 1:
+            return self._perturb_multiple(index, proposals, temperature)
 
         # store old cell
         old_cell = self.cells[index]
+        new_cell = old_cell.get_perturbed_cell(self.proposal_stream, self._step_scales(old_cell))
 
-        # replace the cell at that index with a new cell
-        self.cells[index] = self.cells[index].get_perturbed_cell()
-
-        are_cells_valid = old_cell.check_if_cells_valid(self.cells) # using an instance to call a static method
-        if not are_cells_valid:
-            self.cells[index] = old_cell
+        if not self._is_valid_change([old_cell], [new_cell]):
+            self._record_step(old_cell, new_cell, False)
             return 0, lambda accept: None
 
-        # synthesize new synthetic image
-        # new_synth_image_stack = self.generate_synth_images()
-        new_synth_image_stack = self.generate_synth_images_fast(old_cell, self.cells[index])
+        # replace the cell at that index with a new cell
+        self._replace_cell(index, new_cell)
 
-        # get the cost of the new synthetic image
-        new_cost = self.calculate_cost(new_synth_image_stack)
+        # update the region covered by the old and new cell
+        change = self.propose_change([old_cell], [self.cells[index]])
 
-        # if the difference is greater than the threshold, revert to the old cell
-        old_cost = self.calculate_cost(self.synth_image_stack)
+        # get the cost of the new synthetic image from the change in the residual of the region
+        new_cost = self.cost_after(change)
+        old_cost = self.cost
 
         def callback(accept: bool):
+            self._record_step(old_cell, new_cell, accept)
             if accept:
-                self.synth_image_stack = new_synth_image_stack
+                self.apply_change(change)
+                self._refresh_cell_scores([old_cell], [new_cell])
             else:
-                self.cells[index] = old_cell
+                self._replace_cell(index, old_cell)
 
         return new_cost - old_cost, callback
 
+    def _step_scales(self, cell: Cell):
+        """Returns the adapted sigma scales to perturb the cell with, or None to use the configured sigmas."""
+        return self.step_sizes.scales_for(cell) if self.step_sizes is not None else None
+
+    def _record_step(self, old_cell: Cell, new_cell: Cell, accepted: bool):
+        """Let the step size adapter know whether a perturbation was accepted."""
+        if self.step_sizes is not None:
+            self.step_sizes.record(old_cell, new_cell, accepted)
+
+    def _is_valid_change(self, removed: List[Cell], added: List[Cell]):
+        """
+            Check if the cells would still be valid after removing and adding some cells. Only the
+            added cells are checked, against their neighbours and each other, since the cells already
+            in the frame were valid among themselves.
+        """
+        removed_ids = {id(cell) for cell in removed}
+        for i, cell in enumerate(added):
+            neighbours = [neighbour for neighbour in self.neighbour_grid.query(cell) if id(neighbour) not in removed_ids]
+            if not cell.check_if_cell_valid(cell, neighbours + added[:i]):
+                return False
+        return True
+
+    @staticmethod
+    def _without_overlaps(old_cells: List[Cell], new_cells: List[Cell]) -> List[Cell]:
+        """
+            Put back the old version of every moved cell that overlaps another cell, until the cells
+            are valid. The old cells are valid, so every overlap involves a moved cell and this ends.
+        """
+        cells = list(new_cells)
+        while not cells[0].check_if_cells_valid(cells):
+            overlapping = [i for i, cell in enumerate(cells)
+                           if cell is not old_cells[i] and not cell.check_if_cell_valid(cell, cells[:i] + cells[i + 1:])]
+            for i in overlapping:
+                cells[i] = old_cells[i]
+        return cells
+
+    def _is_valid_replacement(self, index: int, cell: Cell):
+        """Check if the cells would still be valid with the cell at index replaced."""
+        return self._is_valid_change([self.cells[index]], [cell])
+
+    def _score_replacements(self, index: int, candidates: List[Cell]):
+        """Get the changes and costs of replacing the cell at index by each candidate. Invalid candidates cost infinity."""
+        valid = [self._is_valid_replacement(index, candidate) for candidate in candidates]
+        changes: List[Optional[RegionChange]] = [None] * len(candidates)
+        costs = np.full(len(candidates), np.inf)
+        if any(valid):
+            valid_candidates = [candidate for candidate, is_valid in zip(candidates, valid) if is_valid]
+            valid_changes = iter(self.propose_replacements(self.cells[index], valid_candidates))
+            for k, is_valid in enumerate(valid):
+                if is_valid:
+                    changes[k] = next(valid_changes)
+                    costs[k] = self.cost_after(changes[k])
+        return changes, costs
+
+    def _perturb_multiple(self, index: int, proposals: int, temperature: Optional[float]):
+        """
+            Draw several perturbations of one cell, score them together and pick one of them.
+
+            Without a temperature the best proposal is returned (hill climbing). Otherwise a
+            proposal y is picked with probability proportional to exp(-cost(y) / temperature), and
+            a reference set is drawn by perturbing y (plus the current cell x). The returned cost
+            difference is -temperature * log(sum w(y) / sum w(x_ref)), so that the usual
+            exp(-cost_diff / temperature) test accepts with the multiple-try Metropolis probability.
+        """
+        old_cell = self.cells[index]
+        old_cost = self.cost
+        scales = self._step_scales(old_cell)
+        candidates = [old_cell.get_perturbed_cell(self.proposal_stream, scales) for _ in range(proposals)]
+        changes, costs = self._score_replacements(index, candidates)
+        if not np.isfinite(costs).any():
+            self._record_step(old_cell, candidates[0], False)
+            return 0, lambda accept: None
+
+        if temperature is None:
+            chosen = int(np.argmin(costs))
+            cost_diff = costs[chosen] - old_cost
+        else:
+            weights = np.exp(-(costs - costs.min()) / temperature)
+            chosen = self.proposal_stream.choice(weights)
+
+            # reference set drawn around the chosen proposal, plus the current cell
+            references = [candidates[chosen].get_perturbed_cell(self.proposal_stream, scales) for _ in range(proposals - 1)]
+            _, reference_costs = self._score_replacements(index, references)
+            reference_costs = np.append(reference_costs, old_cost)
+
+            # in log space, since the weights of either set can all underflow at low temperatures
+            cost_diff = temperature * (logsumexp(-reference_costs / temperature) - logsumexp(-costs / temperature))
+
+        def callback(accept: bool):
+            self._record_step(old_cell, candidates[chosen], accept)
+            if accept:
+                self._replace_cell(index, candidates[chosen])
+                self.apply_change(changes[chosen])
+                self._refresh_cell_scores([old_cell], [candidates[chosen]])
+
+        return float(cost_diff), callback
+
     def split(self):
-        # randomly pick an index for a cell
-        index = random.randint(0, len(self.cells) - 1)
+        # pick an index for a cell
+        index = self.choose_cell_index()
 
         # store old cell
         old_cell = self.cells[index]
 
         # replace the cell at that index with a new cell
-        child1, child2, valid = old_cell.get_split_cells()
-        if not valid:
+        child1, child2, valid = old_cell.get_split_cells(self.proposal_stream)
+        if not valid or not self._is_valid_change([old_cell], [child1, child2]):
             return 0, lambda accept: None
 
-        self.cells.pop(index)
-        self.cells.append(child1)
-        self.cells.append(child2)
-
-        are_cells_valid = old_cell.check_if_cells_valid(self.cells) # using an instance to call a static method
-        if not are_cells_valid:
-            # remove last 2 cells
-            self.cells = self.cells[:-2]
-            # add back old cell
-            self.cells.append(old_cell)
-            return 0, lambda accept: None
-
-        # synthesize new synthetic image
-        new_synth_image_stack = self.generate_synth_images()
-
-        # get the cost of the new synthetic image
-        new_cost = self.calculate_cost(new_synth_image_stack)
+        # update the box covered by the parent and both children
+        change = self.propose_change([old_cell], [child1, child2])
 
-        # if the difference is greater than the threshold, revert to the old cell
-        old_cost = self.calculate_cost(self.synth_image_stack)
+        # get the cost of the new synthetic image from the change in the residual of the box
+        new_cost = self.cost_after(change)
+        old_cost = self.cost
 
         def callback(accept: bool):
+            # the cells only change once the split is accepted, so a rejected split keeps their order
             if accept:
-                self.synth_image_stack = new_synth_image_stack
-            else:
-                # remove last 2 cells
-                self.cells = self.cells[:-2]
-                # add back old cell
-                self.cells.append(old_cell)
+                # the last cell moves into the parent's place and the children are appended
+                self._remove_cell(index)
+                self._add_cell(child1)
+                self._add_cell(child2)
+                self.apply_change(change)
+                self._refresh_cell_scores([old_cell], [child1, child2])
 
         return new_cost - old_cost, callback
 
@@ -213,41 +538,32 @@ class Frame:
         perterb_params = defaultdict(float)
         perterb_params[perterb_param] = perterb_val
         # perterb cell
-        self.cells[index] = self.cells[index].get_paramaterized_cell(perterb_params)
-
-        # generate new image stack
-        new_synth_image_stack = self.generate_synth_images()
-        # get new cost
-        new_cost = self.calculate_cost(new_synth_image_stack)
+        perterbed_cell = old_cell.get_paramaterized_cell(perterb_params)
 
-        # reset cell
-        self.cells[index] = old_cell
+        # get new cost from the change inside the box around the cell, the frame itself is not modified
+        return self.cost_after(self.propose_change([self.cells[index]], [perterbed_cell]))
 
-        return new_cost
-
-    def _get_synth_perterbed_cells(
+    def _get_perterbed_costs(
         self,
         index: int,
         params: Dict[str, Any],
         perterb_length: float,
         old_cell: Cell
-    ) -> Dict[str, Any]:
+    ) -> Dict[str, float]:
         """
-            Generates a dict in the format of {param: synth_image} where synth image is the synth image stack after
-            some cell param was perterbed by some perterb_length
+            Generates a dict in the format of {param: cost} where cost is the cost of the frame after
+            some cell param was perterbed by some perterb_length. All the perterbations are scored
+            together over the box around the cell.
         """
-        perterbed_cells = {}
-
-        for param, val in params.items():
-            if param == 'name':
-                continue
+        param_names = [param for param in params if param != 'name']
+        perterbed_cells = []
+        for param in param_names:
             perterb_params = defaultdict(float)
             perterb_params[param] = perterb_length
-            self.cells[index] = self.cells[index].get_paramaterized_cell(perterb_params)
-            perterbed_cells[param] = self.generate_synth_images()
-            self.cells[index] = old_cell
+            perterbed_cells.append(old_cell.get_paramaterized_cell(perterb_params))
 
-        return perterbed_cells
+        changes = self.propose_replacements(self.cells[index], perterbed_cells)
+        return {param: self.cost_after(change) for param, change in zip(param_names, changes)}
 
 
     # add a line search to figure out how much to move in the gradient direction
@@ -263,7 +579,7 @@ class Frame:
         alpha = 0.2
 
         cell_list = self.cells
-        orig_cost = self.calculate_cost(self.synth_image_stack)
+        orig_cost = self.cost
 
         cells_grad = []
         param_names = None
@@ -272,7 +588,7 @@ class Frame:
 
         # get gradient for each cell
         for index, cell in enumerate(cell_list):
-            old_cell = deepcopy(cell)
+            old_cell = cell
 
             params = cell.get_cell_params().__dict__
 
@@ -281,10 +597,8 @@ class Frame:
                 param_names = list(params.keys())
                 param_names.remove("name")
 
-            perterbed_cells = self._get_synth_perterbed_cells(index, params, moving_delta, old_cell)
-
-            perterbed_cells_val = np.array(list(perterbed_cells.values()))
-            costs = list(map(self.calculate_cost, perterbed_cells_val))
+            perterbed_costs = self._get_perterbed_costs(index, params, moving_delta, old_cell)
+            costs = [perterbed_costs[param] for param in param_names]
 
             # memory vs speed (if user needs more memory calculate grad here, otherwise vectorize and calculate
             # grad after)
@@ -303,7 +617,7 @@ class Frame:
         for index, cell in enumerate(cell_list):
 
             param_gradients = dict(zip(param_names, cells_grad[index]))
-            old_cell = deepcopy(cell)
+            old_cell = cell
 
             for param, gradient in param_gradients.items():
                 tolerance = 1e-2
@@ -344,10 +658,61 @@ class Frame:
 
 
         for index, cell in enumerate(cell_list):
-            self.cells[index] = self.cells[index].get_paramaterized_cell(directions[index])
+            self._replace_cell(index, self.cells[index].get_paramaterized_cell(directions[index]))
 
-        self.synth_image_stack = self.generate_synth_images()
-        new_cost = self.calculate_cost(self.synth_image_stack)
+        self.regenerate()
+        new_cost = self.cost
 
         print(f"current cost: {new_cost}")
         return new_cost
+
+    def analytic_gradient_descent(self):
+        """
+            Fit the spheres with exact gradients of a soft (sigmoid-edged) rendering of the cost,
+            taking gradient_steps Adam steps over the x, y, z and radius of every cell at once.
+            The parameters with the lowest soft cost seen are kept. Cells moved into an overlap are
+            put back, and the cells are left as they were if the step raises the cost of the hard
+            synthetic images. Returns the hard cost afterwards.
+        """
+        if not self.cells:
+            return self.cost
+        if not all(isinstance(cell, Sphere) for cell in self.cells):
+            raise ValueError("Analytic gradients are only implemented for spheres")
+
+        param_names = ['x', 'y', 'z', 'radius']
+        params = np.array([[getattr(cell.get_cell_params(), name) for name in param_names] for cell in self.cells], dtype=float)
+        initial_params = np.array(params)
+
+        config = self.simulation_config
+        rasterizer = SoftSphereRasterizer(self.z_slices, self.real_image_stack.shape, config.background_color,
+                                          config.cell_color, config.gradient_edge_width)
+        if self._gradient_optimizer is None or self._gradient_optimizer.shape != params.shape:
+            self._gradient_optimizer = Adam(params.shape, config.gradient_learning_rate)
+
+        # Adam can overshoot, so the soft cost is also evaluated after the last step
+        best_soft_cost, best_params = np.inf, initial_params
+        for step in range(config.gradient_steps + 1):
+            soft_cost, gradient = rasterizer.cost_and_gradient(params, self.real_image_stack)
+            if soft_cost < best_soft_cost:
+                best_soft_cost, best_params = soft_cost, np.array(params)
+            if step < config.gradient_steps:
+                params += self._gradient_optimizer.step(gradient)
+                params[:, 3] = np.clip(params[:, 3], Sphere.cellConfig.minRadius, Sphere.cellConfig.maxRadius)
+
+        print(f"soft cost: {best_soft_cost}")
+        old_cells, old_cost = list(self.cells), self.cost
+        new_cells = [cell.get_paramaterized_cell(defaultdict(float, zip(param_names, delta)))
+                     for cell, delta in zip(old_cells, best_params - initial_params)]
+        for index, cell in enumerate(self._without_overlaps(old_cells, new_cells)):
+            self._replace_cell(index, cell)
+        self.regenerate()
+
+        # the soft cost only approximates the hard one, so a step that lowers it can still raise the hard cost
+        if self.cost > old_cost:
+            for index, cell in enumerate(old_cells):
+                self._replace_cell(index, cell)
+            self.regenerate()
+            self._gradient_optimizer = None
+
+        print(f"current cost: {self.cost}")
+        return self.cost
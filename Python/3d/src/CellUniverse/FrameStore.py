@@ -0,0 +1,138 @@
+"""
+This module contains the frame store that gives the lineage lazy access to its frames.
+
+A frame is only decoded when it is first accessed. Its preprocessed image stack is written to a
+.npy file, in the shared image cache if there is one, and memory-mapped, and only the last few
+frames used are kept in memory. A frame that falls out of this window, or is released
+explicitly, keeps just its cells, step sizes and random stream. If it is accessed again, it is
+rebuilt from the reopened stack and those cells, so the memory used grows with the window
+rather than the length of the video. Stacks can also be loaded ahead of time on a loader stage.
+"""
+
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import numpy.typing as npt
+
+from .Adaptation import StepSizeAdapter
+from .Cells import Cell
+from .Config import BaseConfig
+from .Frame import Frame
+from .ImageCache import ImageCache
+from .Pipeline import BoundedStage
+from .Proposals import ProposalStream
+
+
+class FrameState(NamedTuple):
+    """What is kept of a frame that is not in memory."""
+    cells: List[Cell]
+    step_sizes: Optional[StepSizeAdapter]
+    proposal_stream: Optional[ProposalStream]  # None until the frame is first built
+
+
+class FrameStore:
+    """Builds frames on first access and keeps an LRU window of them in memory."""
+
+    def __init__(self, image_paths: List[Path], config: BaseConfig, output_path: Path, initial_states: List[FrameState],
+                 load_image: Callable[[Path, BaseConfig], List[npt.NDArray]], window: int = 2,
+                 image_cache: Optional[ImageCache] = None):
+        """
+        :param image_paths: The image file of each frame.
+        :param initial_states: The cells and step sizes each frame starts with.
+        :param load_image: Decodes and preprocesses an image file into a list of slices.
+        :param window: The number of frames kept in memory.
+        :param image_cache: The cache of preprocessed stacks shared between runs. Without one, the
+                            stacks are kept in a temporary directory for the length of the run.
+        """
+        if window < 1:
+            raise ValueError('The frame window must hold at least one frame')
+        self.image_paths = image_paths
+        self.config = config
+        self.output_path = output_path
+        self.load_image = load_image
+        self.window = window
+        self.image_cache = image_cache
+        self._states = list(initial_states)
+        self._frames: "OrderedDict[int, Frame]" = OrderedDict()  # the frames in memory, least recently used first
+        self._stacks: Dict[int, npt.NDArray] = {}  # memory-mapped preprocessed stacks
+        self._pending: Dict[int, Tuple[BoundedStage, Future]] = {}  # stacks being loaded in the background
+        self._temporary_directory = tempfile.TemporaryDirectory(prefix="cell_universe_frames_") if image_cache is None else None
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, index: int) -> Frame:
+        if not 0 <= index < len(self):
+            raise IndexError(f'frame index {index} out of range for {len(self)} frames')
+        if index in self._frames:
+            self._frames.move_to_end(index)
+            return self._frames[index]
+
+        state = self._states[index]
+        frame = Frame(self._real_image_stack(index), self.config.simulation, state.cells, self.output_path,
+                      self.image_name(index), state.proposal_stream)
+        frame.step_sizes = state.step_sizes
+        self._frames[index] = frame
+        while len(self._frames) > self.window:
+            self.release(next(iter(self._frames)))
+        return frame
+
+    def _real_image_stack(self, index: int) -> npt.NDArray:
+        """The preprocessed image stack of the frame, decoded once and then memory-mapped."""
+        if index not in self._stacks:
+            pending = self._pending.pop(index, None)
+            if pending is not None:
+                loader, future = pending
+                self._stacks[index] = loader.wait(future)
+            else:
+                self._stacks[index] = self._load_stack(index)
+        return self._stacks[index]
+
+    def _load_stack(self, index: int) -> npt.NDArray:
+        """Decode and preprocess the image of the frame into a memory-mapped stack. This may run on a loader thread."""
+        if self.image_cache is not None:
+            return self.image_cache.load(self.image_paths[index], self.config, self.load_image)
+        path = Path(self._temporary_directory.name) / f"{index:05d}.npy"
+        if not path.exists():
+            # write to a temporary file first so a released frame never reopens a partial stack
+            temporary_path = path.with_suffix('.tmp.npy')
+            np.save(temporary_path, np.array(self.load_image(self.image_paths[index], self.config)))
+            temporary_path.replace(path)
+        return np.load(path, mmap_mode='r')
+
+    def prefetch(self, index: int, loader: BoundedStage):
+        """Start loading the stack of the frame on the loader stage, unless it is already loaded or out of range."""
+        if 0 <= index < len(self) and index not in self._stacks and index not in self._pending:
+            self._pending[index] = (loader, loader.submit(self._load_stack, index))
+
+    def image_name(self, index: int) -> str:
+        return self.image_paths[index].name
+
+    def get_proposal_stream(self, index: int) -> Optional[ProposalStream]:
+        """The random stream of the frame, or None if it has not been built yet."""
+        return self._frames[index].proposal_stream if index in self._frames else self._states[index].proposal_stream
+
+    def release(self, index: int):
+        """
+        Drop the image stacks of the frame and close its memory map, keeping its cells, step sizes
+        and random stream. The stack is reopened from its .npy file if the frame is accessed again.
+        """
+        self._stacks.pop(index, None)
+        frame = self._frames.pop(index, None)
+        if frame is not None:
+            self._states[index] = FrameState(frame.cells, frame.step_sizes, frame.proposal_stream)
+
+    def close(self):
+        """Release every frame and delete the memory-mapped stacks, unless they are in the shared cache."""
+        for index in list(self._frames):
+            self.release(index)
+        self._stacks.clear()
+        for loader, future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        if self._temporary_directory is not None:
+            self._temporary_directory.cleanup()
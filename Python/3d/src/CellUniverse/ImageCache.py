@@ -0,0 +1,93 @@
+"""
+This module contains the on-disk cache of preprocessed image stacks, shared between runs.
+
+Decoding a TIFF, normalizing it and blurring every slice is repeated on every run of the same
+dataset even though the result only depends on the file and the preprocessing settings. The
+cache stores each preprocessed stack as a float32 .npy file named after a hash of the file's
+contents, blur_sigma and the dtype, so a hit is just a memory map. The stacks are stored before
+padding, which Frame applies, so the padding does not have to be part of the key. When the cache
+grows past its size limit, the least recently used stacks are deleted.
+"""
+
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import Callable, List
+
+import numpy as np
+import numpy.typing as npt
+
+from .Config import BaseConfig
+
+# bump when the preprocessing in load_image changes, so stale stacks are not reused
+CACHE_VERSION = 1
+CACHE_DTYPE = np.float32
+
+
+class ImageCache:
+    """A directory of preprocessed image stacks keyed by file contents and preprocessing settings."""
+
+    def __init__(self, directory: Path, max_bytes: int):
+        """
+        :param directory: Where to keep the stacks. It is created if it does not exist.
+        :param max_bytes: The size the cache is trimmed to after adding a stack.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def file_hash(image_path: Path) -> str:
+        digest = hashlib.sha256()
+        with open(image_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def key(self, image_path: Path, config: BaseConfig) -> str:
+        """The name of the cached stack of an image, preprocessed with the given settings."""
+        settings = f"{CACHE_VERSION}:{self.file_hash(image_path)}:{config.simulation.blur_sigma!r}:{np.dtype(CACHE_DTYPE).str}"
+        return hashlib.sha256(settings.encode()).hexdigest()
+
+    def load(self, image_path: Path, config: BaseConfig,
+             load_image: Callable[[Path, BaseConfig], List[npt.NDArray]]) -> npt.NDArray:
+        """The memory-mapped preprocessed stack of the image, preprocessing it with load_image on a miss."""
+        path = self.directory / f"{self.key(image_path, config)}.npy"
+        if path.exists():
+            self.hits += 1
+            os.utime(path)  # mark as recently used
+            return np.load(path, mmap_mode='r')
+
+        self.misses += 1
+        stack = np.asarray(load_image(image_path, config), dtype=CACHE_DTYPE)
+        # write to a temporary file first so other runs sharing the cache never see a partial stack
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False) as file:
+            np.save(file, stack)
+        os.replace(file.name, path)
+        self.evict(keep=path)
+        return np.load(path, mmap_mode='r')
+
+    def report(self):
+        print(f"Image cache: {self.hits} hits, {self.misses} misses")
+
+    def evict(self, keep: Path):
+        """Delete the least recently used stacks, other than keep, until the cache fits in max_bytes."""
+        entries = []
+        for path in self.directory.glob("*.npy"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # deleted by another run
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            path.unlink(missing_ok=True)
+            total -= size
@@ -1,17 +1,29 @@
+from concurrent.futures import Executor
 from pathlib import Path
+import random
 
 from scipy.ndimage import gaussian_filter
 
+from .Adaptation import StepSizeAdapter
+from .CellFactory import CellFactory
 from .Cells import Cell
+from .Cells.Cell import CellParams
+from .Checkpoint import Checkpoint, config_hash, find_checkpoints, load_checkpoint, save_checkpoint
 
 from .Config import BaseConfig
+from .Convergence import ConvergenceMonitor, OptimizationResult
 from .Frame import Frame
-from typing import List, Dict
+from .FrameStore import FrameState, FrameStore
+from .ImageCache import ImageCache
+from .Motion import MotionPredictor
+from .Output import CellsWriter, create_image_writer
+from .Pipeline import BoundedStage
+from .Proposals import ProposalStream
+from .Pyramid import coarse_simulation_config, downsample_stack, get_pyramid_levels, scale_cell, scale_cell_config
+from typing import List, Dict, Optional
 
 from PIL import Image
 import numpy as np
-import numpy.typing as npt
-import pandas as pd
 from skimage import io
 from copy import deepcopy
 
@@ -46,18 +58,143 @@ def load_image(image_file: Path, config: BaseConfig):
             imgs.append(process_image(img, config))
     return imgs
 
+def optimize_frame(frame: Frame, config: BaseConfig, frame_index: int):
+    """Run one optimization chain on the frame, modifying its cells in place."""
+    total_iterations = len(frame) * config.simulation.iterations_per_cell
+    if config.simulation.pyramid_factors and frame.cells:
+        return optimize_pyramid(frame, config, frame_index, total_iterations)
+    return run_iterations(frame, config, frame_index, total_iterations)
+
+
+def optimize_pyramid(frame: Frame, config: BaseConfig, frame_index: int, total_iterations: int):
+    """
+    Optimize the frame coarse to fine: most iterations run on downsampled copies of the frame and
+    a short refinement runs at full resolution.
+    """
+    cell_class = type(frame.cells[0])
+    cell_config = cell_class.cellConfig
+    levels = get_pyramid_levels(config.simulation)
+    iterations = 0
+    for level in levels:
+        real_image_stack = downsample_stack(frame.real_image_stack, level)
+        simulation_config = coarse_simulation_config(frame.simulation_config, real_image_stack, level)
+        cells = [scale_cell(cell, level.xy_factor) for cell in frame.cells]
+        coarse_frame = Frame(real_image_stack, simulation_config, cells, frame.output_path, frame.image_name)
+        coarse_frame.step_sizes = frame.step_sizes
+        coarse_frame.proposal_stream = frame.proposal_stream
+
+        print(f"Frame {frame_index}: optimizing at 1/{level.xy_factor} resolution, {real_image_stack.shape} voxels")
+        cell_class.cellConfig = scale_cell_config(cell_config, level.xy_factor)
+        try:
+            result = run_iterations(coarse_frame, config, frame_index, int(level.iteration_fraction * total_iterations))
+        finally:
+            cell_class.cellConfig = cell_config
+        iterations += result.iterations
+        frame.set_cells([scale_cell(cell, level.xy_factor, inverse=True) for cell in coarse_frame.cells])
+
+    # the refinement gets its own share of the budget, not what the coarse levels left unused
+    refinement = max(round((1 - sum(level.iteration_fraction for level in levels)) * total_iterations), 0)
+    print(f"Frame {frame_index}: refining at full resolution")
+    result = run_iterations(frame, config, frame_index, refinement)
+    return result._replace(iterations=iterations + result.iterations)
+
+
+def run_iterations(frame: Frame, config: BaseConfig, frame_index: int, total_iterations: int):
+    """Run up to total_iterations of the configured algorithm on the frame, stopping early once it converges."""
+    algorithm = config.simulation.algorithm
+    proposals = config.simulation.proposals_per_move
+    print(f"Total iterations: {total_iterations}")
+
+    # add tolerance (do not need to calculate gradient descent if minima is reaced)
+    tolerance = 0.5
+    monitor = ConvergenceMonitor(config.convergence, frame.cost)
+    stop_reason = "iteration limit reached"
+
+    for i in range(total_iterations):
+        if i % 100 == 0:
+            print(f"Frame {frame_index}, iteration {i}")
+
+        if algorithm == 'simulated annealing':
+            # this is just some initial code it isn't full simulated annealing
+            temperature = (i + 1) / total_iterations
+            cost_diff, accept = frame.perturb(proposals, temperature)
+            acceptance = np.exp(-cost_diff / temperature)
+            accepted = acceptance > frame.proposal_stream.uniform()
+            accept(accepted)
+        elif algorithm == 'gradient descent':
+            print(f"Current iteration: {i + 1}")
+            cur_cost = frame.cost
+            if config.simulation.gradient_method == 'analytic':
+                new_cost = frame.analytic_gradient_descent()
+            else:
+                new_cost = frame.gradient_descent()
+            accepted = new_cost < cur_cost
+
+            if (cur_cost - new_cost) < tolerance:
+                monitor.record(accepted, frame.cost)
+                stop_reason = "minimum reached: gradient descent step improved the cost by less than the tolerance"
+                break
+
+        else:
+            # Hill climbing
+            options = ['split', 'perturbation']
+            probabilities = [config.prob.split, config.prob.perturbation]
+
+            chosen_option = options[frame.proposal_stream.choice(probabilities)]
+            if chosen_option == 'perturbation':
+                cost_diff, accept = frame.perturb(proposals)
+            elif chosen_option == 'split':
+                cost_diff, accept = frame.split()
+            else:
+                raise ValueError("Invalid option")
+            accepted = cost_diff < 0
+            accept(accepted)
+
+        monitor.record(accepted, frame.cost)
+        if monitor.stop_reason is not None:
+            stop_reason = monitor.stop_reason
+            break
+
+    print(f"Frame {frame_index} stopped after {monitor.iterations} of {total_iterations} iterations "
+          f"with cost {frame.cost:.4f} ({stop_reason})")
+    if frame.step_sizes is not None:
+        frame.step_sizes.log(f"Frame {frame_index} adapted sigmas")
+
+    return OptimizationResult(monitor.iterations, frame.cost, stop_reason)
+
+
+def optimize_chain(frame: Frame, config: BaseConfig, frame_index: int, seed: np.random.SeedSequence):
+    """
+    Run an independent optimization chain on a copy of the frame, e.g. in a worker process.
+    Only the result, the parameters of the optimized cells and the adapted step sizes are
+    returned, not the image stacks.
+    """
+    random_seed, numpy_seed = seed.generate_state(2)
+    random.seed(int(random_seed))
+    np.random.seed(int(numpy_seed))
+    frame.proposal_stream = ProposalStream(np.random.default_rng(seed.spawn(1)[0]))
+    # class level cell settings don't travel with the frame to worker processes
+    type(frame.cells[0]).cellConfig = config.cell
+
+    result = optimize_frame(frame, config, frame_index)
+    return result, [cell.get_cell_params() for cell in frame.cells], frame.step_sizes
+
 
 class Lineage:
-    def __init__(self, initial_cells: Dict[str, List[Cell]], image_paths: List[Path], config: BaseConfig, output_path: Path, continue_from=-1):
+    def __init__(self, initial_cells: Dict[str, List[Cell]], image_paths: List[Path], config: BaseConfig, output_path: Path, continue_from=-1,
+                 frame_window: int = 2, image_cache: Optional[ImageCache] = None):
+        """
+        :param frame_window: The number of frames kept in memory. The others are loaded when accessed.
+        :param image_cache: The cache of preprocessed image stacks shared between runs, if any.
+        """
         self.config = config
-        self.frames: List[Frame] = []
         self.output_path = output_path
+        self.results: Dict[int, OptimizationResult] = {}  # how the optimization of each frame went
+        self.motion = MotionPredictor(config.motion) if config.motion is not None else None
+        self.predicted_frames: List[int] = []  # frames whose cells were extrapolated by the motion model
 
+        initial_states: List[FrameState] = []
         for i, image_path in enumerate(image_paths):
-            # Load original images
-            real_images: List[npt.NDArray] = []
-            real_images.extend(load_image(image_path, config))
-
             file_name = image_path.name
 
             if (continue_from == -1 or i < continue_from) and file_name in initial_cells:
@@ -65,83 +202,63 @@ class Lineage:
             else:
                 cells = []
 
-            self.frames.append(Frame(np.array(real_images), config.simulation, cells, output_path, file_name))
+            step_sizes = StepSizeAdapter(config.adaptation, config.cell) if config.adaptation is not None else None
+            initial_states.append(FrameState(cells, step_sizes, None))
 
-    def optimize(self, frame_index: int):
-        """Perturb the cells in the frame."""
+        # frames are loaded on first access, so only a window of them has to fit in memory
+        self.frames = FrameStore(image_paths, config, output_path, initial_states, load_image, frame_window, image_cache)
+        self.image_writer = create_image_writer(config.output, output_path, len(image_paths))
+        self.cells_writer = CellsWriter(output_path / "cells.csv")
+
+    def optimize(self, frame_index: int, executor: Optional[Executor] = None, chains: int = 1):
+        """
+        Perturb the cells in the frame.
+
+        :param executor: A process pool or dask executor to run independent chains on.
+        :param chains: The number of independent chains to run. The chain with the lowest cost wins.
+        """
         frame = self.frames[frame_index]
-        algorithm = 'hill'
-        total_iterations = len(frame) * self.config.simulation.iterations_per_cell
-        print(f"Total iterations: {total_iterations}")
-
-        # add tolerance (do not need to calculate gradient descent if minima is reaced)
-        tolerance = 0.5
-        minima_reached = False
-
-        for i in range(total_iterations):
-            if i % 100 == 0:
-                print(f"Frame {frame_index}, iteration {i}")
-
-            if algorithm == 'simulated annealing':
-                # this is just some initial code it isn't full simulated annealing
-                cost_diff, accept = frame.perturb()
-                acceptance = np.exp(-cost_diff / ((i + 1) / total_iterations))
-                accept(acceptance > np.random.random_sample())
-            elif algorithm == 'gradient descent':
-                print(f"Current iteration: {i + 1}")
-                if minima_reached:
-                    continue
-
-                cur_cost = frame.calculate_cost(frame.synth_image_stack)
-                new_cost = frame.gradient_descent()
+        if executor is None or chains <= 1 or not frame.cells:
+            self.results[frame_index] = optimize_frame(frame, self.config, frame_index)
+            return
 
-                if (cur_cost - new_cost) < tolerance:
-                    minima_reached = True
+        # give every chain its own random stream derived from the global seed
+        seeds = np.random.SeedSequence(np.random.randint(2 ** 32)).spawn(chains)
+        futures = [executor.submit(optimize_chain, frame, self.config, frame_index, seed) for seed in seeds]
+        results = [future.result() for future in futures]
 
-            else:
-                # Hill climbing
-                options = ['split', 'perturbation']
-                probabilities = [self.config.prob.split, self.config.prob.perturbation]
-
-                chosen_option = np.random.choice(options, p=probabilities)
-                if chosen_option == 'perturbation':
-                    cost_diff, accept = frame.perturb()
-                elif chosen_option == 'split':
-                    cost_diff, accept = frame.split()
-                else:
-                    raise ValueError("Invalid option")
-                accept(cost_diff < 0)
-
-    def save_images(self, frame_index: int):
-        """Save the images in the frame to the output path."""
+        for chain, (result, _, _) in enumerate(results):
+            print(f"Frame {frame_index}, chain {chain}: cost {result.cost:.4f} after {result.iterations} iterations")
+        result, cell_params, step_sizes = min(results, key=lambda chain_result: chain_result[0].cost)
+
+        cell_class = type(frame.cells[0])
+        frame.set_cells([cell_class(params) for params in cell_params])
+        frame.step_sizes = step_sizes
+        self.results[frame_index] = result._replace(cost=frame.cost)
+        print(f"Frame {frame_index}: kept the best of {chains} chains with cost {frame.cost:.4f}")
+
+    def render_images(self, frame_index: int):
+        """Draw the real images with the cell outlines and the synthetic images of the frame."""
         if frame_index < 0 or frame_index >= len(self.frames):
             raise ValueError("Invalid frame index")
         real_images = self.frames[frame_index].generate_output_images()
         synth_images = self.frames[frame_index].generate_output_synth_images()
-        print(f"Saving images for frame {frame_index}...")
-
-        real_output_path = self.output_path / f"real/{frame_index}"
-        if not real_output_path.exists():
-            real_output_path.mkdir(parents=True, exist_ok=True)
-        for i, image in enumerate(real_images):
-            # create a directory for the frame if it doesn't exist
-            image.save(real_output_path / f"{i}.png")
-
-        synth_output_path = self.output_path / f"synth/{frame_index}"
-        if not synth_output_path.exists():
-            synth_output_path.mkdir(parents=True, exist_ok=True)
-        for i, image in enumerate(synth_images):
-            # create a directory for the frame if it doesn't exist
-            image.save(synth_output_path / f"{i}.png")
+        return real_images, synth_images
 
+    def write_images(self, frame_index: int, real_images: List[Image.Image], synth_images: List[Image.Image]):
+        """Encode and write the rendered images of the frame. This doesn't touch the frame, so it can run in the background."""
+        print(f"Saving images for frame {frame_index}...")
+        self.image_writer.write(frame_index, real_images, synth_images)
         print("Done")
 
-    def save_cells(self, frame_index: int):
-        """Save the cells up to the frame index to the output path."""
-        output = pd.concat([frame.get_cells_as_params() for frame in self.frames[:frame_index+1]])
-        # sort the cells by frame and then by cell ID
-        output = output.sort_values(by=['file', 'name'])
-        output.to_csv(self.output_path / "cells.csv", index=False)
+    def write_cells(self, image_name: str, cell_params: List[CellParams]):
+        """Append captured cell parameters to cells.csv. This doesn't touch the frame, so it can run in the background."""
+        self.cells_writer.append(image_name, cell_params)
+
+    def compact_cells(self):
+        """Sort cells.csv by frame and then by cell ID, if the config asks for it."""
+        if self.config.output.sort_cells:
+            self.cells_writer.compact()
 
     #
     # def copy_sim_config_forward(self, to: int):
@@ -151,10 +268,139 @@ class Lineage:
     #     self.frames[to].update_simulation_config(self.frames[to-1].simulation_config)
 
     def copy_cells_forward(self, to: int):
-        """Copy the cells from the previous frame to the next frame."""
+        """
+        Copy the cells and the adapted step sizes from the previous frame to the next frame. With
+        a motion model, the cells are extrapolated from their velocities over the last frames.
+        """
         if to >= len(self.frames):
             return
-        self.frames[to].cells = deepcopy((self.frames[to - 1].cells))
+        self._warm_start(to, self.frames[to - 1].cells, self.frames[to - 1].step_sizes)
+
+    def _warm_start(self, to: int, cells: List[Cell], step_sizes: Optional[StepSizeAdapter]):
+        """Start the frame from the cells and step sizes the previous frame ended with."""
+        previous_cells = cells
+        cells = deepcopy(cells)
+        if self.motion is not None:
+            self.motion.observe(previous_cells)
+            predicted = self.motion.predict(cells)
+            if any(new is not old for new, old in zip(predicted, cells)):
+                self.predicted_frames.append(to)
+            cells = predicted
+        self.frames[to].set_cells(cells)
+        if step_sizes is not None:
+            self.frames[to].step_sizes = deepcopy(step_sizes)
+            self.frames[to].step_sizes.reset_counts()
+
+    @property
+    def checkpoint_path(self) -> Path:
+        return self.output_path / "checkpoints"
+
+    def make_checkpoint(self, frame_index: int) -> Checkpoint:
+        """
+        Capture the optimized cells of the frame and the state needed to continue with the next
+        frame (random state, adapted step sizes, proposal streams of the remaining frames), to be
+        written later by write_checkpoint.
+        """
+        frame = self.frames[frame_index]
+        return Checkpoint(
+            frame_index=frame_index,
+            image_name=frame.image_name,
+            config_hash=config_hash(self.config),
+            cell_params=[cell.get_cell_params() for cell in frame.cells],
+            numpy_state=np.random.get_state(),
+            proposal_states={later: self.frames.get_proposal_stream(later).get_state()
+                             for later in range(frame_index + 1, len(self.frames)) if self.frames.get_proposal_stream(later) is not None},
+            step_sizes=frame.step_sizes.get_state() if frame.step_sizes is not None else None,
+            result=self.results.get(frame_index),
+            predicted=frame_index in self.predicted_frames,
+        )
+
+    def write_checkpoint(self, checkpoint: Checkpoint):
+        save_checkpoint(self.checkpoint_path, checkpoint)
+
+    def resume(self) -> int:
+        """
+        Restore the state after the last good checkpoint and warm start the frame after it. The
+        finished frames are neither optimized nor rendered again. Returns the index of the first
+        frame left to optimize, which is 0 if there is no usable checkpoint.
+        """
+        cell_class = CellFactory(self.config).cellClass
+        expected_hash = config_hash(self.config)
+        checkpoints: List[Checkpoint] = []
+        for path in find_checkpoints(self.checkpoint_path):
+            try:
+                checkpoint = load_checkpoint(path, cell_class)
+            except ValueError as e:
+                print(f"Skipping checkpoint: {e}")
+                continue
+            if checkpoint.config_hash != expected_hash:
+                raise ValueError(f'Checkpoint "{path}" was written with a different config')
+            if checkpoint.frame_index >= len(self.frames) or checkpoint.image_name != self.frames.image_name(checkpoint.frame_index):
+                raise ValueError(f'Checkpoint "{path}" does not match the input frames')
+            checkpoints.append(checkpoint)
+
+        # only an unbroken run of checkpoints from the first frame can be resumed from
+        checkpoints = [checkpoint for i, checkpoint in enumerate(checkpoints) if checkpoint.frame_index == i]
+        if not checkpoints:
+            print("No checkpoint to resume from, starting from the first frame")
+            return 0
+        # drop the cells of frames that finished after the last usable checkpoint, they are optimized again
+        self.cells_writer.keep_frames([checkpoint.image_name for checkpoint in checkpoints])
+
+        for checkpoint in checkpoints:
+            if checkpoint.result is not None:
+                self.results[checkpoint.frame_index] = checkpoint.result
+            if checkpoint.predicted:
+                self.predicted_frames.append(checkpoint.frame_index)
+
+        # replay the motion model over the finished frames; the last one is observed by the warm start
+        if self.motion is not None:
+            for checkpoint in checkpoints[:-1]:
+                self.motion.observe([cell_class(params) for params in checkpoint.cell_params])
+
+        last = checkpoints[-1]
+        step_sizes = None
+        if last.step_sizes is not None:
+            step_sizes = StepSizeAdapter(self.config.adaptation, self.config.cell)
+            step_sizes.set_state(last.step_sizes)
+        if last.frame_index + 1 < len(self.frames):
+            self._warm_start(last.frame_index + 1, [cell_class(params) for params in last.cell_params], step_sizes)
+
+        # restore the random state after loading the next frame, which seeds its proposal stream from it
+        np.random.set_state(last.numpy_state)
+        for index, state in last.proposal_states.items():
+            self.frames[index].proposal_stream.set_state(state)
+
+        print(f"Resuming after frame {last.frame_index} ({last.image_name})")
+        return last.frame_index + 1
+
+    def report_iterations(self):
+        """Print the mean number of iterations per frame with and without a motion model warm start."""
+        if not self.results:
+            return
+        groups = {"warm started by the motion model": [], "copied unchanged": []}
+        for frame_index, result in sorted(self.results.items()):
+            key = "warm started by the motion model" if frame_index in self.predicted_frames else "copied unchanged"
+            groups[key].append(result)
+        for description, results in groups.items():
+            if results:
+                iterations = np.mean([result.iterations for result in results])
+                cost = np.mean([result.cost for result in results])
+                print(f"{len(results)} frames {description}: {iterations:.0f} iterations and "
+                      f"cost {cost:.4f} on average")
+
+    def prefetch(self, frame_index: int, loader: BoundedStage):
+        """Start decoding the image stack of a frame on the loader stage, ahead of its optimization."""
+        self.frames.prefetch(frame_index, loader)
+
+    def release(self, frame_index: int):
+        """Drop the image stacks of a finished frame from memory."""
+        self.frames.release(frame_index)
+
+    def close(self):
+        """Release every frame, delete the memory-mapped image stacks and flush the output images."""
+        self.frames.close()
+        self.image_writer.close()
 
     def __len__(self):
         return len(self.frames)
@@ -0,0 +1,128 @@
+"""
+This module contains the motion model used to warm start a frame from the cells of the previous
+frames, by extrapolating each cell's parameters (position, radius, ...) one frame ahead.
+
+Cells are matched across frames by name. A cell created by a split (named after its parent with
+an extra digit) has no history of its own, so it inherits the position velocity of its closest
+ancestor that has one.
+"""
+
+from collections import defaultdict, deque
+from typing import Deque, Dict, List, Optional
+
+import numpy as np
+
+from .Cells import Cell
+from .Config import MotionConfig
+
+POSITION_PARAMETERS = ('x', 'y', 'z')
+
+
+class KalmanTrack:
+    """A constant velocity Kalman filter on the parameters of one cell, each filtered independently."""
+
+    def __init__(self, values: np.ndarray, config: MotionConfig):
+        self.config = config
+        count = len(values)
+        self.state = np.stack([values, np.zeros(count)], axis=1)  # (parameter, [value, velocity])
+        self.covariance = np.tile(np.diag([config.measurement_noise, config.initial_velocity_variance]), (count, 1, 1))
+
+    def update(self, values: np.ndarray):
+        """Predict one frame ahead, then correct with the observed values."""
+        transition = np.array([[1.0, 1.0], [0.0, 1.0]])
+        q = self.config.process_noise
+        process = q * np.array([[1 / 3, 1 / 2], [1 / 2, 1.0]])  # white noise acceleration over one frame
+        self.state = self.state @ transition.T
+        self.covariance = transition @ self.covariance @ transition.T + process
+
+        innovation = values - self.state[:, 0]
+        innovation_variance = self.covariance[:, 0, 0] + self.config.measurement_noise
+        gain = self.covariance[:, :, 0] / innovation_variance[:, None]
+        self.state += gain * innovation[:, None]
+        self.covariance -= gain[:, :, None] * self.covariance[:, None, 0, :]
+
+    @property
+    def velocity(self) -> np.ndarray:
+        return self.state[:, 1]
+
+    @property
+    def value(self) -> np.ndarray:
+        return self.state[:, 0]
+
+
+class MotionPredictor:
+    """Estimates per-cell velocities from the last frames and extrapolates the cells to the next frame."""
+
+    def __init__(self, config: MotionConfig):
+        self.config = config
+        self.parameters: Optional[List[str]] = None
+        self.history: Dict[str, Deque[np.ndarray]] = defaultdict(lambda: deque(maxlen=config.history))
+        self.tracks: Dict[str, KalmanTrack] = {}
+
+    @staticmethod
+    def _values(cell: Cell) -> Dict[str, float]:
+        return {name: value for name, value in cell.get_cell_params() if isinstance(value, (int, float)) and name != 'name'}
+
+    def observe(self, cells: List[Cell]):
+        """Record the optimized cells of a frame."""
+        observed = set()
+        for cell in cells:
+            values = self._values(cell)
+            if self.parameters is None:
+                self.parameters = list(values)
+            name = cell.get_cell_params().name
+            observed.add(name)
+            vector = np.array([values[parameter] for parameter in self.parameters], dtype=float)
+            self.history[name].append(vector)
+            if self.config.model == 'kalman':
+                if name in self.tracks:
+                    self.tracks[name].update(vector)
+                else:
+                    self.tracks[name] = KalmanTrack(vector, self.config)
+
+        # forget cells that are gone, e.g. because they split, unless they are the ancestor of a
+        # cell that has no velocity of its own yet and inherits theirs
+        inheriting = [name for name in observed if len(self.history[name]) < 2]
+        for name in list(self.history):
+            if name not in observed and not any(child.startswith(name) for child in inheriting):
+                del self.history[name]
+                self.tracks.pop(name, None)
+
+    def velocity(self, name: str) -> Optional[np.ndarray]:
+        """The estimated change of every parameter per frame, or None if the cell has no history yet."""
+        if self.config.model == 'kalman':
+            track = self.tracks.get(name)
+            return track.velocity if track is not None and len(self.history[name]) >= 2 else None
+
+        history = self.history.get(name)
+        if history is None or len(history) < 2:
+            return None
+        # least squares slope over the frames in the window
+        values = np.stack(history)
+        frames = np.arange(len(values)) - (len(values) - 1) / 2
+        return frames @ (values - values.mean(axis=0)) / (frames @ frames)
+
+    def _inherited_velocity(self, name: str) -> Optional[np.ndarray]:
+        """The position velocity of the closest ancestor with a history, for cells created by a split."""
+        while len(name) > 1:
+            name = name[:-1]
+            velocity = self.velocity(name)
+            if velocity is not None:
+                return np.array([value if parameter in POSITION_PARAMETERS else 0.0
+                                 for parameter, value in zip(self.parameters, velocity)])
+        return None
+
+    def predict(self, cells: List[Cell]) -> List[Cell]:
+        """Returns the cells extrapolated one frame ahead. Cells without any history are returned unchanged."""
+        predicted = []
+        for cell in cells:
+            name = cell.get_cell_params().name
+            velocity = self.velocity(name)
+            if velocity is None:
+                velocity = self._inherited_velocity(name)
+            if velocity is None:
+                predicted.append(cell)
+                continue
+            offsets = defaultdict(float, zip(self.parameters, velocity * self.config.damping))
+            predicted.append(cell.get_paramaterized_cell(offsets))
+        return predicted
@@ -0,0 +1,246 @@
+"""
+This module contains the writers for the output of every frame, the real images with cell
+outlines, the synthetic images and the cell parameters, and a reader for the images.
+
+- png: real/{frame}/{slice}.png and synth/{frame}/{slice}.png, one file per slice.
+- tiff: real/{frame}.tif and synth/{frame}.tif, one multi-page file per frame.
+- npy: real.npy and synth.npy, one uint8 array per run indexed by (frame, slice, y, x[, rgb]).
+  Each frame is written into its own chunk of the arrays, which are memory-mapped.
+
+The cell parameters are appended to cells.csv as soon as a frame is finished, see CellsWriter.
+
+Writers may be called from several threads, each writing a different frame.
+"""
+
+import csv
+import io
+import os
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Collection, Dict, List, Optional
+
+import numpy as np
+import numpy.typing as npt
+from PIL import Image
+
+from .Cells.Cell import CellParams
+from .Config import OutputConfig
+
+IMAGE_KINDS = ('real', 'synth')
+
+
+class ImageWriter(ABC):
+    """Writes the output images of each frame under an output directory."""
+
+    def __init__(self, output_path: Path):
+        self.output_path = output_path
+
+    @abstractmethod
+    def write(self, frame_index: int, real_images: List[Image.Image], synth_images: List[Image.Image]):
+        """Write the real images with outlines and the synthetic images of a frame, one image per slice."""
+        pass
+
+    def close(self):
+        """Flush anything still buffered."""
+        pass
+
+
+class PngWriter(ImageWriter):
+    def write(self, frame_index: int, real_images: List[Image.Image], synth_images: List[Image.Image]):
+        for kind, images in zip(IMAGE_KINDS, (real_images, synth_images)):
+            # create a directory for the frame if it doesn't exist
+            frame_path = self.output_path / kind / str(frame_index)
+            frame_path.mkdir(parents=True, exist_ok=True)
+            for i, image in enumerate(images):
+                image.save(frame_path / f"{i}.png")
+
+
+class TiffWriter(ImageWriter):
+    def write(self, frame_index: int, real_images: List[Image.Image], synth_images: List[Image.Image]):
+        for kind, images in zip(IMAGE_KINDS, (real_images, synth_images)):
+            kind_path = self.output_path / kind
+            kind_path.mkdir(parents=True, exist_ok=True)
+            images[0].save(kind_path / f"{frame_index}.tif", save_all=True, append_images=images[1:])
+
+
+class NpyWriter(ImageWriter):
+    """Writes every frame into a chunk of one memory-mapped array per kind of image."""
+
+    def __init__(self, output_path: Path, frame_count: int):
+        super().__init__(output_path)
+        self.frame_count = frame_count
+        self._arrays: Dict[str, np.memmap] = {}
+        self._lock = threading.Lock()
+
+    def _array(self, kind: str, frame_shape: tuple) -> np.memmap:
+        """The array of a kind of image, created on the first write or reopened if a previous run (e.g. a resumed one) made it."""
+        with self._lock:
+            if kind not in self._arrays:
+                self.output_path.mkdir(parents=True, exist_ok=True)
+                path = self.output_path / f"{kind}.npy"
+                shape = (self.frame_count,) + frame_shape
+                array = None
+                if path.exists():
+                    array = np.load(path, mmap_mode='r+')
+                    if array.shape != shape or array.dtype != np.uint8:
+                        array = None
+                if array is None:
+                    array = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=shape)
+                self._arrays[kind] = array
+            return self._arrays[kind]
+
+    def write(self, frame_index: int, real_images: List[Image.Image], synth_images: List[Image.Image]):
+        for kind, images in zip(IMAGE_KINDS, (real_images, synth_images)):
+            stack = np.stack([np.asarray(image) for image in images])
+            array = self._array(kind, stack.shape)
+            array[frame_index] = stack
+            array.flush()
+
+    def close(self):
+        with self._lock:
+            for array in self._arrays.values():
+                array.flush()
+            self._arrays.clear()
+
+
+def create_image_writer(config: OutputConfig, output_path: Path, frame_count: int) -> ImageWriter:
+    if config.format == 'tiff':
+        return TiffWriter(output_path)
+    if config.format == 'npy':
+        return NpyWriter(output_path, frame_count)
+    return PngWriter(output_path)
+
+
+class CellsWriter:
+    """
+    Appends the cells of every finished frame to a csv file, one row per cell. The rows of a frame
+    are written with a single write and synced to disk before the call returns, so a crash can
+    at worst leave a partial last line, which is dropped when the file is reopened by keep_frames.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._fieldnames: Optional[List[str]] = None
+        self._started = False
+        self._lock = threading.Lock()
+
+    def _read_rows(self) -> List[Dict[str, str]]:
+        """The complete rows of the file, leaving out a partial last line."""
+        if not self.path.exists():
+            return []
+        text = self.path.read_text()
+        if not text.endswith('\n'):
+            text = text[:text.rfind('\n') + 1]
+        reader = csv.DictReader(io.StringIO(text))
+        rows = list(reader)
+        if reader.fieldnames:
+            self._fieldnames = list(reader.fieldnames)
+        return rows
+
+    def _replace_rows(self, rows: List[Dict[str, str]]):
+        """Atomically rewrite the file with the given rows."""
+        temporary_path = self.path.with_suffix('.tmp')
+        with open(temporary_path, 'w', newline='') as file:
+            if self._fieldnames is not None:
+                writer = csv.DictWriter(file, self._fieldnames)
+                writer.writeheader()
+                writer.writerows(rows)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.path)
+
+    def keep_frames(self, image_names: Collection[str]):
+        """Continue an existing file, keeping only the rows of the given frames, e.g. the ones finished before a resume."""
+        with self._lock:
+            image_names = set(image_names)
+            self._replace_rows([row for row in self._read_rows() if row['file'] in image_names])
+            self._started = True
+
+    def append(self, image_name: str, cell_params: List[CellParams]):
+        """Append the cells of a finished frame and sync them to disk."""
+        rows = [dict(params, file=image_name) for params in cell_params]
+        with self._lock:
+            if not self._started:
+                # a new run replaces the cells of an earlier run
+                self.path.unlink(missing_ok=True)
+                self._started = True
+            if not rows:
+                return
+
+            buffer = io.StringIO(newline='')
+            new_file = self._fieldnames is None
+            if new_file:
+                self._fieldnames = list(rows[0])
+            writer = csv.DictWriter(buffer, self._fieldnames)
+            if new_file:
+                writer.writeheader()
+            writer.writerows(rows)
+
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'a', newline='') as file:
+                file.write(buffer.getvalue())
+                file.flush()
+                os.fsync(file.fileno())
+
+    def compact(self):
+        """Atomically sort the rows by file and then by cell name."""
+        with self._lock:
+            if self.path.exists():
+                self._replace_rows(sorted(self._read_rows(), key=lambda row: (row['file'], row['name'])))
+
+
+class OutputReader:
+    """
+    Reads the images written by a run, whichever format they were written in. The npy format is
+    memory-mapped, so frames are only read from disk when their pixels are used; the png and tiff
+    formats are decoded when a frame is read.
+    """
+
+    def __init__(self, output_path: Path):
+        self.output_path = output_path
+        self._arrays: Dict[str, np.memmap] = {}
+        if (output_path / "real.npy").exists():
+            self.format = 'npy'
+            self._arrays = {kind: np.load(output_path / f"{kind}.npy", mmap_mode='r') for kind in IMAGE_KINDS}
+        elif any((output_path / "real").glob("*.tif")):
+            self.format = 'tiff'
+        elif (output_path / "real").is_dir():
+            self.format = 'png'
+        else:
+            raise ValueError(f'No output images found in "{output_path}"')
+
+    def frames(self) -> List[int]:
+        """The indices of the frames that were written."""
+        if self.format == 'npy':
+            return list(range(len(self._arrays['real'])))
+        if self.format == 'tiff':
+            return sorted(int(path.stem) for path in (self.output_path / "real").glob("*.tif"))
+        return sorted(int(path.name) for path in (self.output_path / "real").iterdir() if path.name.isdigit())
+
+    def read(self, kind: str, frame_index: int) -> npt.NDArray:
+        """The (slice, y, x[, rgb]) uint8 stack of the real images with outlines or the synthetic images of a frame."""
+        if kind not in IMAGE_KINDS:
+            raise ValueError(f'kind should be one of {IMAGE_KINDS}')
+        if self.format == 'npy':
+            return self._arrays[kind][frame_index]
+        if self.format == 'tiff':
+            with Image.open(self.output_path / kind / f"{frame_index}.tif") as image:
+                slices = []
+                for i in range(getattr(image, 'n_frames', 1)):
+                    image.seek(i)
+                    slices.append(np.array(image))
+            return np.stack(slices)
+        frame_path = self.output_path / kind / str(frame_index)
+        paths = sorted(frame_path.glob("*.png"), key=lambda path: int(path.stem))
+        slices = []
+        for path in paths:
+            with Image.open(path) as image:
+                slices.append(np.array(image))
+        return np.stack(slices)
+
+    def real(self, frame_index: int) -> npt.NDArray:
+        return self.read('real', frame_index)
+
+    def synth(self, frame_index: int) -> npt.NDArray:
+        return self.read('synth', frame_index)
@@ -0,0 +1,111 @@
+"""
+This module contains the background stages that overlap loading and writing frames with the
+optimization of the current frame.
+
+Each stage is a few worker threads fed through a bounded queue, so submitting work blocks once
+the stage falls behind instead of piling up finished frames in memory. PNG encoding and file
+I/O release the GIL, so threads are enough to overlap them with the optimizer. The time every
+stage spends working, and the time the main thread spends waiting on it, are recorded to show
+how much of the work is hidden.
+"""
+
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List
+
+
+class StageTimings:
+    """Wall time spent working in each stage, and waiting on it from the main thread."""
+
+    def __init__(self):
+        self.busy_time: Dict[str, float] = defaultdict(float)
+        self.wait_time: Dict[str, float] = defaultdict(float)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _timed(self, times: Dict[str, float], stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                times[stage] += time.perf_counter() - start
+
+    def busy(self, stage: str):
+        """Time work done in a stage."""
+        return self._timed(self.busy_time, stage)
+
+    def waiting(self, stage: str):
+        """Time the main thread spends blocked on a stage."""
+        return self._timed(self.wait_time, stage)
+
+    def report(self, elapsed: float):
+        print(f"Stage timings over {elapsed:.2f} seconds:")
+        for stage, busy in self.busy_time.items():
+            waited = f", {self.wait_time[stage]:.2f} s waited for" if stage in self.wait_time else ""
+            print(f"  {stage}: {busy:.2f} s{waited}")
+
+
+class BoundedStage:
+    """Runs tasks on worker threads. Submitting blocks while max_pending tasks are already queued."""
+
+    def __init__(self, name: str, workers: int, max_pending: int, timings: StageTimings):
+        self.name = name
+        self.timings = timings
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_pending)
+        self._futures: List[Future] = []
+        self._threads = [threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True) for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            future, function, args = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with self.timings.busy(self.name):
+                    result = function(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def submit(self, function: Callable, *args) -> Future:
+        """Queue function(*args), waiting for room in the queue. Raises the error of an earlier task that failed."""
+        finished = [future for future in self._futures if future.done()]
+        self._futures = [future for future in self._futures if not future.done()]
+        for future in finished:
+            if not future.cancelled():
+                future.result()
+
+        future: Future = Future()
+        with self.timings.waiting(self.name):
+            self._queue.put((future, function, args))
+        self._futures.append(future)
+        return future
+
+    def wait(self, future: Future) -> Any:
+        """The result of a task, timing how long the main thread waits for it."""
+        with self.timings.waiting(self.name):
+            return future.result()
+
+    def join(self):
+        """Wait for every submitted task, raising the first error."""
+        futures, self._futures = self._futures, []
+        for future in futures:
+            self.wait(future)
+
+    def shutdown(self):
+        """Finish the queued tasks and stop the worker threads."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
@@ -0,0 +1,89 @@
+"""
+This module contains the helpers used to optimize a frame coarse to fine on an image pyramid.
+
+A coarse level downsamples the (padded) real image stack by averaging xy_factor x xy_factor
+blocks of pixels, and optionally keeps only every z_factor-th slice around the middle one. A
+coarse pixel j covers the fine pixels xy_factor * j ... xy_factor * j + xy_factor - 1, so a fine
+coordinate maps to (coordinate - (xy_factor - 1) / 2) / xy_factor in x and y. Spheres must stay
+spheres, so z and the radius are divided by xy_factor as well, and the coarse slices are
+z_scaling * z_factor / xy_factor apart.
+"""
+
+from typing import List, NamedTuple
+
+import numpy as np
+import numpy.typing as npt
+
+from .Cells import Cell
+from .Config import SimulationConfig
+
+# cell parameters measured in pixels that are scaled without an offset
+LENGTH_PARAMETERS = ('z', 'radius', 'minRadius', 'maxRadius')
+
+
+class PyramidLevel(NamedTuple):
+    """A coarse level of the image pyramid."""
+    xy_factor: int
+    z_factor: int
+    iteration_fraction: float
+
+
+def get_pyramid_levels(simulation_config: SimulationConfig) -> List[PyramidLevel]:
+    """Returns the coarse levels to optimize before the full resolution refinement, coarsest first."""
+    factors = simulation_config.pyramid_factors
+    z_factors = simulation_config.pyramid_z_factors or [1] * len(factors)
+    fractions = simulation_config.pyramid_iterations or [0.8 / len(factors)] * len(factors)
+    return [PyramidLevel(*level) for level in zip(factors, z_factors, fractions)]
+
+
+def coarse_slice_indices(slice_count: int, z_factor: int) -> List[int]:
+    """
+    Returns the indices of every z_factor-th slice counted from the middle one, so the kept
+    slices are still laid out as z_scaling * (i - len // 2) with a larger z_scaling.
+    """
+    middle = slice_count // 2
+    return list(range(middle - (middle // z_factor) * z_factor, slice_count, z_factor))
+
+
+def downsample_stack(image_stack: npt.NDArray, level: PyramidLevel) -> npt.NDArray:
+    """Downsample a stack by averaging blocks of pixels in xy and keeping every z_factor-th slice."""
+    image_stack = image_stack[coarse_slice_indices(len(image_stack), level.z_factor)]
+    f = level.xy_factor
+    depth, height, width = image_stack.shape
+    height, width = height // f * f, width // f * f
+    blocks = image_stack[:, :height, :width].reshape(depth, height // f, f, width // f, f)
+    return blocks.mean(axis=(2, 4))
+
+
+def coarse_simulation_config(simulation_config: SimulationConfig, image_stack: npt.NDArray, level: PyramidLevel):
+    """Returns the simulation config of a coarse level. The stack is already padded at full resolution."""
+    return simulation_config.copy(update={
+        'padding': 0,
+        'z_slices': len(image_stack),
+        'z_scaling': simulation_config.z_scaling * level.z_factor / level.xy_factor,
+        'blur_sigma': 0,
+        'pyramid_factors': [],
+    })
+
+
+def _scale_value(name: str, value: float, xy_factor: int, inverse: bool):
+    if name in ('x', 'y'):
+        offset = (xy_factor - 1) / 2
+        return value * xy_factor + offset if inverse else (value - offset) / xy_factor
+    if name in LENGTH_PARAMETERS:
+        return value * xy_factor if inverse else value / xy_factor
+    return value
+
+
+def scale_cell(cell: Cell, xy_factor: int, inverse: bool = False) -> Cell:
+    """Map a cell to a coarse level, or back to full resolution if inverse is set."""
+    params = {name: _scale_value(name, value, xy_factor, inverse) if isinstance(value, float) else value
+              for name, value in cell.get_cell_params()}
+    return type(cell)(cell.paramClass(**params))
+
+
+def scale_cell_config(cell_config, xy_factor: int):
+    """Scale the size constraints of the cell config (e.g. minRadius) to a coarse level. Perturbation sigmas stay in coarse pixels."""
+    return cell_config.copy(update={
+        name: value / xy_factor for name, value in cell_config if name in LENGTH_PARAMETERS and isinstance(value, float)
+    })
@@ -0,0 +1,123 @@
+"""
+This module contains a differentiable renderer for spherical cells and the optimizer used to
+fit spheres to an image stack with analytic gradients.
+
+Each sphere is rendered with a smooth occupancy sigmoid((radius - distance) / edge_width),
+where distance is the 3D distance from the voxel (x, y, z) to the center of the sphere. The
+synthetic image is background + (cell - background) * sum of the occupancies, so the cost
+sum((real - synth)**2) has exact gradients with respect to the x, y, z and radius of every
+sphere, computed in one backward pass over each sphere's bounding box.
+"""
+
+from bisect import bisect_left, bisect_right
+from math import ceil, floor
+from typing import List
+
+import numpy as np
+import numpy.typing as npt
+
+
+class SoftSphereRasterizer:
+    """Renders spheres with sigmoid edges and computes the gradient of the L2 cost."""
+
+    def __init__(self, z_slices: List[float], shape, background_color: float, cell_color: float, edge_width: float = 1.0, margin: float = 4.0):
+        """
+        :param z_slices: The z value of each slice, in ascending order.
+        :param shape: The (z, y, x) shape of the image stack.
+        :param edge_width: The width of the sigmoid edge, in pixels.
+        :param margin: How many edge widths past the radius the bounding box of a sphere extends.
+        """
+        self.z_slices = list(z_slices)
+        self._z_values = np.asarray(z_slices, dtype=float)
+        self.shape = tuple(shape)
+        self.background_color = background_color
+        self.cell_color = cell_color
+        self.edge_width = edge_width
+        self.margin = margin
+
+    def _boxes(self, params: npt.NDArray):
+        """
+        Yields the index of each sphere with the (z, y, x) slices of its bounding box and the
+        offsets from the center of the sphere to every voxel in the box.
+        """
+        depth, height, width = self.shape
+        extent_margin = self.margin * self.edge_width
+        for i, (x, y, z, radius) in enumerate(params):
+            extent = radius + extent_margin
+            first = bisect_left(self.z_slices, z - extent)
+            last = bisect_right(self.z_slices, z + extent)
+            top, bottom = max(floor(y - extent), 0), min(ceil(y + extent) + 1, height)
+            left, right = max(floor(x - extent), 0), min(ceil(x + extent) + 1, width)
+            if first >= last or top >= bottom or left >= right:
+                continue
+            dz = (self._z_values[first:last] - z)[:, None, None]
+            dy = (np.arange(top, bottom) - y)[None, :, None]
+            dx = (np.arange(left, right) - x)[None, None, :]
+            yield i, (slice(first, last), slice(top, bottom), slice(left, right)), dx, dy, dz
+
+    def _occupancy(self, radius: float, dx, dy, dz):
+        distance = np.sqrt(dx ** 2 + dy ** 2 + dz ** 2)
+        occupancy = 1 / (1 + np.exp(-(radius - distance) / self.edge_width))
+        return occupancy, distance
+
+    def render(self, params: npt.NDArray):
+        """
+        Render the soft synthetic image stack.
+
+        :param params: An (n, 4) array with the x, y, z and radius of each sphere.
+        """
+        occupancy_sum = np.zeros(self.shape)
+        for i, box, dx, dy, dz in self._boxes(params):
+            occupancy, _ = self._occupancy(params[i, 3], dx, dy, dz)
+            occupancy_sum[box] += occupancy
+        return self.background_color + (self.cell_color - self.background_color) * occupancy_sum
+
+    def cost_and_gradient(self, params: npt.NDArray, real_image_stack: npt.NDArray):
+        """
+        Compute the soft L2 cost sum((real - synth)**2) and its gradient.
+
+        :param params: An (n, 4) array with the x, y, z and radius of each sphere.
+        :return: The cost and an (n, 4) array with its derivative with respect to each parameter.
+        """
+        residual = self.render(params) - real_image_stack
+        cost = float(np.square(residual).sum())
+
+        gradient = np.zeros_like(params, dtype=float)
+        scale = 2 * (self.cell_color - self.background_color) / self.edge_width
+        for i, box, dx, dy, dz in self._boxes(params):
+            occupancy, distance = self._occupancy(params[i, 3], dx, dy, dz)
+            # d cost / d (radius - distance), per voxel
+            weight = scale * residual[box] * occupancy * (1 - occupancy)
+            # d distance / d center = -(voxel - center) / distance
+            weight_over_distance = weight / np.maximum(distance, 1e-6)
+            gradient[i, 0] = (weight_over_distance * dx).sum()
+            gradient[i, 1] = (weight_over_distance * dy).sum()
+            gradient[i, 2] = (weight_over_distance * dz).sum()
+            gradient[i, 3] = weight.sum()
+        return cost, gradient
+
+
+class Adam:
+    """The Adam optimizer, stepping a parameter array against its gradient."""
+
+    def __init__(self, shape, learning_rate: float = 0.1, beta1: float = 0.9, beta2: float = 0.999, epsilon: float = 1e-8):
+        self.learning_rate = learning_rate
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+        self._m = np.zeros(shape)
+        self._v = np.zeros(shape)
+        self._t = 0
+
+    @property
+    def shape(self):
+        return self._m.shape
+
+    def step(self, gradient: npt.NDArray):
+        """Returns the change to apply to the parameters for the given gradient."""
+        self._t += 1
+        self._m = self.beta1 * self._m + (1 - self.beta1) * gradient
+        self._v = self.beta2 * self._v + (1 - self.beta2) * gradient ** 2
+        m_hat = self._m / (1 - self.beta1 ** self._t)
+        v_hat = self._v / (1 - self.beta2 ** self._t)
+        return -self.learning_rate * m_hat / (np.sqrt(v_hat) + self.epsilon)
@@ -0,0 +1,125 @@
+"""
+This module contains spatial indexes that let a Frame find the cells near a region without
+looping over every cell in the frame.
+"""
+
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from itertools import product
+from math import floor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .Cells import Cell
+
+
+class SliceIndex:
+    """Maps every z-slice of a frame to the cells that intersect it."""
+
+    def __init__(self, z_slices: List[float], cells: Iterable[Cell] = ()):
+        """
+        :param z_slices: The z value of every slice in the stack, in ascending order.
+        :param cells: The cells to index.
+        """
+        self.z_slices = list(z_slices)
+        self._buckets: List[Dict[int, Cell]] = [{} for _ in self.z_slices]
+        for cell in cells:
+            self.add(cell)
+
+    def slice_range(self, z_min: float, z_max: float) -> range:
+        """Returns the indices of the slices whose z value lies in [z_min, z_max]."""
+        return range(bisect_left(self.z_slices, z_min), bisect_right(self.z_slices, z_max))
+
+    def _cell_slices(self, cell: Cell) -> range:
+        min_corner, max_corner = cell.calculate_corners()
+        return self.slice_range(min_corner[2], max_corner[2])
+
+    def add(self, cell: Cell):
+        """Adds a cell to the buckets of every slice it intersects."""
+        for i in self._cell_slices(cell):
+            self._buckets[i][id(cell)] = cell
+
+    def remove(self, cell: Cell):
+        """Removes a cell from the buckets of every slice it intersects."""
+        for i in self._cell_slices(cell):
+            self._buckets[i].pop(id(cell), None)
+
+    def replace(self, old_cell: Cell, new_cell: Cell):
+        """Replaces a cell with another one, e.g. after a perturbation is accepted."""
+        self.remove(old_cell)
+        self.add(new_cell)
+
+    def cells_at(self, index: int) -> List[Cell]:
+        """Returns the cells that intersect the slice at the given index."""
+        return list(self._buckets[index].values())
+
+
+class NeighbourGrid:
+    """
+    A uniform grid of cell centers used to find the cells whose bounding boxes can intersect a
+    given cell's, without comparing it against every cell in the frame.
+    """
+
+    def __init__(self, cells: Iterable[Cell] = (), spacing: Optional[float] = None):
+        """
+        :param cells: The cells to index.
+        :param spacing: The side of a grid cell. Defaults to the largest cell diameter.
+        """
+        cells = list(cells)
+        if spacing is None:
+            spacing = 2 * max((self._bounds(cell)[1] for cell in cells), default=0.0)
+        self.spacing = spacing if spacing > 0 else 1.0
+        self._buckets: Dict[Tuple[int, int, int], Dict[int, Cell]] = defaultdict(dict)
+        self._max_extent = 0.0  # largest half-size of any cell added so far
+        for cell in cells:
+            self.add(cell)
+
+    @staticmethod
+    def _bounds(cell: Cell):
+        """Returns the center of a cell's bounding box and the largest distance from it to a side."""
+        min_corner, max_corner = cell.calculate_corners()
+        center = [(low + high) / 2 for low, high in zip(min_corner, max_corner)]
+        extent = max((high - low) / 2 for low, high in zip(min_corner, max_corner))
+        return center, extent
+
+    def _key(self, center: List[float]):
+        return tuple(floor(value / self.spacing) for value in center)
+
+    def add(self, cell: Cell):
+        center, extent = self._bounds(cell)
+        self._buckets[self._key(center)][id(cell)] = cell
+        self._max_extent = max(self._max_extent, extent)
+
+    def remove(self, cell: Cell):
+        key = self._key(self._bounds(cell)[0])
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket.pop(id(cell), None)
+            if not bucket:
+                del self._buckets[key]
+
+    def replace(self, old_cell: Cell, new_cell: Cell):
+        self.remove(old_cell)
+        self.add(new_cell)
+
+    def query(self, cell: Cell, margin: float = 0.0) -> List[Cell]:
+        """
+        Returns the indexed cells, other than the cell itself, whose bounding boxes intersect the
+        cell's, grown by margin on every side.
+        """
+        center, extent = self._bounds(cell)
+        reach = extent + self._max_extent + margin
+        low = self._key([value - reach for value in center])
+        high = self._key([value + reach for value in center])
+        min_corner, max_corner = cell.calculate_corners()
+        min_corner = [value - margin for value in min_corner]
+        max_corner = [value + margin for value in max_corner]
+
+        neighbours = []
+        for key in product(*(range(low[i], high[i] + 1) for i in range(3))):
+            for other in self._buckets.get(key, {}).values():
+                if other is cell:
+                    continue
+                other_min, other_max = other.calculate_corners()
+                if all(other_min[i] <= max_corner[i] and other_max[i] >= min_corner[i] for i in range(3)):
+                    neighbours.append(other)
+        return neighbours
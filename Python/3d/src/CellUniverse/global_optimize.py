@@ -3,6 +3,7 @@ import numpy as np
 import dask
 
 import optimization
+from .Proposals import ProposalStream
 from global_optimization.Changes import BackGroundLuminosityOffset, CameraShift, Combination, OpacityDiffractionOffset, Perturbation, Split
 from .utils import gerp
 from global_optimization.Modules import CellNodeM, FrameM, LineageM
@@ -114,6 +115,16 @@ def optimize_core(lineage: LineageM, window_start, window_end, start_temp, end_t
     opacity_diffraction_offset_prob = config["prob.opacity_diffraction_offset"]
     camera_shift_prob = config["prob.camera_shift"]
 
+    # pre-drawn random numbers for cell picks, move types, perturbations and acceptance tests
+    proposals = ProposalStream()
+    change_options = ["split", "perturbation", "combine", "background_offset", "opacity_diffraction_offset", "camera_shift"]
+
+    # optionally pick cells in proportion to the residual around them, with one sampler (and the
+    # bounds of the cells' simulated regions) per frame
+    residual_selection = config.get("selection.residualWeighted", False)
+    uniform_floor = config.get("selection.uniformFloor", 0.1)
+    samplers = {}
+
     run_iterations = min(current_iteration + batch_size, total_iterations)
     while current_iteration < run_iterations:
         frame_index = lineage.choose_random_frame_index(window_start - window_start * offset, window_end - window_start * offset)  # offset true for multithreading
@@ -124,7 +135,16 @@ def optimize_core(lineage: LineageM, window_start, window_end, start_temp, end_t
             frame_end_temp = gerp(end_temp, start_temp, (frame_index - window_start * (not offset)) / window)
             temperature = gerp(frame_start_temp, frame_end_temp, current_iteration / (total_iterations))
         frame = lineage.frames[frame_index]
-        node = np.random.choice(frame.nodes)
+        if residual_selection:
+            nodes = frame.nodes
+            if frame_index not in samplers or len(samplers[frame_index][0]) != len(nodes):
+                synth_stack, _, _, real_stack = lineage.get_frame_stacks_at_index(frame_index)
+                samplers[frame_index] = optimization.residual_sampler(nodes, real_stack, synth_stack, frame.simulation_config)
+            index = optimization.choose_cell_index(len(nodes), samplers[frame_index][0], uniform_floor, proposals)
+            node = nodes[index]
+        else:
+            nodes = frame.nodes
+            node = nodes[proposals.integer(len(nodes))]
         if node.cell.dormant:
             continue
 
@@ -140,14 +160,13 @@ def optimize_core(lineage: LineageM, window_start, window_end, start_temp, end_t
             print("Now the normalized probability is split_prob: %f, perturbation_prob: %f, combine_prob: %f, background_offset_prob: %f, opacity_diffraction_offset_prob: %f, camera_shift_prob: %f." % (split_prob, perturbation_prob, combine_prob, background_offset_prob, opacity_diffraction_offset_prob, camera_shift_prob))
             print();
             
-        change_option = np.random.choice(["split", "perturbation", "combine", "background_offset", "opacity_diffraction_offset", "camera_shift"],
-                                         p=[split_prob, perturbation_prob, combine_prob, background_offset_prob, opacity_diffraction_offset_prob, camera_shift_prob])
+        change_option = change_options[proposals.choice([split_prob, perturbation_prob, combine_prob, background_offset_prob, opacity_diffraction_offset_prob, camera_shift_prob])]
         change = None
-        if change_option == "split" and (np.random.random_sample() < optimization.split_proba_sin(node.cell.length, config["bacilli.minLength"], config["bacilli.maxLength"])) and not (window_start <= 0 and frame_index <= 0):
+        if change_option == "split" and (proposals.uniform() < optimization.split_proba_sin(node.cell.length, config["bacilli.minLength"], config["bacilli.maxLength"])) and not (window_start <= 0 and frame_index <= 0):
             change = Split(node.parent, config, realimages[frame_index], synthimages[frame_index], cellmaps[frame_index], lineage.frames[frame_index], distmaps[frame_index])
 
         elif change_option == "perturbation":
-            change = Perturbation(node, config, lineage.frames[frame_index])
+            change = Perturbation(node, config, lineage.frames[frame_index], proposals)
         #
         # elif change_option == "combine" and not (window_start <= 0 and frame_index <= 0):
         #     change = Combination(node.parent, config, realimages[frame_index], synthimages[frame_index], cellmaps[frame_index], lineage.frames[frame_index], distmaps[frame_index])
@@ -180,8 +199,23 @@ def optimize_core(lineage: LineageM, window_start, window_end, start_temp, end_t
                     circular_buffer[circular_buffer_cursor] = acceptance
                     circular_buffer_cursor = (circular_buffer_cursor + 1) % circular_buffer_capacity
 
-            if acceptance > np.random.random_sample():
+            if acceptance > proposals.uniform():
+                if residual_selection and isinstance(change, Perturbation):
+                    # the pixels that change lie in the old and the new region of the cell
+                    region = node.cell.simulated_region(frame.simulation_config).\
+                        union(change.replacement_cell.simulated_region(frame.simulation_config))
                 change.apply(lineage.get_frame_stacks_at_index(frame_index), lineage.z_slices)
+                if residual_selection:
+                    nodes = frame.nodes
+                    sampler, bounds = samplers[frame_index]
+                    if isinstance(change, Perturbation) and len(nodes) == len(sampler):
+                        # rescore the cell and every cell whose region overlaps the pixels it changed
+                        synth_stack, _, _, real_stack = lineage.get_frame_stacks_at_index(frame_index)
+                        bounds[index] = optimization.region_bounds(nodes[index].cell.simulated_region(frame.simulation_config),
+                                                                   real_stack[0].shape)
+                        optimization.update_residual_sampler(sampler, bounds, real_stack, synth_stack, region)
+                    else:
+                        del samplers[frame_index]  # rebuilt on the next pick from this frame
                 # if type(change) == Split:
                 #     total_iterations += iteration_per_cell
 
@@ -0,0 +1,78 @@
+"""
+Benchmarks the batched whole-stack sphere renderer against rendering one slice at a time,
+and checks that both produce the same pixels.
+
+Usage: python render_benchmark.py [cell counts...]
+"""
+import sys
+import time
+
+import numpy as np
+
+from CellUniverse.Cells import Sphere
+from CellUniverse.Cells.Sphere import SphereParams
+from CellUniverse.Config import SimulationConfig
+from CellUniverse.Frame import Frame
+
+
+def make_frame(cell_count: int, rng: np.random.Generator):
+    # keep the density of cells roughly constant as the colony grows
+    size = int(max(64, 12 * np.sqrt(cell_count)))
+    depth = 33
+    simulation_config = SimulationConfig(iterations_per_cell=1, background_color=0.1, cell_color=0.8)
+    simulation_config.z_slices = depth
+
+    cells = [Sphere(SphereParams(
+        name=str(i),
+        x=rng.uniform(0, size),
+        y=rng.uniform(0, size),
+        z=rng.uniform(-depth / 2, depth / 2),
+        radius=rng.uniform(2, 8),
+    )) for i in range(cell_count)]
+    return Frame(np.zeros((depth, size, size)), simulation_config, cells, None, 'benchmark')
+
+
+def render_stack(frame: Frame):
+    """Render the cells of the frame, rasterizing the whole stack at once."""
+    shape = (len(frame.z_slices),) + tuple(frame.get_image_shape())
+    synth_image_stack = np.full(shape, frame.simulation_config.background_color)
+    if frame.cells:
+        type(frame.cells[0]).draw_stack(frame.cells, synth_image_stack, frame.simulation_config, frame.z_slices)
+    return synth_image_stack
+
+
+def render_by_slice(frame: Frame):
+    """Render the cells of the frame one slice at a time. Used as a reference for render_stack."""
+    shape = frame.get_image_shape()
+    synth_image_stack = []
+    for i, z in enumerate(frame.z_slices):
+        synth_image = np.full(shape, frame.simulation_config.background_color)
+        for cell in frame.slice_index.cells_at(i):
+            cell.draw(synth_image, frame.simulation_config, z = z)
+        synth_image_stack.append(synth_image)
+    return np.array(synth_image_stack)
+
+
+def benchmark(function, repeat: int = 3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(cell_counts):
+    rng = np.random.default_rng(0)
+    print(f"{'cells':>6} {'stack':>16} {'by slice (s)':>13} {'batched (s)':>12} {'speedup':>8}  match")
+    for cell_count in cell_counts:
+        frame = make_frame(cell_count, rng)
+        slice_time, by_slice = benchmark(lambda: render_by_slice(frame))
+        batched_time, batched = benchmark(lambda: render_stack(frame))
+        shape = 'x'.join(map(str, batched.shape))
+        print(f'{cell_count:>6} {shape:>16} {slice_time:>13.4f} {batched_time:>12.4f} '
+              f'{slice_time / batched_time:>7.1f}x  {np.array_equal(by_slice, batched)}')
+
+
+if __name__ == '__main__':
+    main([int(count) for count in sys.argv[1:]] or [10, 100, 500, 1000, 5000])
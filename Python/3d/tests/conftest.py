@@ -0,0 +1,18 @@
+"""
+Shared fixtures for the tests of the 3D pipeline. The CellUniverse package is imported from
+Python/3d/src, the way the scripts in that directory import it.
+"""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+
+@pytest.fixture(autouse=True)
+def seeded_random():
+    """Seed np.random, which the frames' proposal streams are seeded from."""
+    np.random.seed(0)
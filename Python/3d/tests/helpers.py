@@ -0,0 +1,129 @@
+"""
+Helpers shared by the tests: small sphere configs, random colonies and frames built from them.
+"""
+
+import csv
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import typed_argparse as tap
+import yaml
+from PIL import Image
+
+from CellUniverse.Args import Args
+from CellUniverse.Cells import Sphere
+from CellUniverse.Cells.Sphere import SphereParams
+from CellUniverse.Config.Config import SphereBaseConfig
+from CellUniverse.Frame import Frame
+
+
+def sphere_config_values(**simulation):
+    """The values of a small sphere config, with the simulation settings overridden by simulation."""
+    return {
+        'cellType': 'sphere',
+        'cell': {
+            'x': {'prob': 1, 'mu': 0, 'sigma': 1},
+            'y': {'prob': 1, 'mu': 0, 'sigma': 1},
+            'z': {'prob': 1, 'mu': 0, 'sigma': 0.5},
+            'radius': {'prob': 1, 'mu': 0, 'sigma': 0.3},
+            'minRadius': 2,
+            'maxRadius': 12,
+        },
+        'simulation': {'iterations_per_cell': 20, 'background_color': 0.1, 'cell_color': 0.8, 'padding': 2,
+                       **simulation},
+        'prob': {'perturbation': 0.8, 'split': 0.2},
+    }
+
+
+def make_config(depth=9, **simulation):
+    """
+    A sphere config for stacks of depth slices. Sphere reads its perturbation settings from the
+    class, so they are set too.
+    """
+    config = SphereBaseConfig(**sphere_config_values(**simulation))
+    config.simulation.z_slices = depth
+    Sphere.cellConfig = config.cell
+    return config
+
+
+def make_cells(count, shape=(64, 64), depth=9, seed=0, min_radius=3, max_radius=6):
+    """Random spheres inside the image that do not overlap each other."""
+    rng = np.random.default_rng(seed)
+    cells = []
+    while len(cells) < count:
+        cell = Sphere(SphereParams(name=str(len(cells)), x=rng.uniform(5, shape[1] - 5), y=rng.uniform(5, shape[0] - 5),
+                                   z=rng.uniform(-depth / 2, depth / 2), radius=rng.uniform(min_radius, max_radius)))
+        if Sphere.check_if_cells_valid(cells + [cell]):
+            cells.append(cell)
+    return cells
+
+
+def render(config, cells, shape=(64, 64)):
+    """The unpadded synthetic image stack of some cells, to use as a real image."""
+    padding = config.simulation.padding
+    frame = Frame(np.zeros((config.simulation.z_slices,) + shape), config.simulation, cells, None, 'truth')
+    return np.array(frame.synth_image_stack[:, padding:-padding, padding:-padding])
+
+
+def make_frame(count=20, shape=(64, 64), seed=0, **simulation):
+    """A frame whose real images show one colony and whose cells start as another one."""
+    config = make_config(**simulation)
+    depth = config.simulation.z_slices
+    real_image_stack = render(config, make_cells(count, shape, depth, seed), shape)
+    frame = Frame(real_image_stack, config.simulation, make_cells(count, shape, depth, seed + 1), None, 'frame.tif')
+    return config, frame
+
+
+def full_cost(frame, cells=None):
+    """The cost of the frame, or of other cells on its images, computed from scratch without the incremental bookkeeping."""
+    if cells is None:
+        coverage = frame.generate_coverage()
+    else:
+        coverage = np.zeros(frame.coverage_stack.shape, dtype=frame.coverage_stack.dtype)
+        type(cells[0]).count_stack(cells, coverage, frame.simulation_config, frame.z_slices)
+    residual = np.square(frame.real_image_stack - frame.synth_from_coverage(coverage)).sum()
+    return float(np.sqrt(residual)) + frame.simulation_config.overlap_cost * frame.count_overlap(coverage)
+
+
+
+def write_dataset(directory: Path, frames=3, count=6, shape=(48, 48), depth=9, **sections) -> List[str]:
+    """
+    Write a colony drifting by a pixel per frame as TIFF stacks, its initial cells and a config,
+    with the config sections overridden by sections, and return the arguments to run on them.
+    """
+    values = sphere_config_values(iterations_per_cell=10)
+    for name, section in sections.items():
+        values[name] = {**values.get(name, {}), **section}
+    with open(directory / 'config.yaml', 'w') as file:
+        yaml.safe_dump(values, file)
+
+    config = make_config(depth)
+    cells = make_cells(count, shape, depth)
+    for t in range(frames):
+        moved = [Sphere(cell.get_cell_params().copy(update={'x': cell.get_cell_params().x + t})) for cell in cells]
+        stack = (render(config, moved, shape) * 255).astype(np.uint8)
+        slices = [Image.fromarray(image) for image in stack]
+        slices[0].save(directory / f'frame{t:03d}.tif', save_all=True, append_images=slices[1:])
+
+    with open(directory / 'initial.csv', 'w', newline='') as file:
+        writer = csv.DictWriter(file, ['file', 'name', 'x', 'y', 'z', 'radius'])
+        writer.writeheader()
+        for cell in cells:
+            params = cell.get_cell_params()
+            # the initial z is measured from the first slice
+            writer.writerow(dict(params, file='frame000.tif', z=params.z + depth // 2))
+
+    return ['-i', str(directory / 'frame%03d.tif'), '-c', str(directory / 'config.yaml'),
+            '-I', str(directory / 'initial.csv'), '-st', '1', '-et', '0.1']
+
+
+def parse_args(arguments: List[str]) -> Args:
+    """Parse command-line arguments the way the CellUniverse scripts do."""
+    parsed = []
+
+    def main(args: Args):
+        parsed.append(args)
+
+    tap.Parser(Args).bind(main).run(arguments)
+    return parsed[0]
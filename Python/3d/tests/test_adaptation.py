@@ -0,0 +1,67 @@
+import json
+from math import log
+
+import numpy as np
+import pytest
+
+from CellUniverse.Adaptation import StepSizeAdapter
+from CellUniverse.Cells import Sphere
+from CellUniverse.Cells.Sphere import SphereParams
+from CellUniverse.Config import AdaptationConfig
+
+from helpers import make_config
+
+
+def sphere(name='a', x=10.0, radius=4.0):
+    return Sphere(SphereParams(name=name, x=x, y=10.0, z=0.0, radius=radius))
+
+
+@pytest.mark.parametrize('initial_scale', [0.2, 1.0, 10.0])
+def test_scale_moves_toward_the_target_acceptance_rate(initial_scale):
+    """A move is accepted with probability exp(-scale), so the target rate is reached at scale = -log(target)."""
+    config = make_config()
+    adaptation = AdaptationConfig(learning_rate=0.02, log_interval=0)
+    adapter = StepSizeAdapter(adaptation, config.cell)
+    adapter.set_state({'scales': {**adapter.scales, 'x': initial_scale}, 'cell_scales': {}})
+    rng = np.random.default_rng(0)
+    scales = []
+    for _ in range(8000):
+        scale = adapter.scales['x']
+        adapter.record(sphere(), sphere(x=11.0), bool(rng.uniform() < np.exp(-scale)))
+        scales.append(scale)
+    assert np.mean(scales[-3000:]) == pytest.approx(-log(adaptation.target_acceptance), rel=0.1)
+    # only the changed parameter adapts
+    assert adapter.scales['radius'] == 1.0
+    assert adapter.acceptance_rates()['radius'] is None
+
+
+def test_scale_is_clamped():
+    adapter = StepSizeAdapter(AdaptationConfig(learning_rate=1.0, min_scale=0.5, max_scale=2.0, log_interval=0), make_config().cell)
+    for _ in range(50):
+        adapter.record(sphere(), sphere(x=11.0), True)
+    assert adapter.scales['x'] == 2.0
+    for _ in range(50):
+        adapter.record(sphere(), sphere(x=11.0), False)
+    assert adapter.scales['x'] == 0.5
+
+
+def test_state_round_trips_through_json():
+    """The state goes into the JSON header of a checkpoint."""
+    cell_config = make_config().cell
+    adaptation = AdaptationConfig(per_cell=True, log_interval=0)
+    adapter = StepSizeAdapter(adaptation, cell_config)
+    rng = np.random.default_rng(1)
+    for _ in range(200):
+        name = str(rng.integers(3))
+        adapter.record(sphere(name), sphere(name, x=11.0, radius=4.0 + rng.uniform()), bool(rng.uniform() < 0.3))
+
+    restored = StepSizeAdapter(adaptation, cell_config)
+    restored.set_state(json.loads(json.dumps(adapter.get_state())))
+    assert restored.get_state() == adapter.get_state()
+    assert restored.scales_for(sphere('1')) == adapter.scales_for(sphere('1'))
+
+    # both continue the same way
+    for accepted in [True, False, False, True]:
+        adapter.record(sphere('2'), sphere('2', x=12.0), accepted)
+        restored.record(sphere('2'), sphere('2', x=12.0), accepted)
+    assert restored.get_state() == adapter.get_state()
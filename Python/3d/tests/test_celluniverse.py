@@ -0,0 +1,33 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from CellUniverse.CellUniverse import CellUniverse
+
+from helpers import parse_args, write_dataset
+
+
+@pytest.mark.parametrize('parallel', [[], ['-w', '2']])
+def test_one_chain_by_default_without_a_pool(tmp_path, parallel):
+    arguments = write_dataset(tmp_path, frames=2) + ['-o', str(tmp_path / 'output')] + parallel
+    universe = CellUniverse(parse_args(arguments))
+    assert universe.chains == 1
+    assert universe.executor is None
+    universe.run()
+    assert (tmp_path / 'output' / 'cells.csv').exists()
+
+
+def test_chains_run_on_a_process_pool(tmp_path, capsys):
+    arguments = write_dataset(tmp_path, frames=2) + ['-o', str(tmp_path / 'output'), '-w', '2', '-j', '2']
+    universe = CellUniverse(parse_args(arguments))
+    assert universe.chains == 2
+    assert isinstance(universe.executor, ProcessPoolExecutor)
+    universe.run()
+    assert capsys.readouterr().out.count('kept the best of 2 chains') == 2
+
+
+def test_image_cache_reports_hits_and_misses(tmp_path, capsys):
+    arguments = write_dataset(tmp_path, frames=2) + ['--cache-dir', str(tmp_path / 'cache')]
+    for output, expected in [('first', '0 hits, 2 misses'), ('second', '2 hits, 0 misses')]:
+        CellUniverse(parse_args(arguments + ['-o', str(tmp_path / output)])).run()
+        assert f'Image cache: {expected}' in capsys.readouterr().out
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from CellUniverse.CellUniverse import CellUniverse
+from CellUniverse.Cells import Sphere
+from CellUniverse.Checkpoint import Checkpoint, find_checkpoints, load_checkpoint, save_checkpoint
+from CellUniverse.Convergence import OptimizationResult
+from CellUniverse.Lineage import Lineage
+from CellUniverse.Proposals import ProposalStream
+
+from helpers import make_cells, make_config, parse_args, write_dataset
+
+
+def test_checkpoint_round_trip(tmp_path):
+    make_config()
+    np.random.seed(3)
+    stream = ProposalStream(np.random.default_rng(4))
+    stream.uniforms(10)
+    checkpoint = Checkpoint(
+        frame_index=2,
+        image_name='frame002.tif',
+        config_hash='abc',
+        cell_params=[cell.get_cell_params() for cell in make_cells(5)],
+        numpy_state=np.random.get_state(),
+        proposal_states={3: stream.get_state()},
+        step_sizes={'scales': {'x': 0.5}, 'cell_scales': {'1': {'radius': 2.0}}},
+        result=OptimizationResult(100, 1.5, 'converged'),
+        predicted=True,
+    )
+    save_checkpoint(tmp_path, checkpoint)
+    loaded = load_checkpoint(find_checkpoints(tmp_path)[0], Sphere)
+
+    assert loaded.cell_params == checkpoint.cell_params
+    assert loaded._replace(cell_params=None, numpy_state=None) == checkpoint._replace(cell_params=None, numpy_state=None)
+    np.random.set_state(checkpoint.numpy_state)
+    expected = np.random.random(5)
+    np.random.set_state(loaded.numpy_state)
+    assert np.array_equal(np.random.random(5), expected)
+
+
+def run(directory, output, *extra):
+    arguments = write_dataset(directory, frames=4) + ['-o', str(directory / output), '-s', '5', *extra]
+    CellUniverse(parse_args(arguments)).run()
+    return (directory / output / 'cells.csv').read_text()
+
+
+def test_same_seed_gives_the_same_run(tmp_path):
+    assert run(tmp_path, 'first') == run(tmp_path, 'second')
+    assert run(tmp_path, 'first') != run(tmp_path, 'other', '-s', '6')
+
+
+@pytest.mark.parametrize('crashed_frame', [0, 2])
+def test_resumed_run_matches_a_straight_run(tmp_path, monkeypatch, capsys, crashed_frame):
+    straight = run(tmp_path, 'straight')
+
+    write_checkpoint = Lineage.write_checkpoint
+
+    def crash(self, checkpoint):
+        write_checkpoint(self, checkpoint)
+        if checkpoint.frame_index == crashed_frame:
+            raise RuntimeError('crash')
+
+    monkeypatch.setattr(Lineage, 'write_checkpoint', crash)
+    with pytest.raises(RuntimeError, match='crash'):
+        run(tmp_path, 'resumed')
+    monkeypatch.setattr(Lineage, 'write_checkpoint', write_checkpoint)
+    capsys.readouterr()
+
+    assert run(tmp_path, 'resumed', '--resume') == straight
+    assert f'Resuming after frame {crashed_frame}' in capsys.readouterr().out
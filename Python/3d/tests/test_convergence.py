@@ -0,0 +1,48 @@
+import pytest
+
+from CellUniverse.Config import ConvergenceConfig
+from CellUniverse.Convergence import ConvergenceMonitor
+
+
+def stop(config, costs, accepted=None, initial_cost=100.0):
+    """Record the costs until the monitor stops. Returns the number of iterations and the stop reason."""
+    monitor = ConvergenceMonitor(config, initial_cost)
+    for i, cost in enumerate(costs):
+        monitor.record(accepted[i] if accepted is not None else True, cost)
+        if monitor.stop_reason is not None:
+            return monitor.iterations, monitor.stop_reason
+    return monitor.iterations, None
+
+
+def test_without_a_config_it_never_stops():
+    assert stop(None, [100.0] * 5000) == (5000, None)
+
+
+def test_stops_once_the_cost_plateaus_for_a_window():
+    costs = [100.0 - i for i in range(1, 21)] + [80.0] * 30
+    iterations, reason = stop(ConvergenceConfig(window=10, tolerance=1e-3), costs)
+    # the window holds the last improvement until 10 flat iterations have followed it
+    assert iterations == 30
+    assert reason.startswith('converged: cost improved by')
+
+
+def test_a_small_steady_improvement_counts_as_a_plateau():
+    costs = [100.0 - 0.001 * i for i in range(1, 101)]
+    assert stop(ConvergenceConfig(window=10, tolerance=1e-3), costs)[0] == 10
+    assert stop(ConvergenceConfig(window=10, tolerance=1e-5), costs) == (100, None)
+
+
+def test_never_stops_before_the_window_or_min_iterations():
+    assert stop(ConvergenceConfig(window=25, tolerance=1e-3), [100.0] * 100)[0] == 25
+    assert stop(ConvergenceConfig(window=25, tolerance=1e-3, min_iterations=60), [100.0] * 100)[0] == 60
+
+
+def test_stops_when_too_few_moves_are_accepted():
+    costs = [100.0 - i for i in range(1, 101)]
+    accepted = [True] * 20 + [i % 10 == 0 for i in range(80)]
+    config = ConvergenceConfig(window=20, tolerance=1e-3, min_acceptance=0.2)
+    iterations, reason = stop(config, costs, accepted)
+    # the window first holds fewer than 4 accepted moves after iteration 39
+    assert iterations == 39
+    assert reason == 'converged: acceptance rate 15.00% over the last 20 iterations'
+    assert stop(config.copy(update={'min_acceptance': 0.0}), costs, accepted) == (100, None)
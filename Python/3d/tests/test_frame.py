@@ -0,0 +1,205 @@
+import warnings
+from collections import defaultdict
+
+import numpy as np
+import pytest
+
+from CellUniverse.Cells import Sphere
+from CellUniverse.Cells.Sphere import SphereParams
+
+from CellUniverse.Frame import Frame
+from CellUniverse.Proposals import ProposalStream
+
+from helpers import full_cost, make_cells, make_config, make_frame, render
+
+
+def draw_by_slice(cells, config, shape, z_slices):
+    """Draw the cells one slice at a time with Sphere.draw, the reference for Sphere.draw_stack."""
+    stack = np.full(shape, config.simulation.background_color)
+    for image, z in zip(stack, z_slices):
+        for cell in cells:
+            cell.draw(image, config.simulation, z=z)
+    return stack
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_draw_stack_matches_drawing_each_slice(seed):
+    """Includes spheres cut off by the sides, top and bottom of the stack and by its padding."""
+    config = make_config()
+    rng = np.random.default_rng(seed)
+    shape = (config.simulation.z_slices, 40, 50)
+    z_slices = [z - shape[0] // 2 for z in range(shape[0])]
+    cells = [Sphere(SphereParams(name=str(i), x=rng.uniform(-6, shape[2] + 6), y=rng.uniform(-6, shape[1] + 6),
+                                 z=rng.uniform(-8, 8), radius=rng.uniform(1, 8))) for i in range(40)]
+
+    stack = np.full(shape, config.simulation.background_color)
+    Sphere.draw_stack(cells, stack, config.simulation, z_slices)
+    expected = draw_by_slice(cells, config, shape, z_slices)
+    assert np.array_equal(stack, expected)
+
+    # a box inside the stack, as drawn by the incremental updates
+    region = (slice(2, 7), slice(5, 30), slice(10, 45))
+    box = np.full(stack[region].shape, config.simulation.background_color)
+    Sphere.draw_stack(cells, box, config.simulation, z_slices[region[0]], origin=(region[1].start, region[2].start))
+    assert np.array_equal(box, expected[region])
+
+
+def test_frame_coverage_matches_drawing_each_slice():
+    """The coverage of a padded frame covers the same voxels as drawing every slice."""
+    config, frame = make_frame(count=30, shape=(48, 48))
+    shape = frame.coverage_stack.shape
+    expected = draw_by_slice(frame.cells, config, shape, frame.z_slices)
+    assert shape[1:] == (48 + 2 * config.simulation.padding,) * 2
+    assert np.array_equal(frame.coverage_stack > 0, expected != config.simulation.background_color)
+
+
+def test_rejected_split_keeps_cells_and_order():
+    _, frame = make_frame()
+    cells = list(frame.cells)
+    synth = np.array(frame.synth_image_stack)
+    cost = frame.cost
+    for _ in range(50):
+        _, callback = frame.split()
+        callback(False)
+        assert frame.cells == cells
+        assert np.array_equal(frame.synth_image_stack, synth)
+        assert frame.cost == cost
+
+
+def test_accepted_split_replaces_parent_by_children():
+    _, frame = make_frame(count=5, shape=(96, 96))
+    for _ in range(100):
+        names = [cell.get_cell_params().name for cell in frame.cells]
+        _, callback = frame.split()
+        callback(True)
+        if len(frame.cells) == len(names):  # the split was invalid
+            continue
+        children = [cell.get_cell_params().name for cell in frame.cells[-2:]]
+        parent = children[0][:-1]
+        assert children == [parent + '0', parent + '1']
+        assert sorted(name for name in names if name != parent) == sorted(cell.get_cell_params().name for cell in frame.cells[:-2])
+        return
+    pytest.fail('no valid split was proposed')
+
+
+def test_split_and_perturbation_only_draw_from_the_proposal_stream():
+    make_config()
+    cell = make_cells(1)[0]
+    draws = []
+    for seed in (0, 1):
+        np.random.seed(seed)
+        proposals = ProposalStream(np.random.default_rng(7))
+        cells = [cell.get_perturbed_cell(proposals), *cell.get_split_cells(proposals)[:2]]
+        draws.append([new_cell.get_cell_params() for new_cell in cells])
+    assert draws[0] == draws[1]
+
+
+def test_neighbour_grid_check_matches_all_pairs_check():
+    """The overlap check against the grid neighbours accepts the same changes as checking all pairs of cells."""
+    _, frame = make_frame(count=40, shape=(48, 48))
+    rng = np.random.default_rng(1)
+    outcomes = set()
+    for _ in range(2000):
+        index = int(rng.integers(len(frame.cells)))
+        old_cell = frame.cells[index]
+        if rng.uniform() < 0.5:
+            added = [old_cell.get_perturbed_cell(frame.proposal_stream, {'x': 3, 'y': 3, 'z': 3, 'radius': 3})]
+        else:
+            child1, child2, _ = old_cell.get_split_cells(frame.proposal_stream)
+            added = [child1, child2]
+        others = frame.cells[:index] + frame.cells[index + 1:]
+
+        valid = frame._is_valid_change([old_cell], added)
+        assert valid == Sphere.check_if_cells_valid(others + added)
+        outcomes.add(valid)
+
+        # move the frame on so the checks see many configurations
+        if valid and len(added) == 1:
+            frame._replace_cell(index, added[0])
+    assert outcomes == {True, False}
+
+
+@pytest.mark.parametrize('overlap_cost', [0.0, 0.5])
+def test_incremental_cost_matches_full_recompute(overlap_cost):
+    _, frame = make_frame(overlap_cost=overlap_cost, cost_recompute_interval=10 ** 9, proposals_per_move=1)
+    rng = np.random.default_rng(2)
+    for i in range(600):
+        proposals = 3 if i % 3 == 0 else 1
+        cost_diff, callback = frame.split() if i % 10 == 0 else frame.perturb(proposals)
+        callback(bool(rng.uniform() < 0.5))
+    assert frame.cost == pytest.approx(full_cost(frame), rel=1e-9)
+    assert np.array_equal(frame.synth_image_stack, frame.synth_from_coverage(frame.generate_coverage()))
+    assert np.array_equal(frame.coverage_stack, frame.generate_coverage())
+
+
+
+@pytest.mark.parametrize('temperature', [1e-6, 0.05, 1.0])
+def test_multiple_try_metropolis_keeps_the_incremental_cost(temperature):
+    """At low temperatures every weight of a set underflows, which must not produce an infinite cost difference."""
+    _, frame = make_frame(cost_recompute_interval=10 ** 9)
+    accepted = 0
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        for _ in range(300):
+            cost_diff, callback = frame.perturb(4, temperature)
+            assert np.isfinite(cost_diff)
+            accept = np.exp(min(-cost_diff / temperature, 0)) > frame.proposal_stream.uniform()
+            accepted += accept
+            callback(accept)
+    assert accepted > 0
+    assert frame.cost == pytest.approx(full_cost(frame), rel=1e-9)
+    assert np.array_equal(frame.coverage_stack, frame.generate_coverage())
+
+
+
+@pytest.mark.parametrize('overlap_cost', [0.0, 0.5])
+def test_finite_differences_in_the_cell_box_match_the_full_stack(overlap_cost):
+    """The costs gradient_descent differentiates are scored in the box around a cell only."""
+    _, frame = make_frame(count=15, shape=(40, 40), overlap_cost=overlap_cost)
+    for index in range(0, len(frame.cells), 3):
+        cell = frame.cells[index]
+        params = dict(cell.get_cell_params())
+        for nudge in (1, 0.3, -2):
+            expected = {}
+            for name in ('x', 'y', 'z', 'radius'):
+                moved = cell.get_paramaterized_cell(defaultdict(float, {name: nudge}))
+                expected[name] = full_cost(frame, frame.cells[:index] + [moved] + frame.cells[index + 1:])
+                assert frame._cost_of_perterb(name, nudge, index, cell) == pytest.approx(expected[name], rel=1e-9)
+            assert frame._get_perterbed_costs(index, params, nudge, cell) == pytest.approx(expected, rel=1e-9)
+
+
+@pytest.mark.parametrize('learning_rate', [0.1, 5.0])
+def test_analytic_gradient_descent_never_raises_the_cost(learning_rate):
+    _, frame = make_frame(count=10, algorithm='gradient descent', gradient_learning_rate=learning_rate, gradient_steps=5)
+    for _ in range(5):
+        cells, cost = list(frame.cells), frame.cost
+        new_cost = frame.analytic_gradient_descent()
+        assert new_cost <= cost
+        assert new_cost == pytest.approx(full_cost(frame))
+        if new_cost == cost:
+            assert frame.cells == cells
+
+
+def test_analytic_gradient_descent_never_makes_cells_overlap():
+    """The real image shows two overlapping spheres, which the gradient pulls the cells towards."""
+    config = make_config(algorithm='gradient descent', gradient_learning_rate=1.0, gradient_steps=5)
+    truth = [Sphere(SphereParams(name='a', x=29.0, y=32.0, z=0.0, radius=6.0)),
+             Sphere(SphereParams(name='b', x=35.0, y=32.0, z=0.0, radius=6.0))]
+    cells = [Sphere(SphereParams(name='a', x=22.0, y=32.0, z=0.0, radius=5.0)),
+             Sphere(SphereParams(name='b', x=42.0, y=32.0, z=0.0, radius=5.0))]
+    frame = Frame(render(config, truth), config.simulation, list(cells), None, 'frame.tif')
+    moved = False
+    for _ in range(20):
+        frame.analytic_gradient_descent()
+        assert Sphere.check_if_cells_valid(frame.cells)
+        moved = moved or frame.cells != cells
+    assert moved
+
+
+def test_analytic_gradient_descent_keeps_an_exact_fit():
+    """The soft edges pull the spheres away from an exact fit, which would raise the hard cost."""
+    config = make_config(algorithm='gradient descent', gradient_steps=5, gradient_edge_width=3.0)
+    cells = make_cells(10)
+    frame = Frame(render(config, cells), config.simulation, list(cells), None, 'frame.tif')
+    assert frame.analytic_gradient_descent() == 0
+    assert frame.cells == cells
@@ -0,0 +1,63 @@
+from pathlib import Path
+
+import numpy as np
+
+from CellUniverse.Adaptation import StepSizeAdapter
+from CellUniverse.Config import AdaptationConfig
+from CellUniverse.FrameStore import FrameState, FrameStore
+
+from helpers import make_cells, make_config, render
+
+
+def make_store(frames=4, window=2):
+    """A store over frames rendered in memory. Returns it and the number of times each image was decoded."""
+    config = make_config()
+    cells = make_cells(6, shape=(48, 48))
+    stacks = [render(config, cells, (48, 48)) for _ in range(frames)]
+    loads = [0] * frames
+
+    def load_image(image_path, config):
+        index = int(image_path.stem)
+        loads[index] += 1
+        return list(stacks[index])
+
+    states = [FrameState(list(cells), StepSizeAdapter(AdaptationConfig(), config.cell), None) for _ in range(frames)]
+    store = FrameStore([Path(f'{i}.tif') for i in range(frames)], config, Path('output'), states, load_image, window)
+    return store, loads
+
+
+def test_window_evicts_frames_and_their_memory_maps():
+    store, loads = make_store(frames=5, window=2)
+    for index in range(5):
+        store[index]
+        assert len(store._frames) <= 2
+        assert set(store._stacks) == set(store._frames)
+    assert list(store._frames) == [3, 4]
+    assert loads == [1] * 5
+    store.close()
+
+
+def test_released_frame_rebuilds_with_the_same_state():
+    store, loads = make_store(window=1)
+    frame = store[0]
+    for _ in range(20):
+        _, accept = frame.perturb(1)
+        accept(True)
+    frame.proposal_stream.uniform()
+    cells, step_sizes, stream = list(frame.cells), frame.step_sizes, frame.proposal_stream
+    real_image_stack = np.array(frame.real_image_stack)
+    stream_state = stream.get_state()
+
+    store[1]
+    assert 0 not in store._frames and 0 not in store._stacks
+
+    rebuilt = store[0]
+    assert rebuilt is not frame
+    assert rebuilt.cells == cells
+    assert rebuilt.step_sizes is step_sizes
+    assert rebuilt.proposal_stream is stream and stream.get_state() == stream_state
+    assert np.array_equal(rebuilt.real_image_stack, real_image_stack)
+    assert rebuilt.cost == frame.cost
+    # the stack is reopened from its .npy file rather than decoded again
+    assert loads == [1, 1, 0, 0]
+    store.close()
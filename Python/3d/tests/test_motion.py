@@ -0,0 +1,39 @@
+import pytest
+
+from CellUniverse.Cells import Sphere
+from CellUniverse.Cells.Sphere import SphereParams
+from CellUniverse.Config import MotionConfig
+from CellUniverse.Motion import MotionPredictor
+
+
+def sphere(name, x):
+    return Sphere(SphereParams(name=name, x=x, y=20.0, z=0.0, radius=4.0))
+
+
+@pytest.mark.parametrize('model', ['constant velocity', 'kalman'])
+def test_children_of_a_split_inherit_the_parent_velocity(model):
+    motion = MotionPredictor(MotionConfig(model=model))
+    for x in (10.0, 12.0, 14.0):
+        motion.observe([sphere('a', x), sphere('b', 40.0)])
+
+    # the frame where a splits
+    children = [sphere('a0', 15.0), sphere('a1', 17.0)]
+    motion.observe(children + [sphere('b', 40.0)])
+    predicted = [cell.get_cell_params().x for cell in motion.predict(children)]
+    if model == 'constant velocity':
+        assert predicted == pytest.approx([17.0, 19.0])
+    else:
+        assert predicted[0] > 15.0 and predicted[1] > 17.0
+
+
+def test_parent_is_forgotten_once_its_children_have_a_velocity():
+    motion = MotionPredictor(MotionConfig())
+    for x in (10.0, 12.0):
+        motion.observe([sphere('a', x)])
+    motion.observe([sphere('a0', 13.0), sphere('a1', 15.0)])
+    assert 'a' in motion.history
+
+    motion.observe([sphere('a0', 13.0), sphere('a1', 15.0)])
+    assert 'a' not in motion.history
+    predicted = [cell.get_cell_params().x for cell in motion.predict([sphere('a0', 13.0), sphere('a1', 15.0)])]
+    assert predicted == pytest.approx([13.0, 15.0])
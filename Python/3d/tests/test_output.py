@@ -0,0 +1,77 @@
+import csv
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from CellUniverse.Cells.Sphere import SphereParams
+from CellUniverse.Config import OutputConfig
+from CellUniverse.Output import CellsWriter, OutputReader, create_image_writer
+
+
+@pytest.mark.parametrize('format', ['png', 'tiff', 'npy'])
+def test_output_reader_reads_what_was_written(tmp_path, format):
+    rng = np.random.default_rng(0)
+    frames = [(rng.integers(0, 256, (3, 8, 10, 3), dtype=np.uint8), rng.integers(0, 256, (3, 8, 10), dtype=np.uint8))
+              for _ in range(2)]
+    writer = create_image_writer(OutputConfig(format=format), tmp_path, len(frames))
+    for frame_index, (real, synth) in reversed(list(enumerate(frames))):
+        writer.write(frame_index, [Image.fromarray(image) for image in real], [Image.fromarray(image) for image in synth])
+    writer.close()
+
+    reader = OutputReader(tmp_path)
+    assert reader.format == format
+    assert reader.frames() == [0, 1]
+    for frame_index, (real, synth) in enumerate(frames):
+        assert np.array_equal(reader.real(frame_index), real)
+        assert np.array_equal(reader.synth(frame_index), synth)
+    with pytest.raises(ValueError):
+        reader.read('residual', 0)
+
+
+def test_output_reader_without_images(tmp_path):
+    with pytest.raises(ValueError):
+        OutputReader(tmp_path)
+
+
+def spheres(*names):
+    return [SphereParams(name=name, x=1.0, y=2.0, z=0.0, radius=3.0) for name in names]
+
+
+def read_cells(path):
+    with open(path, newline='') as file:
+        return [(row['file'], row['name']) for row in csv.DictReader(file)]
+
+
+def test_cells_writer_replaces_an_earlier_run(tmp_path):
+    path = tmp_path / 'cells.csv'
+    path.write_text('file,name\nold.tif,9\n')
+    writer = CellsWriter(path)
+    writer.append('a.tif', spheres('1', '0'))
+    assert read_cells(path) == [('a.tif', '1'), ('a.tif', '0')]
+
+
+def test_cells_writer_keep_frames_drops_later_frames_and_a_partial_line(tmp_path):
+    path = tmp_path / 'cells.csv'
+    writer = CellsWriter(path)
+    for image_name in ('a.tif', 'b.tif', 'c.tif'):
+        writer.append(image_name, spheres('0', '1'))
+    # a crash while appending the next frame
+    with open(path, 'a') as file:
+        file.write('d.tif,0,1.0,2')
+
+    resumed = CellsWriter(path)
+    resumed.keep_frames(['a.tif', 'b.tif'])
+    resumed.append('c.tif', spheres('2'))
+    assert read_cells(path) == [('a.tif', '0'), ('a.tif', '1'), ('b.tif', '0'), ('b.tif', '1'), ('c.tif', '2')]
+    assert path.read_text().endswith('\n')
+
+
+def test_cells_writer_compact_sorts_by_file_then_name(tmp_path):
+    path = tmp_path / 'cells.csv'
+    writer = CellsWriter(path)
+    writer.append('b.tif', spheres('1', '0'))
+    writer.append('a.tif', spheres('10', '1'))
+    writer.compact()
+    assert read_cells(path) == [('a.tif', '1'), ('a.tif', '10'), ('b.tif', '0'), ('b.tif', '1')]
+    assert not path.with_suffix('.tmp').exists()
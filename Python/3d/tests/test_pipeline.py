@@ -0,0 +1,80 @@
+import threading
+
+import pytest
+
+from CellUniverse.Pipeline import BoundedStage, StageTimings
+
+TIMEOUT = 5
+
+
+def test_submit_blocks_while_the_queue_is_full():
+    stage = BoundedStage('write', 1, 1, StageTimings())
+    started, release = threading.Event(), threading.Event()
+    done = []
+
+    def blocked():
+        started.set()
+        assert release.wait(TIMEOUT)
+        done.append('first')
+
+    stage.submit(blocked)
+    assert started.wait(TIMEOUT)
+    stage.submit(done.append, 'second')  # fills the queue
+
+    submitter = threading.Thread(target=stage.submit, args=(done.append, 'third'))
+    submitter.start()
+    submitter.join(0.2)
+    assert submitter.is_alive()
+    assert done == []
+
+    release.set()
+    submitter.join(TIMEOUT)
+    assert not submitter.is_alive()
+    stage.join()
+    assert done == ['first', 'second', 'third']
+    assert stage.timings.wait_time['write'] >= 0.2
+    stage.shutdown()
+
+
+def test_errors_are_raised_by_join_and_the_next_submit():
+    def fail():
+        raise ValueError('broken frame')
+
+    stage = BoundedStage('write', 2, 2, StageTimings())
+    stage.submit(fail)
+    with pytest.raises(ValueError, match='broken frame'):
+        stage.join()
+
+    future = stage.submit(fail)
+    with pytest.raises(ValueError):
+        future.result(TIMEOUT)
+    with pytest.raises(ValueError, match='broken frame'):
+        stage.submit(lambda: None)
+    stage.shutdown()
+
+
+def test_wait_returns_the_result():
+    stage = BoundedStage('load', 1, 1, StageTimings())
+    assert stage.wait(stage.submit(sum, [1, 2, 3])) == 6
+    stage.shutdown()
+
+
+def test_shutdown_finishes_the_queued_tasks_and_stops_the_threads():
+    stage = BoundedStage('write', 2, 4, StageTimings())
+    release = threading.Event()
+    done = []
+    lock = threading.Lock()
+
+    def task(i):
+        assert release.wait(TIMEOUT)
+        with lock:
+            done.append(i)
+
+    for i in range(6):
+        if i == 5:
+            release.set()
+        stage.submit(task, i)
+    stage.shutdown()
+    assert sorted(done) == list(range(6))
+    assert not any(thread.is_alive() for thread in stage._threads)
+    assert stage.timings.busy_time['write'] > 0
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from CellUniverse import Lineage
+from CellUniverse.Convergence import OptimizationResult
+from CellUniverse.Frame import Frame
+from CellUniverse.Pyramid import PyramidLevel, coarse_simulation_config, downsample_stack, scale_cell
+
+from helpers import make_cells, make_config, make_frame, render
+
+
+@pytest.mark.parametrize('xy_factor', [2, 3, 4])
+def test_scale_cell_round_trips(xy_factor):
+    make_config()
+    for cell in make_cells(10):
+        restored = scale_cell(scale_cell(cell, xy_factor), xy_factor, inverse=True)
+        assert restored.get_cell_params().name == cell.get_cell_params().name
+        for name in ('x', 'y', 'z', 'radius'):
+            assert getattr(restored.get_cell_params(), name) == pytest.approx(getattr(cell.get_cell_params(), name))
+
+
+def coarse_cost(frame, level, cells):
+    real_image_stack = downsample_stack(frame.real_image_stack, level)
+    simulation_config = coarse_simulation_config(frame.simulation_config, real_image_stack, level)
+    coarse_cells = [scale_cell(cell, level.xy_factor) for cell in cells]
+    return Frame(real_image_stack, simulation_config, coarse_cells, None, 'coarse').cost
+
+
+@pytest.mark.parametrize('level', [PyramidLevel(2, 1, 0.4), PyramidLevel(2, 2, 0.4), PyramidLevel(4, 1, 0.4)])
+def test_coarse_cost_is_lowest_at_the_ground_truth(level):
+    config = make_config()
+    truth = make_cells(8, shape=(64, 64), min_radius=4, max_radius=8)
+    frame = Frame(render(config, truth), config.simulation, list(truth), None, 'frame.tif')
+    best = coarse_cost(frame, level, truth)
+
+    for index in range(len(truth)):
+        params = truth[index].get_cell_params()
+        # one coarse pixel off in x or y, or half a coarse pixel off in the radius
+        for name, offset in [('x', level.xy_factor), ('x', -level.xy_factor), ('y', level.xy_factor),
+                             ('y', -level.xy_factor), ('radius', level.xy_factor / 2), ('radius', -level.xy_factor / 2)]:
+            moved = type(truth[index])(params.copy(update={name: getattr(params, name) + offset}))
+            assert coarse_cost(frame, level, truth[:index] + [moved] + truth[index + 1:]) > best
+
+
+def test_refinement_gets_its_share_of_the_iterations(monkeypatch):
+    """A coarse level that stops early does not hand its unused iterations to the full resolution pass."""
+    config, frame = make_frame(count=5, pyramid_factors=[4, 2], pyramid_iterations=[0.5, 0.3])
+    budgets = []
+
+    def run_iterations(frame, config, frame_index, total_iterations):
+        budgets.append(total_iterations)
+        return OptimizationResult(1, frame.cost, 'converged')
+
+    monkeypatch.setattr(Lineage, 'run_iterations', run_iterations)
+    result = Lineage.optimize_pyramid(frame, config, 0, 1000)
+    assert budgets == [500, 300, 200]
+    assert result.iterations == 3
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from CellUniverse.Cells import Sphere
+from CellUniverse.Cells.Cell import PerturbParams
+from CellUniverse.Cells.Sphere import SphereParams
+from CellUniverse.Frame import Frame
+from CellUniverse.Sampling import FenwickSampler
+
+from helpers import make_config, make_frame
+
+
+def test_fenwick_sampler_matches_prefix_sums():
+    rng = np.random.default_rng(0)
+    weights = rng.uniform(0, 1, 50)
+    sampler = FenwickSampler(weights)
+    for _ in range(200):
+        index = int(rng.integers(len(weights)))
+        weights[index] = rng.uniform(0, 1)
+        sampler.update(index, weights[index])
+    assert np.allclose(sampler.weights, weights)
+    assert sampler.total == pytest.approx(weights.sum())
+    for uniform in rng.uniform(0, 1, 100):
+        expected = int(np.searchsorted(np.cumsum(weights), uniform * weights.sum(), side='right'))
+        assert sampler.sample(uniform) == expected
+
+
+def test_fenwick_sampler_swap_remove_and_append():
+    sampler = FenwickSampler([1.0, 2.0, 3.0, 4.0])
+    sampler.swap_remove(1)
+    assert list(sampler.weights) == [1.0, 4.0, 3.0]
+    sampler.append(5.0)
+    assert list(sampler.weights) == [1.0, 4.0, 3.0, 5.0]
+    assert sampler.total == 13.0
+
+
+def test_residual_scores_match_a_full_rescore():
+    """After many accepted moves, the incrementally updated scores equal scoring every cell again."""
+    _, frame = make_frame(count=40, shape=(48, 48), cell_selection='residual')
+    rng = np.random.default_rng(3)
+    for i in range(3000):
+        _, callback = frame.split() if i % 20 == 0 else frame.perturb()
+        callback(bool(rng.uniform() < 0.7))
+    rescored = [frame._cell_score(cell) for cell in frame.cells]
+    assert np.allclose(frame.cell_sampler.weights, rescored, rtol=1e-9, atol=1e-9)
+
+
+def test_cells_sharing_an_edge_pixel_are_rescored(monkeypatch):
+    """Cells whose boxes are less than a pixel apart share pixels of their score regions."""
+    config = make_config()
+    Sphere.cellConfig = config.cell.copy(update={
+        'x': PerturbParams(prob=0, mu=0, sigma=0), 'y': PerturbParams(prob=0, mu=0, sigma=0),
+        'z': PerturbParams(prob=0, mu=0, sigma=0), 'radius': PerturbParams(prob=1, mu=-0.4, sigma=0)})
+    config.simulation.cell_selection = 'residual'
+    # the box of the first cell ends at x = 13.4 and the box of the second starts at x = 13.6
+    cells = [Sphere(SphereParams(name='a', x=10, y=20, z=0, radius=3.4)),
+             Sphere(SphereParams(name='b', x=17.6, y=20, z=0, radius=4))]
+    frame = Frame(np.zeros((9, 40, 40)), config.simulation, cells, None, 'frame.tif')
+    monkeypatch.setattr(frame, 'choose_cell_index', lambda: 0)
+
+    _, callback = frame.perturb()
+    callback(True)
+    assert frame.cells[0].get_cell_params().radius == pytest.approx(3.0)
+    assert np.allclose(frame.cell_sampler.weights, [frame._cell_score(cell) for cell in frame.cells])
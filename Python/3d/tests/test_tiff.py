@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from CellUniverse.CellUniverse import get_image_file_paths, probe_tiff
+
+from helpers import make_config
+
+
+def write_tiff(path, slices, shape=(20, 30), dtype=np.uint8):
+    images = [Image.fromarray(np.full(shape, i, dtype=dtype)) for i in range(slices)]
+    images[0].save(path, save_all=True, append_images=images[1:])
+
+
+def test_probe_tiff_reads_the_header(tmp_path):
+    write_tiff(tmp_path / 'frame000.tif', 7)
+    assert tuple(probe_tiff(tmp_path / 'frame000.tif')) == (7, 20, 30, 'uint8')
+    write_tiff(tmp_path / 'frame001.tif', 1, dtype=np.uint16)
+    assert tuple(probe_tiff(tmp_path / 'frame001.tif')) == (1, 20, 30, 'uint16')
+
+
+def test_z_slices_are_set_from_the_header(tmp_path):
+    for i in range(3):
+        write_tiff(tmp_path / f'frame{i:03d}.tif', 5)
+    config = make_config(depth=9)
+    paths = get_image_file_paths(str(tmp_path / 'frame%03d.tif'), 0, -1, config)
+    assert [path.name for path in paths] == ['frame000.tif', 'frame001.tif', 'frame002.tif']
+    assert config.simulation.z_slices == 5
+    assert config.simulation.z_values == [-2, -1, 0, 1, 2]
+
+
+@pytest.mark.parametrize('slices, shape, dtype', [(6, (20, 30), np.uint8), (5, (20, 31), np.uint8), (5, (20, 30), np.uint16)])
+def test_frames_that_disagree_are_refused(tmp_path, slices, shape, dtype):
+    write_tiff(tmp_path / 'frame000.tif', 5)
+    write_tiff(tmp_path / 'frame001.tif', slices, shape, dtype)
+    with pytest.raises(ValueError, match='frame001.tif'):
+        get_image_file_paths(str(tmp_path / 'frame%03d.tif'), 0, -1, make_config())